@@ -0,0 +1,34 @@
+"""
+View of the galaxy shared by galaxy_renderer (OpenGL) and
+offline_renderer (NumPy), kept free of OpenGL so both can import it.
+
+The camera sits at CAMERA_POSITION looking down -z with a FIELD_OF_VIEW
+degree vertical perspective from NEAR to FAR, the scene turned by the
+MouseInteractor in front of it. Bodies are lit from LIGHT_POSITION with
+AMBIENT + DIFFUSE * cos(angle) grey.
+"""
+import math
+
+CAMERA_POSITION = (0, 0, 2)
+FIELD_OF_VIEW = 60
+NEAR = 0.05
+FAR = 10
+LIGHT_POSITION = (2, 2, 3)
+AMBIENT = 0.2
+DIFFUSE = 0.7
+
+
+def light_direction():
+    """
+        Unit vector towards the light.
+    """
+    length = math.sqrt(sum(c * c for c in LIGHT_POSITION))
+    return tuple(c / length for c in LIGHT_POSITION)
+
+
+def pixels_per_unit(y_size, field_of_view=FIELD_OF_VIEW):
+    """
+        Pixels covered by one unit of length at distance one from the
+        camera, for a window y_size pixels high.
+    """
+    return y_size / (2 * math.tan(math.radians(field_of_view) / 2))
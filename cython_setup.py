@@ -6,6 +6,10 @@ How to use:
 
 Python will then search the file specified using FILE_NAME
 and attempt to cythonize it
+
+To let the compiler use AVX for the tiled kernel on the build machine:
+
+    CFLAGS="-march=native" python cython_setup.py  build_ext --inplace
 '''
 
 from distutils.core import setup
@@ -19,7 +23,9 @@ ext_modules = [
         Extension(FILE_NAME,
                   sources=[FILE_NAME + ".pyx"],
                   libraries=[],
-                  extra_compile_args=['-fopenmp'],
+                  # no errno/FP-trap semantics needed, lets gcc vectorise sqrt
+                  extra_compile_args=['-fopenmp', '-fno-math-errno',
+                                      '-fno-trapping-math'],
                   extra_link_args=['-fopenmp'],
                   include_dirs=[np.get_include()]
                   )
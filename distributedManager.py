@@ -1,24 +1,165 @@
-from multiprocessing.managers import BaseManager
-from multiprocessing import JoinableQueue, Queue
-
-
-class TaskManager(BaseManager):
-    pass
-
-
-if __name__ == '__main__':
-    from sys import argv, exit
-    if len(argv) != 2:
-        print('usage:', argv[0], b'socket_nr')
-        exit(0)
-    master_socket = int(argv[1])
-    task_queue = JoinableQueue()
-    result_queue = Queue()
-    TaskManager.register('get_job_queue',
-                         callable=lambda:task_queue)
-    TaskManager.register('get_result_queue',
-                         callable=lambda:result_queue)
-    m = TaskManager(address=('', master_socket),
-                    authkey=b'secret')
-    print('starting queue server, socket', master_socket)
-    m.get_server().serve_forever()
+"""
+Binary transport between distributedMaster and distributedWorker.
+
+Every message is one small header followed by the raw bytes of the
+numpy arrays it carries, sent over a multiprocessing.connection with
+send_bytes. The receiver reads the header and then reads every array
+directly into its preallocated target with recv_bytes_into, so arrays
+are never pickled or copied into temporary objects.
+
+Messages (header fields step, start, end, timestep; arrays):
+    STATE  step, 0, N, 0    positions (N, 3), speed (N, 3), mass (N,)
+                            after step
+    SLICE  step, start, end positions[start:end] valid at the start of step
+    STEP   step, start, end, timestep
+                            speed[start:end], compute bodies start to end-1,
+                            a worker may get several chunks of one step
+    RESULT step, start, end positions[start:end], speed[start:end] after step
+    STOP
+
+Ring mode, the workers pass the slices among themselves:
+    RING    0, rank, nr_of_workers
+                            the worker answers with an ADDRESS it listens
+                            on for its predecessor in the ring
+    ADDRESS                 "host:port" bytes, from the master the address
+                            of the successor to connect to
+    RING_STEP step, start, end, timestep
+                            compute bodies start to end-1 with the own
+                            speeds, then forward slices around the ring
+                            (as SLICE messages) until every worker has all
+                            positions of step + 1, answer with ACK step
+    COLLECT step            the worker answers with RESULT of its range
+"""
+import queue
+import socket
+import struct
+import threading
+import time
+from multiprocessing.connection import Client
+
+AUTHKEY = b'secret'
+
+STATE_MESSAGE = b'S'
+SLICE_MESSAGE = b'P'
+STEP_MESSAGE = b'T'
+RESULT_MESSAGE = b'R'
+STOP_MESSAGE = b'Q'
+RING_MESSAGE = b'G'
+ADDRESS_MESSAGE = b'A'
+RING_STEP_MESSAGE = b'W'
+ACK_MESSAGE = b'K'
+COLLECT_MESSAGE = b'C'
+
+# kind, dtype character of the arrays, step, start, end, timestep
+_HEADER = struct.Struct('<ccqqqd')
+_DTYPE = b'd'
+
+
+def send_message(conn, kind, step=0, start=0, end=0, timestep=0.0, arrays=()):
+    """
+    Send a header and the buffers of the float64 arrays
+    """
+    conn.send_bytes(_HEADER.pack(kind, _DTYPE, step, start, end, timestep))
+    for array in arrays:
+        conn.send_bytes(memoryview(array).cast('B'))
+
+
+def recv_header(conn):
+    """
+    Receive a header, return (kind, step, start, end, timestep)
+    """
+    kind, dtype, step, start, end, timestep = _HEADER.unpack(conn.recv_bytes())
+    if dtype != _DTYPE:
+        raise ValueError('unexpected dtype in message: {}'.format(dtype))
+    return kind, step, start, end, timestep
+
+
+def recv_array_into(conn, array):
+    """
+    Receive the next array of a message directly into a contiguous
+    float64 array of the right size
+    """
+    # byte view, recv_bytes_into measures the buffer in items of its format
+    size = conn.recv_bytes_into(memoryview(array).cast('B'))
+    if size != array.nbytes:
+        raise ValueError('expected {} bytes, received {}'.format(array.nbytes, size))
+
+
+def pack_address(address):
+    """
+    Encode a (host, port) address for an ADDRESS message
+    """
+    return '{}:{}'.format(*address).encode()
+
+
+def unpack_address(data):
+    """
+    Decode the bytes of an ADDRESS message to (host, port)
+    """
+    host, _, port = data.decode().rpartition(':')
+    return host, int(port)
+
+
+def local_ip(conn):
+    """
+    IP of the local end of a connection, reachable by the other end
+    """
+    sock = socket.fromfd(conn.fileno(), socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        return sock.getsockname()[0]
+    finally:
+        sock.close()
+
+
+def _send_loop(conn, messages):
+    while True:
+        message = messages.get()
+        try:
+            if message is None:
+                break
+            send_message(conn, *message)
+        finally:
+            messages.task_done()
+
+
+def start_sender(conn):
+    """
+    Start a thread that sends the send_message argument tuples put into
+    the returned queue, so sending never blocks the caller. None ends
+    the thread, queue.join() waits until everything queued is sent.
+    Returns (queue, thread).
+    """
+    messages = queue.Queue()
+    sender = threading.Thread(target=_send_loop, args=(conn, messages),
+                              daemon=True)
+    sender.start()
+    return messages, sender
+
+
+def disable_nagle(conn):
+    """
+    Send small messages (headers, thin slices) at once instead of letting
+    TCP wait for more data, which costs ~40 ms per step otherwise
+    """
+    sock = socket.fromfd(conn.fileno(), socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    finally:
+        sock.close()
+
+
+def connect(master_ip, master_socket, timeout=60):
+    """
+    Connect to the master, retry until it listens or timeout seconds
+    passed
+    """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            conn = Client((master_ip, master_socket), authkey=AUTHKEY)
+            disable_nagle(conn)
+            return conn
+        except ConnectionRefusedError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.2)
@@ -1,63 +1,276 @@
-from distributedManager import TaskManager
+from multiprocessing.connection import Listener, wait
 import time
+
 import numpy as np
 
+import distributedManager as dm
+
 
-def __calculate(positions, speed, mass, timestep): # This will probably receive (positions, speed, mass, timestep)
-    job_queue, result_queue = m.get_job_queue(), m.get_result_queue()
+# chunks per worker and step at equal speed, more chunks balance better
+# but cost more messages
+_CHUNKS_PER_WORKER = 4
+# chunks a worker may have queued, the second hides the round trip
+_MAX_IN_FLIGHT = 2
+# smallest chunk in bodies
+_MIN_CHUNK = 32
+# weight of the newest sample in the throughput average
+_RATE_SMOOTHING = 0.3
 
-    in_list = __create_argument_list(positions, speed, mass, timestep)
-    result_list = []
 
-    for arg in in_list:
-        job_queue.put(arg)
-    job_queue.join()
-    while not result_queue.empty():
-        result_list.append(result_queue.get())
-    return result_list
+class DistributedMaster:
+    """
+    Splits every step of the direct sum over the connected workers.
+    Workers keep positions and masses, get the speeds of a chunk with
+    each job and return only that chunk. Returned chunks are forwarded
+    to all workers as soon as they arrive, so the broadcast for the next
+    step overlaps with workers that are still computing.
 
+    Scheduling: chunk sizes follow the measured throughput of each
+    worker, every worker pulls new chunks from the remaining range as
+    soon as it has less than _MAX_IN_FLIGHT queued (work stealing), and
+    when nothing is left an idle worker gets a copy of the oldest
+    unfinished chunk of another one (speculative re-issue), the first
+    result wins.
 
-def __create_argument_list(positions, speed, mass, timestep, l):
+    After start_ring() the workers form a ring instead: every worker
+    keeps the speeds of a fixed range, and the new positions are passed
+    from worker to worker, so the master only sends the step barrier and
+    collects positions and speeds when asked to.
     """
-    Create a tuple of positions, speed, mass, timestep and indexrange
+    def __init__(self, address):
+        """
+        Listen for workers on address (host, port), port 0 picks a free one
+        """
+        self.listener = Listener(address, authkey=dm.AUTHKEY)
+        self.address = self.listener.address
+        self.connections = []
+        self.send_queues = []
+        self.senders = []
+        # per worker: measured bodies/s, time its last result arrived and
+        # the chunks it still computes {(step, start): (end, send time)}
+        self.rates = []
+        self.last_result = []
+        self.in_flight = []
+        # results of step s are written to buffers[s % 2], so a chunk of
+        # step s is not overwritten while it is still forwarded
+        self.buffers = None
+        self.step = 0
+        self.ring = False
+
+    def accept_workers(self, nr_of_workers):
+        """
+        Wait until nr_of_workers workers connected
+        """
+        for i in range(nr_of_workers):
+            conn = self.listener.accept()
+            dm.disable_nagle(conn)
+            messages, sender = dm.start_sender(conn)
+            self.connections.append(conn)
+            self.send_queues.append(messages)
+            self.senders.append(sender)
+            self.rates.append(1.0)
+            self.last_result.append(0.0)
+            self.in_flight.append({})
+
+    def set_state(self, positions, speed, mass):
+        """
+        Send positions, speeds and masses to all workers, needed at the
+        start and again after the bodies were re-sorted
+        """
+        positions = np.array(positions, dtype=np.float64)
+        self.buffers = (positions, positions.copy())
+        self.mass = np.array(mass, dtype=np.float64)
+        speed = np.array(speed, dtype=np.float64)
+        for messages in self.send_queues:
+            messages.put((dm.STATE_MESSAGE, self.step, 0, positions.shape[0], 0.0,
+                          (positions, speed, self.mass)))
+
+    def start_ring(self):
+        """
+        Connect the workers to a ring, each one to the next in the order
+        they connected. Call after accept_workers.
+        """
+        nr_of_workers = len(self.connections)
+        for rank, messages in enumerate(self.send_queues):
+            messages.put((dm.RING_MESSAGE, 0, rank, nr_of_workers))
+        addresses = []
+        for conn in self.connections:
+            dm.recv_header(conn)
+            addresses.append(conn.recv_bytes())
+        for rank, messages in enumerate(self.send_queues):
+            messages.put((dm.ADDRESS_MESSAGE, 0, 0, 0, 0.0,
+                          (addresses[(rank + 1) % nr_of_workers],)))
+        self.ring = True
+
+    def _issue(self, worker, start, end, speed, timestep, outstanding):
+        """
+        Send the chunk start to end-1 of the current step to a worker
+        """
+        now = time.time()
+        self.send_queues[worker].put((dm.STEP_MESSAGE, self.step, start, end,
+                                      timestep, (speed[start:end],)))
+        self.in_flight[worker][(self.step, start)] = (end, now)
+        outstanding.setdefault((start, end), [now, 0])[1] += 1
+
+    def move_bodies(self, positions, speed, timestep, collect=True):
+        """
+        Advance all bodies but the black hole by one step, positions and
+        speed are updated in place. The positions are only read by
+        set_state. In ring mode they are only updated if collect is set,
+        otherwise they stay at the last collected step.
+        """
+        if self.ring:
+            self._move_bodies_ring(positions, speed, timestep, collect)
+            return
+        speed = np.asarray(speed)
+        nr_of_bodies = self.buffers[0].shape[0]
+        nr_of_workers = len(self.connections)
+        self.step += 1
+        result = self.buffers[self.step % 2]
+        # unfinished chunks {(start, end): [first send time, copies]}
+        outstanding = {}
+        next_start = 1
+        finished = 1
+        total_rate = sum(self.rates)
+
+        while finished < nr_of_bodies:
+            # HAND OUT NEW CHUNKS, RE-ISSUE STRAGGLERS
+            for worker in range(nr_of_workers):
+                while len(self.in_flight[worker]) < _MAX_IN_FLIGHT and next_start < nr_of_bodies:
+                    size = int((nr_of_bodies - 1) * self.rates[worker]
+                               / total_rate / _CHUNKS_PER_WORKER)
+                    end = min(nr_of_bodies, next_start + max(size, _MIN_CHUNK))
+                    self._issue(worker, next_start, end, speed, timestep, outstanding)
+                    next_start = end
+                if not self.in_flight[worker] and next_start == nr_of_bodies:
+                    stragglers = [(sent, chunk) for chunk, (sent, copies)
+                                  in outstanding.items() if copies == 1]
+                    if stragglers:
+                        start, end = min(stragglers)[1]
+                        self._issue(worker, start, end, speed, timestep, outstanding)
+
+            busy = [conn for conn, chunks in zip(self.connections, self.in_flight) if chunks]
+            for conn in wait(busy):
+                worker = self.connections.index(conn)
+                kind, step, start, end, _ = dm.recv_header(conn)
+                _, sent = self.in_flight[worker].pop((step, start))
+                if step != self.step or (start, end) not in outstanding:
+                    # late copy of a chunk that is already done
+                    dm.recv_array_into(conn, np.empty((end - start, 3)))
+                    dm.recv_array_into(conn, np.empty((end - start, 3)))
+                    self.last_result[worker] = time.time()
+                    continue
+                dm.recv_array_into(conn, result[start:end])
+                dm.recv_array_into(conn, speed[start:end])
+                del outstanding[(start, end)]
+                finished += end - start
+
+                # THROUGHPUT, counted from when the worker could start
+                now = time.time()
+                busy_time = now - max(sent, self.last_result[worker])
+                self.last_result[worker] = now
+                if busy_time > 0:
+                    self.rates[worker] += _RATE_SMOOTHING * ((end - start) / busy_time
+                                                             - self.rates[worker])
+
+                # PIPELINED BROADCAST FOR THE NEXT STEP
+                for messages in self.send_queues:
+                    messages.put((dm.SLICE_MESSAGE, self.step + 1, start, end,
+                                  0.0, (result[start:end],)))
+        np.copyto(np.asarray(positions), result)
+
+    def _move_bodies_ring(self, positions, speed, timestep, collect):
+        """
+        One step in ring mode, the master waits for all workers (step
+        barrier) and receives nothing but acknowledgements unless collect
+        is set
+        """
+        nr_of_bodies = self.buffers[0].shape[0]
+        bounds = np.linspace(1, nr_of_bodies, len(self.connections) + 1).astype(np.int64)
+        self.step += 1
+        for worker, messages in enumerate(self.send_queues):
+            messages.put((dm.RING_STEP_MESSAGE, self.step, int(bounds[worker]),
+                          int(bounds[worker + 1]), timestep))
+        for conn in self.connections:
+            kind, step, _, _, _ = dm.recv_header(conn)
+            if kind != dm.ACK_MESSAGE or step != self.step:
+                raise RuntimeError('worker did not finish step {}'.format(self.step))
+        if not collect:
+            return
+
+        positions, speed = np.asarray(positions), np.asarray(speed)
+        for messages in self.send_queues:
+            messages.put((dm.COLLECT_MESSAGE, self.step))
+        for conn in self.connections:
+            kind, step, start, end, _ = dm.recv_header(conn)
+            dm.recv_array_into(conn, positions[start:end])
+            dm.recv_array_into(conn, speed[start:end])
+
+    def stop(self):
+        """
+        Let all workers exit and close the connections
+        """
+        for messages in self.send_queues:
+            messages.put((dm.STOP_MESSAGE,))
+            messages.put(None)
+        for sender in self.senders:
+            sender.join()
+        for conn in self.connections:
+            conn.close()
+        self.listener.close()
+
+
+def _local_run(nr_of_bodies, steps, nr_of_workers, ring=False):
+    """
+    Start a master and workers on localhost, compare a distributed run
+    against the single-node _move_bodies. With ring the workers exchange
+    the positions among themselves and only the last step is collected.
     """
-    # converting mem views to np array
-    step = 10 # number of positions every worker has to work with
-    count = 1
-    pos = np.asarray(positions)
-    spe = np.zeros((step, 3), dtype=np.float64)
-    mas = np.asarray(mass)
-
-    for i in range(1, mass.shape[0], step):
-        index = 0
-        indexrange = []
-        for j in range(i, step*count+1):
-            if j > mass.shape[0]:
-                break
-            spe[index][0] = speed[j][0]
-            spe[index][1] = speed[j][1]
-            spe[index][2] = speed[j][2]
-            indexrange.append(j)
-            index += 1
-        count += 1
-        l.append((pos, spe, mas, timestep, indexrange))
-    return l
+    import distributedWorker
+    import reference_run
 
+    master = DistributedMaster(('127.0.0.1', 0))
+    master_ip, master_socket = master.address
+    processes = distributedWorker.start_workers(master_ip, master_socket,
+                                                nr_of_workers)
+    master.accept_workers(nr_of_workers)
+    if ring:
+        master.start_ring()
 
-if __name__ == '__main__':
-    from sys import argv, exit
-    if len(argv) != 4:
-        print('usage:', argv[0], 'server_IP server_socket amount_of_shots')
-        exit(0)
-    server_ip = argv[1]
-    server_socket = int(argv[2])
-    TaskManager.register('get_job_queue')
-    TaskManager.register('get_result_queue')
-    m = TaskManager(address=(server_ip, server_socket), authkey=b'secret')
-    m.connect()
+    positions, speed, mass = reference_run.bodies(nr_of_bodies)
+    reference = reference_run.run(positions, speed, mass, steps)
 
     t1 = time.time()
-    result = __calculate(m, int(argv[3]))
+    master.set_state(positions, speed, mass)
+    for i in range(steps):
+        master.move_bodies(positions, speed, reference_run.TIMESTEP, collect=i == steps - 1)
     t2 = time.time()
-    print(' result: ', result)
-    print(' time:   ', t2-t1, ' s\n')
+
+    master.stop()
+    for p in processes:
+        p.join()
+    print(' workers:      ', nr_of_workers, 'in a ring' if ring else '')
+    print(' distributed:  ', t2-t1, ' s')
+    print(' single node:  ', reference[2], ' s')
+    print(' max deviation:', np.abs(positions - reference[0]).max())
+    return reference_run.identical(positions, speed, reference)
+
+
+if __name__ == '__main__':
+    from sys import argv, exit
+    if len(argv) < 2 or (argv[1] != 'local' and len(argv) < 4):
+        print('usage:', argv[0], 'listen_IP listen_socket nr_of_workers')
+        print('       ', argv[0], 'local [nr_of_bodies] [steps] [nr_of_workers] [star|ring]')
+        exit(0)
+    if argv[1] == 'local':
+        nr_of_bodies = int(argv[2]) if len(argv) > 2 else 2000
+        steps = int(argv[3]) if len(argv) > 3 else 10
+        nr_of_workers = int(argv[4]) if len(argv) > 4 else 2
+        ring = len(argv) > 5 and argv[5] == 'ring'
+        identical = _local_run(nr_of_bodies, steps, nr_of_workers, ring)
+        print(' identical:    ', identical)
+        exit(0 if identical else 1)
+    master = DistributedMaster((argv[1], int(argv[2])))
+    master.accept_workers(int(argv[3]))
+    print(len(master.connections), 'workers connected')
+    master.stop()
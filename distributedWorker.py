@@ -1,40 +1,131 @@
 from multiprocessing import cpu_count, Process
-from distributedManager import TaskManager
+from multiprocessing.connection import Listener
+import threading
+
+import numpy as np
+
+import distributedManager as dm
 import simulation_physic as sp
 
 
-def __worker_function(job_queue, result_queue):
+def __connect_ring(conn):
+    """
+    Listen for the predecessor, tell the master where and connect to the
+    successor it answers with. Returns (predecessor connection,
+    successor send queue, successor sender thread)
+    """
+    listener = Listener((dm.local_ip(conn), 0), authkey=dm.AUTHKEY)
+    dm.send_message(conn, dm.ADDRESS_MESSAGE,
+                    arrays=(dm.pack_address(listener.address),))
+    dm.recv_header(conn)
+    successor_ip, successor_socket = dm.unpack_address(conn.recv_bytes())
+    # accept in the background, every worker connects before it accepts
+    predecessor = []
+    acceptor = threading.Thread(target=lambda: predecessor.append(listener.accept()))
+    acceptor.start()
+    successor = dm.connect(successor_ip, successor_socket)
+    acceptor.join()
+    listener.close()
+    dm.disable_nagle(predecessor[0])
+    messages, sender = dm.start_sender(successor)
+    return predecessor[0], messages, sender
+
+
+def __worker_function(master_ip, master_socket, nr_of_threads):
+    conn = dm.connect(master_ip, master_socket)
+    sp._set_num_threads(nr_of_threads)
+
+    # persistent state, positions[s % 2] holds the positions at the start
+    # of step s and is kept current by SLICE messages
+    positions, speed, mass = None, None, None
+    # ring mode: predecessor connection, queue to the successor, number of
+    # workers and the range computed by this worker
+    predecessor, ring, ring_sender, ring_size = None, None, None, 0
+    own_range = (0, 0)
     while True:
-        task = job_queue.get()
-        result = sp._mp_move_bodies_circle(*task)
-        # In the tuple task should be positions,speed,mass,timestep and probably the index range
-        # if error here check job queue
-        # the move bodies function returns a tuple (positions, speed)
-        result_queue.put(result)
-        job_queue.task_done()
-
-
-def __start_workers(m):
-    job_queue, result_queue = m.get_job_queue(), m.get_result_queue()
-    nr_of_processes = cpu_count()
+        kind, step, start, end, timestep = dm.recv_header(conn)
+        if kind == dm.STOP_MESSAGE:
+            break
+        elif kind == dm.STATE_MESSAGE:
+            positions = (np.empty((end, 3), dtype=np.float64),
+                         np.empty((end, 3), dtype=np.float64))
+            speed = np.empty((end, 3), dtype=np.float64)
+            mass = np.empty(end, dtype=np.float64)
+            dm.recv_array_into(conn, positions[0])
+            dm.recv_array_into(conn, speed)
+            dm.recv_array_into(conn, mass)
+            positions[1][...] = positions[0]
+        elif kind == dm.SLICE_MESSAGE:
+            dm.recv_array_into(conn, positions[step % 2][start:end])
+        elif kind == dm.STEP_MESSAGE:
+            current = positions[step % 2]
+            dm.recv_array_into(conn, speed[start:end])
+            # further chunks of this step need the old positions
+            old_positions = current[start:end].copy()
+            sp._mp_move_bodies_circle(current, speed, mass, timestep,
+                                      np.array([start, end], dtype=np.int32))
+            # only the chunk goes back
+            dm.send_message(conn, dm.RESULT_MESSAGE, step, start, end,
+                            arrays=(current[start:end], speed[start:end]))
+            current[start:end] = old_positions
+        elif kind == dm.RING_MESSAGE:
+            ring_size = end
+            predecessor, ring, ring_sender = __connect_ring(conn)
+        elif kind == dm.RING_STEP_MESSAGE:
+            current, following = positions[step % 2], positions[(step + 1) % 2]
+            # current is not read again, integrate the own range in place
+            sp._mp_move_bodies_circle(current, speed, mass, timestep,
+                                      np.array([start, end], dtype=np.int32))
+            following[start:end] = current[start:end]
+            own_range = (start, end)
+            # ALLGATHER: pass on the slice received last, after
+            # ring_size - 1 rounds every slice went around once
+            for i in range(ring_size - 1):
+                ring.put((dm.SLICE_MESSAGE, step + 1, start, end, 0.0,
+                          (following[start:end],)))
+                _, _, start, end, _ = dm.recv_header(predecessor)
+                dm.recv_array_into(predecessor, following[start:end])
+            # the next step integrates following in place, it must be sent
+            ring.join()
+            dm.send_message(conn, dm.ACK_MESSAGE, step)
+        elif kind == dm.COLLECT_MESSAGE:
+            start, end = own_range
+            dm.send_message(conn, dm.RESULT_MESSAGE, step, start, end,
+                            arrays=(positions[(step + 1) % 2][start:end],
+                                    speed[start:end]))
+    if ring is not None:
+        ring.put(None)
+        ring_sender.join()
+        predecessor.close()
+    conn.close()
+
+
+def start_workers(master_ip, master_socket, nr_of_processes=1, nr_of_threads=0):
+    """
+    Start worker processes that connect to the master, with
+    nr_of_threads OpenMP threads each (0 = split the cores between them)
+    """
+    if nr_of_threads <= 0:
+        nr_of_threads = max(1, cpu_count() // nr_of_processes)
     processes = [Process(target=__worker_function,
-                         args=(job_queue, result_queue))
+                         args=(master_ip, master_socket, nr_of_threads))
                  for i in range(nr_of_processes)]
     for p in processes:
         p.start()
-    return nr_of_processes
+    return processes
 
 
 if __name__ == '__main__':
     from sys import argv, exit
     if len(argv) < 3:
-        print('usage:', argv[0], 'server_IP server_socket')
+        print('usage:', argv[0], 'master_IP master_socket [nr_of_processes] [nr_of_threads]')
         exit(0)
-    server_ip = argv[1]
-    server_socket = int(argv[2])
-    TaskManager.register('get_job_queue')
-    TaskManager.register('get_result_queue')
-    m = TaskManager(address=(server_ip, server_socket), authkey=b'secret')
-    m.connect()
-    nr_of_processes = __start_workers(m)
+    master_ip = argv[1]
+    master_socket = int(argv[2])
+    nr_of_processes = int(argv[3]) if len(argv) > 3 else 1
+    nr_of_threads = int(argv[4]) if len(argv) > 4 else 0
+    processes = start_workers(master_ip, master_socket, nr_of_processes,
+                              nr_of_threads)
     print(nr_of_processes, 'workers started')
+    for p in processes:
+        p.join()
@@ -0,0 +1,252 @@
+"""
+Compare the step implementations over body count and thread count.
+
+How to use:
+    python engine_benchmark.py [--bodies N ...] [--threads T ...]
+                               [--output results.json] [--baseline old.json]
+
+Implementations:
+    mockup    simulation_mockup._move_bodies_circle, a Python loop over
+              numba-compiled physics_formula calls per body. It sets the
+              speeds to circular orbits instead of integrating them and
+              moves the black hole, so its results are not compared.
+    numba     simulation_physics._move_bodies_circle, every body is
+              pulled towards the mass focus of all others and bodies are
+              moved one after the other.
+    cython_*  simulation_physic._move_bodies with every engine, the
+              pairwise sum of the forces. cython_direct is the reference.
+
+Every implementation does one untimed step first (compiles the numba
+functions, starts the OpenMP threads). The result of that step is
+compared with the one of cython_direct from the same initial bodies. The
+deviation is the largest error of a body's speed change divided by the
+largest speed change, i.e. the relative error of the accelerations. It is
+only checked against the tolerance for implementations of the pairwise
+model. The numba and mockup implementations are single-threaded and run
+once per body count. An implementation is skipped for larger body counts
+once one of its steps would take longer than --max-step-seconds.
+
+The results are written as JSON. With --baseline, the steps/s of every
+run are compared with an earlier result file to show regressions
+between builds.
+"""
+import argparse
+import datetime
+import json
+import platform
+import sys
+import time
+from multiprocessing import cpu_count
+
+import numpy as np
+
+import reference_run
+import simulation_constants as sc
+import simulation_physic as sp
+
+_MODEL_PAIRWISE = 'pairwise'
+_MODEL_MASS_FOCUS = 'mass_focus'
+_MODEL_CIRCULAR = 'circular_orbits'
+
+_REFERENCE = 'cython_' + sc.ENGINE_DIRECT
+# allowed relative acceleration error against the reference, the direct
+# engines only differ in the order of the sums
+_TOLERANCES = {
+    sc.ENGINE_DIRECT: 0.0,
+    sc.ENGINE_DIRECT_SYMMETRIC: 1e-9,
+    sc.ENGINE_DIRECT_TILED: 1e-9,
+    sc.ENGINE_BARNES_HUT: 1e-2,
+    sc.ENGINE_PARTICLE_MESH: 5e-2,
+}
+# a run is flagged as regression if it is that much slower than the baseline
+_REGRESSION = 0.9
+
+
+def _cython_step(engine):
+    def step(positions, speed, mass, timestep):
+        sp._move_bodies(engine, positions, speed, mass, timestep)
+    return step
+
+
+def _implementations():
+    """
+    Returns [(name, model, threaded, exponent of the cost in N, step
+    function)], the numba ones only if numba is installed
+    """
+    implementations = [('cython_' + engine, _MODEL_PAIRWISE, True,
+                        1 if engine in (sc.ENGINE_BARNES_HUT, sc.ENGINE_PARTICLE_MESH) else 2,
+                        _cython_step(engine))
+                       for engine in sc.ENGINES]
+    try:
+        import simulation_mockup
+        import simulation_physics
+    except ImportError:
+        print('numba not installed, skipping the mockup and numba implementations')
+        return implementations
+
+    def mockup_step(positions, speed, mass, timestep):
+        # the mockup multiplies the step width by 60 * 24
+        simulation_mockup._move_bodies_circle(positions, speed, mass, timestep / (60 * 24))
+
+    # the mockup sleeps 1 / __FPS seconds per step to pace the renderer
+    setattr(simulation_mockup, '__FPS', float('inf'))
+    implementations.append(('numba', _MODEL_MASS_FOCUS, False, 2,
+                            simulation_physics._move_bodies_circle))
+    implementations.append(('mockup', _MODEL_CIRCULAR, False, 2, mockup_step))
+    return implementations
+
+
+def _deviation(initial_speed, speed, reference_speed):
+    """
+    Relative error of the speed changes of one step, without the black hole
+    """
+    reference_change = reference_speed[1:] - initial_speed[1:]
+    error = np.abs((speed[1:] - initial_speed[1:]) - reference_change).max()
+    return float(error / np.abs(reference_change).max())
+
+
+def _time_steps(step, positions, speed, mass, min_seconds, max_steps):
+    """
+    Step copies of the bodies until min_seconds passed, returns (steps, seconds)
+    """
+    positions, speed = positions.copy(), speed.copy()
+    steps = 0
+    start = time.perf_counter()
+    while True:
+        step(positions, speed, mass, reference_run.TIMESTEP)
+        steps += 1
+        seconds = time.perf_counter() - start
+        if seconds >= min_seconds or steps >= max_steps:
+            return steps, seconds
+
+
+def _run(args):
+    implementations = _implementations()
+    results = []
+    # seconds of one step at the last body count, to skip hopeless runs
+    last_step = {}
+    # implementations that can not run here, e.g. numba without scipy
+    unavailable = {}
+    for nr_of_bodies in args.bodies:
+        positions, speed, mass = reference_run.bodies(nr_of_bodies, seed=nr_of_bodies)
+        reference_speed = None
+        for name, model, threaded, exponent, step in implementations:
+            if name in unavailable:
+                results.append({'implementation': name, 'nr_of_bodies': nr_of_bodies,
+                                'skipped': unavailable[name]})
+                continue
+            if name in last_step:
+                previous_bodies, seconds = last_step[name]
+                if seconds * (nr_of_bodies / previous_bodies) ** exponent > args.max_step_seconds:
+                    results.append({'implementation': name, 'nr_of_bodies': nr_of_bodies,
+                                    'skipped': 'estimated step time above {} s'.format(
+                                        args.max_step_seconds)})
+                    continue
+            for nr_of_threads in (args.threads if threaded else (1,)):
+                if threaded:
+                    sp._set_num_threads(nr_of_threads)
+                # WARM-UP, also the step that is checked
+                checked_positions, checked_speed = positions.copy(), speed.copy()
+                warm_up = time.perf_counter()
+                try:
+                    step(checked_positions, checked_speed, mass, reference_run.TIMESTEP)
+                except ImportError as error:
+                    # numba compiles on the first call and may miss scipy
+                    unavailable[name] = str(error)
+                    print(name, 'skipped:', error)
+                    results.append({'implementation': name, 'nr_of_bodies': nr_of_bodies,
+                                    'skipped': unavailable[name]})
+                    break
+                warm_up = time.perf_counter() - warm_up
+                if name == _REFERENCE and reference_speed is None:
+                    reference_speed = checked_speed
+
+                steps, seconds = _time_steps(step, positions, speed, mass,
+                                             args.min_seconds, args.max_steps)
+                deviation, tolerance, agrees = None, None, None
+                if model != _MODEL_CIRCULAR and reference_speed is not None:
+                    deviation = _deviation(speed, checked_speed, reference_speed)
+                if model == _MODEL_PAIRWISE and deviation is not None:
+                    tolerance = _TOLERANCES[name[len('cython_'):]]
+                    agrees = deviation <= tolerance
+                result = {'implementation': name, 'model': model,
+                          'nr_of_bodies': nr_of_bodies, 'threads': nr_of_threads,
+                          'steps': steps, 'seconds': seconds,
+                          'steps_per_s': steps / seconds,
+                          'interactions_per_s': steps * float(nr_of_bodies) ** 2 / seconds,
+                          'warm_up_seconds': warm_up, 'deviation': deviation,
+                          'tolerance': tolerance, 'agrees': agrees}
+                results.append(result)
+                last_step[name] = (nr_of_bodies, seconds / steps)
+                _print_result(result)
+    return results
+
+
+def _print_result(result):
+    deviation = result['deviation']
+    print('{:26s} {:7d} {:4d} {:12.3f} {:12.4g} {:>10s} {:>6s}'.format(
+        result['implementation'], result['nr_of_bodies'], result['threads'],
+        result['steps_per_s'], result['interactions_per_s'],
+        '-' if deviation is None else '{:.2e}'.format(deviation),
+        '-' if result['agrees'] is None else 'ok' if result['agrees'] else 'FAIL'))
+
+
+def _compare(results, baseline_file):
+    """
+    Print the change of steps/s against the runs of an earlier result file,
+    returns the number of regressions
+    """
+    with open(baseline_file) as f:
+        baseline = {(r['implementation'], r['nr_of_bodies'], r['threads']): r['steps_per_s']
+                    for r in json.load(f)['results'] if 'skipped' not in r}
+    regressions = 0
+    print('\nagainst', baseline_file)
+    for result in results:
+        key = (result['implementation'], result['nr_of_bodies'], result.get('threads'))
+        if 'skipped' in result or key not in baseline:
+            continue
+        ratio = result['steps_per_s'] / baseline[key]
+        regressions += ratio < _REGRESSION
+        print('{:26s} {:7d} {:4d} {:8.2f}x{}'.format(
+            *key, ratio, '  REGRESSION' if ratio < _REGRESSION else ''))
+    return regressions
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the step implementations against each other.')
+    parser.add_argument('--bodies', type=int, nargs='+',
+                        default=[10, 100, 1000, 10000, 100000])
+    parser.add_argument('--threads', type=int, nargs='+',
+                        default=sorted({1, cpu_count()}))
+    parser.add_argument('--min-seconds', type=float, default=0.5,
+                        help='time each run at least that long')
+    parser.add_argument('--max-steps', type=int, default=1000)
+    parser.add_argument('--max-step-seconds', type=float, default=5.0,
+                        help='skip implementations whose step gets slower')
+    parser.add_argument('--output', default='engine_benchmark.json')
+    parser.add_argument('--baseline', help='earlier result file to compare with')
+    return parser
+
+
+def _main(argv):
+    args = _parser().parse_args(argv[1:])
+    print('implementation            bodies threads  steps/s  interactions/s  deviation  check')
+    results = _run(args)
+    with open(args.output, 'w') as f:
+        json.dump({'date': datetime.datetime.now().isoformat(),
+                   'platform': platform.platform(),
+                   'python': platform.python_version(),
+                   'numpy': np.__version__,
+                   'cpu_count': cpu_count(),
+                   'arguments': vars(args),
+                   'results': results}, f, indent=1)
+    print('results written to', args.output)
+    failed = sum(1 for r in results if r.get('agrees') is False)
+    if args.baseline:
+        failed += _compare(results, args.baseline)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main(sys.argv))
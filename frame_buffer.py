@@ -0,0 +1,171 @@
+"""
+Shared-memory frame transport between simulation and renderer.
+
+The simulation writes every frame, an (N, 4) float64 array of positions
+and radii or a density grid, in place into one of several slots of a
+multiprocessing.shared_memory block. The renderer attaches to the same
+block and reads the newest complete frame without pickling. Only small
+control messages (the descriptor of the block, END_MESSAGE) still go
+through the pipe.
+
+Layout of the block (all int64 header fields, followed by the slots):
+    [0] number of frames published so far
+    [1] slot holding the newest frame
+    [2 + slot] sequence counter of each slot, odd while it is written
+
+A reader copies the newest slot and checks the slot's sequence counter
+before and after the copy (seqlock). If the writer touched the slot in
+between, the copy is retried, so readers never see torn frames and the
+writer never waits for a reader.
+"""
+from collections import namedtuple
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+# default number of slots, one being written, one being read, one spare
+DEFAULT_NR_OF_SLOTS = 3
+# frame data starts on its own cache line
+_DATA_OFFSET_ALIGN = 64
+# positions and radius
+DEFAULT_NR_OF_COLUMNS = 4
+
+# picklable description sent through the pipe to let the reader attach
+FrameBufferDescriptor = namedtuple('FrameBufferDescriptor',
+                                   ['name', 'nr_of_rows', 'nr_of_columns',
+                                    'nr_of_slots'])
+
+
+def _data_offset(nr_of_slots):
+    header_bytes = (2 + nr_of_slots) * np.dtype(np.int64).itemsize
+    return -(-header_bytes // _DATA_OFFSET_ALIGN) * _DATA_OFFSET_ALIGN
+
+
+class FrameBuffer:
+    """
+        Multi-buffered 2D float64 frames in shared memory with one writer
+        and any number of readers.
+    """
+    def __init__(self, memory, nr_of_rows, nr_of_columns, nr_of_slots, owner):
+        self.memory = memory
+        self.nr_of_rows = nr_of_rows
+        self.nr_of_columns = nr_of_columns
+        self.nr_of_slots = nr_of_slots
+        self.owner = owner
+        self.header = np.ndarray((2 + nr_of_slots,), dtype=np.int64,
+                                 buffer=memory.buf)
+        self.slots = np.ndarray((nr_of_slots, nr_of_rows, nr_of_columns),
+                                dtype=np.float64, buffer=memory.buf,
+                                offset=_data_offset(nr_of_slots))
+        self.last_read = 0
+
+    @classmethod
+    def create(cls, nr_of_rows, nr_of_columns=DEFAULT_NR_OF_COLUMNS,
+               nr_of_slots=DEFAULT_NR_OF_SLOTS):
+        """
+            Allocate a new shared block, used by the writer.
+
+            Args:
+                nr_of_rows (int): Rows per frame (number of bodies)
+                nr_of_columns (int): Columns per frame
+                nr_of_slots (int): Number of frame slots, at least 2
+        """
+        if nr_of_slots < 2:
+            raise ValueError('a frame buffer needs at least 2 slots')
+        size = (_data_offset(nr_of_slots)
+                + nr_of_slots * nr_of_rows * nr_of_columns
+                * np.dtype(np.float64).itemsize)
+        memory = shared_memory.SharedMemory(create=True, size=size)
+        frame_buffer = cls(memory, nr_of_rows, nr_of_columns, nr_of_slots,
+                           True)
+        frame_buffer.header[:] = 0
+        return frame_buffer
+
+    @classmethod
+    def attach(cls, descriptor):
+        """
+            Attach to the block described by a FrameBufferDescriptor,
+            used by readers.
+        """
+        memory = shared_memory.SharedMemory(name=descriptor.name)
+        # the writer owns the block, keep the reader's resource tracker
+        # from unlinking it when the reader exits
+        resource_tracker.unregister(memory._name, 'shared_memory')
+        return cls(memory, descriptor.nr_of_rows, descriptor.nr_of_columns,
+                   descriptor.nr_of_slots, False)
+
+    def descriptor(self):
+        """
+            Return the FrameBufferDescriptor to send to readers.
+        """
+        return FrameBufferDescriptor(self.memory.name, self.nr_of_rows,
+                                     self.nr_of_columns, self.nr_of_slots)
+
+    @property
+    def frame_count(self):
+        """
+            Number of frames published so far.
+        """
+        return int(self.header[0])
+
+    def begin_write(self):
+        """
+            Return the view of the next free slot. Fill it and call
+            end_write() to publish it.
+        """
+        slot = (int(self.header[1]) + 1) % self.nr_of_slots
+        # odd sequence number: slot is being written
+        self.header[2 + slot] += 1
+        return self.slots[slot]
+
+    def end_write(self):
+        """
+            Publish the slot filled since begin_write().
+        """
+        slot = (int(self.header[1]) + 1) % self.nr_of_slots
+        self.header[2 + slot] += 1
+        self.header[1] = slot
+        self.header[0] += 1
+
+    def write(self, frame):
+        """
+            Copy a complete frame into the buffer and publish it.
+        """
+        self.begin_write()[...] = frame
+        self.end_write()
+
+    def read(self, out):
+        """
+            Copy the newest frame into out if there is one that was not
+            read before.
+
+            Args:
+                out (numpy.ndarray): float64 target array of the frame shape
+            Returns:
+                Number of frames published up to the one read (frames
+                in between were skipped), 0 if there was no new frame.
+        """
+        while True:
+            count = int(self.header[0])
+            if count == self.last_read:
+                return 0
+            slot = int(self.header[1])
+            sequence = self.header[2 + slot]
+            if sequence % 2:
+                continue
+            out[...] = self.slots[slot]
+            if (self.header[2 + slot] == sequence
+                    and int(self.header[1]) == slot):
+                self.last_read = count
+                return count
+
+    def close(self):
+        """
+            Detach from the block, the writer also frees it.
+        """
+        # drop the views before closing the mapping
+        self.header = None
+        self.slots = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
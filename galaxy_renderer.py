@@ -19,36 +19,99 @@ OpenGL output for gravity simulation
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 # or open http://www.fsf.org/licensing/licenses/gpl.html
 #
+import math
 import sys
 import time
 try:
     from OpenGL import GLUT
     from OpenGL import GL
     from OpenGL import GLU
+    from OpenGL.GL import shaders
 except ImportError:
     print(' Error: Software not installed properly !!')
     sys.exit()
 
+import numpy as np
+
+import camera
+from frame_buffer import FrameBuffer, FrameBufferDescriptor
 from mouse_interactor import MouseInteractor
 from simulation_constants import END_MESSAGE
+from trajectory_replay import SEEK_STEP, TrajectoryReplay
 
 # initial window parameters
 _WINDOW_SIZE = (512, 512)
 _WINDOW_POSITION = (100, 100)
-_LIGHT_POSITION = (2, 2, 3)
-_CAMERA_POSITION = (0, 0, 2)
+
+# sphere tessellations (slices, stacks) and the smallest projected
+# diameter in pixels each one is used for
+_SPHERE_LEVELS = ((6, 4, 0), (10, 8, 6), (16, 16, 24), (32, 32, 96))
+# bodies with a smaller projected diameter in pixels are drawn as points
+_POINT_DIAMETER = 2.0
+
+# draw modes of GalaxyRenderer
+MODE_SPHERES = 'spheres'
+MODE_SPRITES = 'sprites'
+MODE_DENSITY = 'density'
+MODES = (MODE_SPHERES, MODE_SPRITES, MODE_DENSITY)
+
+# point sprites: size in pixels from the radius in w and the distance,
+# the fragment shader cuts out a lit disc that looks like a sphere
+_SPRITE_VERTEX_SHADER = '''
+#version 120
+uniform float pixels_per_unit;
+void main() {
+    vec4 eye = gl_ModelViewMatrix * vec4(gl_Vertex.xyz, 1.0);
+    gl_Position = gl_ProjectionMatrix * eye;
+    gl_PointSize = max(2.0 * gl_Vertex.w * pixels_per_unit / -eye.z, 1.0);
+}
+'''
+_SPRITE_FRAGMENT_SHADER = '''
+#version 120
+uniform vec3 light_direction;
+void main() {
+    vec2 disc = gl_PointCoord * 2.0 - 1.0;
+    float dist_sq = dot(disc, disc);
+    if (dist_sq > 1.0) {
+        discard;
+    }
+    vec3 normal = vec3(disc.x, -disc.y, sqrt(1.0 - dist_sq));
+    float diffuse = max(dot(normal, light_direction), 0.0);
+    gl_FragColor = vec4(vec3(%r + %r * diffuse), 1.0);
+}
+''' % (camera.AMBIENT, camera.DIFFUSE)
 
 
 class GalaxyRenderer:
     """
         Class containing OpenGL code
     """
-    def __init__(self, render_pipe, fps):
+    def __init__(self, render_pipe, fps, mode=MODE_SPHERES, replay=None):
+        if mode not in MODES:
+            raise ValueError('unknown render mode: {}'.format(mode))
+        if replay is not None and mode == MODE_DENSITY:
+            raise ValueError('recordings can not be replayed in density mode')
         self.render_pipe = render_pipe
         self.fps = fps
+        self.mode = mode
         self.bodies = None
+        self.frame_buffer = None
+        self.frame = None
+        self.next_render = 0
+        self.frame_pending = False
         self.do_exit = False
-        self.sphere = None
+        self.spheres = None
+        self.sprite_program = None
+        self.vertex_buffer = None
+        self.vertex_buffer_size = 0
+        self.density_texture = None
+        self.density_texture_size = 0
+        # replay of a recording instead of frames from the simulation
+        self.replay = replay
+        self.replay_clock = time.perf_counter()
+        self.replay_changed = True
+        if replay is not None:
+            self.frame = np.empty((replay.nr_of_bodies, 4))
         self.init_glut()
         self.init_gl()
         self.mouse_interactor = MouseInteractor(0.01, 1)
@@ -65,18 +128,43 @@ class GalaxyRenderer:
         GLUT.glutCreateWindow(str.encode("Galaxy Renderer"))
         GLUT.glutDisplayFunc(self.render)
         GLUT.glutIdleFunc(self.update_positions)
+        if self.replay is not None:
+            GLUT.glutKeyboardFunc(self.keyboard)
+            GLUT.glutSpecialFunc(self.special_key)
+
+    def keyboard(self, key, x_pos, y_pos):
+        """
+            Playback keys of the replay, see trajectory_replay
+        """
+        if self.replay.keyboard(key):
+            self.replay_changed = True
+
+    def special_key(self, key, x_pos, y_pos):
+        """
+            Arrow keys seek in the replay
+        """
+        if key == GLUT.GLUT_KEY_LEFT:
+            self.replay.seek_relative(-SEEK_STEP)
+        elif key == GLUT.GLUT_KEY_RIGHT:
+            self.replay.seek_relative(SEEK_STEP)
+        else:
+            return
+        self.replay_changed = True
 
     def init_gl(self):
         """
             Initialise OpenGL settings
         """
-        self.sphere = GL.glGenLists(1)
-        GL.glNewList(self.sphere, GL.GL_COMPILE)
+        first_list = GL.glGenLists(len(_SPHERE_LEVELS))
+        self.spheres = []
         quad_obj = GLU.gluNewQuadric()
         GLU.gluQuadricDrawStyle(quad_obj, GLU.GLU_FILL)
         GLU.gluQuadricNormals(quad_obj, GLU.GLU_SMOOTH)
-        GLU.gluSphere(quad_obj, 1, 16, 16)
-        GL.glEndList()
+        for level, (slices, stacks, _) in enumerate(_SPHERE_LEVELS):
+            self.spheres.append(first_list + level)
+            GL.glNewList(first_list + level, GL.GL_COMPILE)
+            GLU.gluSphere(quad_obj, 1, slices, stacks)
+            GL.glEndList()
         GL.glShadeModel(GL.GL_SMOOTH)
         GL.glEnable(GL.GL_DEPTH_TEST)
         GL.glEnable(GL.GL_CULL_FACE)
@@ -84,23 +172,61 @@ class GalaxyRenderer:
         # make sure normal vectors of scaled spheres are normalised
         GL.glEnable(GL.GL_NORMALIZE)
         GL.glEnable(GL.GL_LIGHT0)
-        light_pos = list(_LIGHT_POSITION) + [1]
+        light_pos = list(camera.LIGHT_POSITION) + [1]
         GL.glLightfv(GL.GL_LIGHT0, GL.GL_POSITION, light_pos)
         GL.glLightfv(GL.GL_LIGHT0, GL.GL_AMBIENT, [1.0, 1.0, 1.0, 1.0])
         GL.glLightfv(GL.GL_LIGHT0, GL.GL_DIFFUSE, [1.0, 1.0, 1.0, 1.0])
         GL.glLightfv(GL.GL_LIGHT0, GL.GL_SPECULAR, [1.0, 1.0, 1.0, 1.0])
-        GL.glMaterialfv(GL.GL_FRONT, GL.GL_AMBIENT, [0.2, .2, .2, 1])
-        GL.glMaterialfv(GL.GL_FRONT, GL.GL_DIFFUSE, [0.7, 0.7, 0.7, 1])
+        GL.glMaterialfv(GL.GL_FRONT, GL.GL_AMBIENT, [camera.AMBIENT] * 3 + [1])
+        GL.glMaterialfv(GL.GL_FRONT, GL.GL_DIFFUSE, [camera.DIFFUSE] * 3 + [1])
         GL.glMaterialfv(GL.GL_FRONT, GL.GL_SPECULAR, [0.1, 0.1, 0.1, 1])
         GL.glMaterialf(GL.GL_FRONT, GL.GL_SHININESS, 20)
         GL.glMatrixMode(GL.GL_PROJECTION)
         GL.glLoadIdentity()
-        GLU.gluPerspective(60, 1, .01, 10)
+        GLU.gluPerspective(camera.FIELD_OF_VIEW, 1, .01, camera.FAR)
         GL.glMatrixMode(GL.GL_MODELVIEW)
+        if self.mode == MODE_SPRITES:
+            self.init_sprites()
+        elif self.mode == MODE_DENSITY:
+            self.density_texture = GL.glGenTextures(1)
+            GL.glBindTexture(GL.GL_TEXTURE_2D, self.density_texture)
+            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER,
+                               GL.GL_LINEAR)
+            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER,
+                               GL.GL_LINEAR)
+            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_S,
+                               GL.GL_CLAMP_TO_EDGE)
+            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_T,
+                               GL.GL_CLAMP_TO_EDGE)
+            GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+
+    def init_sprites(self):
+        """
+            Compile the point sprite shaders and create the vertex buffer,
+            fall back to spheres if the driver lacks GLSL 1.20.
+        """
+        try:
+            self.sprite_program = shaders.compileProgram(
+                shaders.compileShader(_SPRITE_VERTEX_SHADER,
+                                      GL.GL_VERTEX_SHADER),
+                shaders.compileShader(_SPRITE_FRAGMENT_SHADER,
+                                      GL.GL_FRAGMENT_SHADER))
+        except (GL.GLError, RuntimeError) as error:
+            print('point sprites not supported, drawing spheres:', error)
+            self.mode = MODE_SPHERES
+            return
+        self.vertex_buffer = GL.glGenBuffers(1)
+        GL.glEnable(GL.GL_VERTEX_PROGRAM_POINT_SIZE)
+        GL.glEnable(GL.GL_POINT_SPRITE)
+        light = camera.light_direction()
+        GL.glUseProgram(self.sprite_program)
+        GL.glUniform3f(GL.glGetUniformLocation(self.sprite_program,
+                                               'light_direction'), *light)
+        GL.glUseProgram(0)
 
     def render(self):
         """
-            Render the scene using the sphere display list
+            Render the scene with the current draw mode
         """
         if self.do_exit:
             print('renderer exiting ...')
@@ -114,22 +240,152 @@ class GalaxyRenderer:
         GL.glLoadIdentity()
         x_size = GLUT.glutGet(GLUT.GLUT_WINDOW_WIDTH)
         y_size = GLUT.glutGet(GLUT.GLUT_WINDOW_HEIGHT)
-        GLU.gluPerspective(60, float(x_size) / float(y_size), 0.05, 10)
+        GLU.gluPerspective(camera.FIELD_OF_VIEW, float(x_size) / float(y_size),
+                           camera.NEAR, camera.FAR)
         GL.glMatrixMode(GL.GL_MODELVIEW)
         GL.glLoadIdentity()
-        GL.glTranslatef(-_CAMERA_POSITION[0],
-                        -_CAMERA_POSITION[1],
-                        -_CAMERA_POSITION[2])
+        GL.glTranslatef(-camera.CAMERA_POSITION[0],
+                        -camera.CAMERA_POSITION[1],
+                        -camera.CAMERA_POSITION[2])
         self.mouse_interactor.apply_transformation()
-        for body_index in range(self.bodies.shape[0]):
-            body = self.bodies[body_index, :]
-            GL.glPushMatrix()
-            GL.glTranslatef(body[0], body[1], body[2])
-            GL.glScalef(body[3], body[3], body[3])
-            GL.glCallList(self.sphere)
-            GL.glPopMatrix()
+        if self.mode == MODE_SPRITES:
+            self.draw_sprites(y_size)
+        elif self.mode == MODE_DENSITY:
+            self.draw_density()
+        else:
+            self.draw_spheres(y_size)
         GLUT.glutSwapBuffers()
 
+    def select_detail(self, y_size):
+        """
+            Cull the bodies against the view frustum and choose a sphere
+            tessellation for the visible ones from their projected
+            diameter, vectorised over all bodies with the current
+            modelview and projection matrices
+
+            Args:
+                y_size (int): Window height in pixels
+            Returns:
+                Indices of the bodies to draw as points and a list with
+                the indices of the bodies for every entry of _SPHERE_LEVELS
+        """
+        # OpenGL returns column-major matrices
+        modelview = np.array(GL.glGetDoublev(GL.GL_MODELVIEW_MATRIX)).reshape(4, 4).T
+        projection = np.array(GL.glGetDoublev(GL.GL_PROJECTION_MATRIX)).reshape(4, 4).T
+        clip = projection @ modelview
+        # frustum planes (Gribb/Hartmann), normalised to get distances
+        planes = np.array([clip[3] + clip[0], clip[3] - clip[0],
+                           clip[3] + clip[1], clip[3] - clip[1],
+                           clip[3] + clip[2], clip[3] - clip[2]])
+        planes /= np.linalg.norm(planes[:, :3], axis=1)[:, None]
+        positions = self.bodies[:, :3]
+        radius = self.bodies[:, 3]
+        distances = positions @ planes[:, :3].T + planes[:, 3]
+        visible = np.flatnonzero((distances > -radius[:, None]).all(axis=1))
+
+        depth = -(positions[visible] @ modelview[2, :3] + modelview[2, 3])
+        diameter = (2 * radius[visible] * camera.pixels_per_unit(y_size)
+                    / np.maximum(depth, 1e-9))
+        points = diameter < _POINT_DIAMETER
+        levels = np.searchsorted([level[2] for level in _SPHERE_LEVELS],
+                                 diameter, side='right') - 1
+        return visible[points], [visible[~points & (levels == level)]
+                                 for level in range(len(_SPHERE_LEVELS))]
+
+    def draw_spheres(self, y_size):
+        """
+            Draw the visible bodies as scaled copies of the sphere display
+            list matching their size on screen, sub-pixel bodies as one
+            batch of points
+
+            Args:
+                y_size (int): Window height in pixels
+        """
+        points, levels = self.select_detail(y_size)
+        if points.size:
+            GL.glDisable(GL.GL_LIGHTING)
+            GL.glColor3f(0.6, 0.6, 0.6)
+            GL.glEnableClientState(GL.GL_VERTEX_ARRAY)
+            GL.glVertexPointer(3, GL.GL_DOUBLE, 0,
+                               np.ascontiguousarray(self.bodies[points, :3]))
+            GL.glDrawArrays(GL.GL_POINTS, 0, points.size)
+            GL.glDisableClientState(GL.GL_VERTEX_ARRAY)
+            GL.glEnable(GL.GL_LIGHTING)
+        for sphere, indices in zip(self.spheres, levels):
+            for body in self.bodies[indices]:
+                GL.glPushMatrix()
+                GL.glTranslatef(body[0], body[1], body[2])
+                GL.glScalef(body[3], body[3], body[3])
+                GL.glCallList(sphere)
+                GL.glPopMatrix()
+
+    def draw_density(self):
+        """
+            Show the (G, G) mass grid sent by the simulation as texture on
+            a quad in the x-y plane, logarithmic brightness
+        """
+        grid = self.bodies
+        occupied = grid[grid > 0]
+        if occupied.size:
+            image = np.log1p(grid / occupied.mean())
+            image /= image.max()
+        else:
+            image = np.zeros_like(grid)
+        image = np.ascontiguousarray(image, dtype=np.float32)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, self.density_texture)
+        GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 1)
+        if image.shape[0] != self.density_texture_size:
+            GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_LUMINANCE,
+                            image.shape[1], image.shape[0], 0,
+                            GL.GL_LUMINANCE, GL.GL_FLOAT, image)
+            self.density_texture_size = image.shape[0]
+        else:
+            GL.glTexSubImage2D(GL.GL_TEXTURE_2D, 0, 0, 0,
+                               image.shape[1], image.shape[0],
+                               GL.GL_LUMINANCE, GL.GL_FLOAT, image)
+        GL.glDisable(GL.GL_LIGHTING)
+        GL.glDisable(GL.GL_CULL_FACE)
+        GL.glEnable(GL.GL_TEXTURE_2D)
+        GL.glColor3f(1, 1, 1)
+        # the grid covers -1 to 1 in renderer coordinates, row 0 at y = -1
+        GL.glBegin(GL.GL_QUADS)
+        for tex_x, tex_y in ((0, 0), (1, 0), (1, 1), (0, 1)):
+            GL.glTexCoord2f(tex_x, tex_y)
+            GL.glVertex3f(2 * tex_x - 1, 2 * tex_y - 1, 0)
+        GL.glEnd()
+        GL.glDisable(GL.GL_TEXTURE_2D)
+        GL.glEnable(GL.GL_CULL_FACE)
+        GL.glEnable(GL.GL_LIGHTING)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+
+    def draw_sprites(self, y_size):
+        """
+            Upload the frame as one vertex buffer, radius in w, and draw
+            all bodies with a single glDrawArrays call of point sprites
+
+            Args:
+                y_size (int): Window height in pixels
+        """
+        vertices = np.ascontiguousarray(self.bodies, dtype=np.float32)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.vertex_buffer)
+        if vertices.nbytes != self.vertex_buffer_size:
+            GL.glBufferData(GL.GL_ARRAY_BUFFER, vertices.nbytes, vertices,
+                            GL.GL_STREAM_DRAW)
+            self.vertex_buffer_size = vertices.nbytes
+        else:
+            GL.glBufferSubData(GL.GL_ARRAY_BUFFER, 0, vertices.nbytes,
+                               vertices)
+        GL.glUseProgram(self.sprite_program)
+        GL.glUniform1f(GL.glGetUniformLocation(self.sprite_program,
+                                               'pixels_per_unit'),
+                       camera.pixels_per_unit(y_size))
+        GL.glEnableClientState(GL.GL_VERTEX_ARRAY)
+        GL.glVertexPointer(4, GL.GL_FLOAT, 0, None)
+        GL.glDrawArrays(GL.GL_POINTS, 0, vertices.shape[0])
+        GL.glDisableClientState(GL.GL_VERTEX_ARRAY)
+        GL.glUseProgram(0)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
+
     @staticmethod
     def start():
         """
@@ -139,29 +395,74 @@ class GalaxyRenderer:
 
     def update_positions(self):
         """
-            Read new object positions from pipe.
+            Read new object positions from the shared frame buffer, or
+            from the pipe if the simulation sends frames through it.
+
+            Latest frame wins: all queued pipe messages are drained and
+            only the newest frame is kept. A redraw is requested at most
+            fps times per second, in between the idle callback sleeps.
+            A replay computes the frame for the current playback position
+            instead.
         """
-        if self.render_pipe.poll():
+        while self.render_pipe is not None and self.render_pipe.poll():
             pipe_input = self.render_pipe.recv()
             if isinstance(pipe_input, str) and pipe_input == END_MESSAGE:
                 self.do_exit = True
+                if self.frame_buffer is not None:
+                    self.frame_buffer.close()
+                    self.frame_buffer = None
+                GLUT.glutPostRedisplay()
+                return
+            elif isinstance(pipe_input, FrameBufferDescriptor):
+                self.frame_buffer = FrameBuffer.attach(pipe_input)
+                # frames are copied into this array, no allocation per frame
+                self.frame = np.empty((pipe_input.nr_of_rows,
+                                       pipe_input.nr_of_columns))
             else:
                 self.bodies = pipe_input
-                GLUT.glutPostRedisplay()
+                self.frame_pending = True
+        if self.frame_buffer is not None and self.frame_buffer.read(self.frame):
+            self.bodies = self.frame
+            self.frame_pending = True
+
+        now = time.perf_counter()
+        if self.replay is not None and now >= self.next_render:
+            self.replay.advance(now - self.replay_clock)
+            self.replay_clock = now
+            if not self.replay.paused or self.replay_changed:
+                self.bodies = self.replay.frame(self.frame)
+                self.frame_pending = True
+                self.replay_changed = False
+        if self.frame_pending and now >= self.next_render:
+            self.next_render = now + 1/self.fps
+            self.frame_pending = False
+            GLUT.glutPostRedisplay()
         else:
-            time.sleep(1/self.fps)
+            time.sleep(min(1/self.fps, max(self.next_render - now, 0.001)))
 
 
-def startup(render_pipe, fps):
+def startup(render_pipe, fps, mode=MODE_SPHERES, replay=None,
+            replay_extent=None):
     """
         Create GalaxyRenderer instance and start rendering
 
         Args:
             render_pipe (multiprocessing.Pipe): Pipe to read positions from
             fps (float): Number of frames per second
+            mode (str): One of MODES, 'spheres' draws a lit sphere per
+                body, 'sprites' all bodies in one call as point sprites,
+                'density' shows the mass grid the simulation publishes
+                with density_grid > 0
+            replay (str): Play this trajectory_recorder or
+                trajectory_archive file instead of reading frames from
+                render_pipe, which may then be None
+            replay_extent (float): Distance shown as 1 in the replay,
+                dis_lim[1] of the recorded run
     """
+    if replay is not None:
+        replay = TrajectoryReplay(replay, replay_extent)
     print('creating renderer')
-    galaxy_renderer = GalaxyRenderer(render_pipe, fps)
+    galaxy_renderer = GalaxyRenderer(render_pipe, fps, mode, replay)
     print('starting renderer')
     galaxy_renderer.start()
     print('done')
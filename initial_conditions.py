@@ -0,0 +1,245 @@
+"""
+Initial bodies of a run, generated with NumPy in O(N).
+
+Every body gets the circular speed around the mass focus of all other
+bodies, like the original initialisation. The mass focus excluding a body
+is the total mass moment minus the body's own, so no body has to loop
+over all others. Positions, masses and radii are drawn in batches from a
+numpy.random.Generator, a seed gives the same bodies on every machine.
+
+Profiles (simulation_constants.PROFILES):
+    uniform             |x| between dis_lim[0] and dis_lim[1], y within the
+                        dis_lim[1] circle and |z| up to dis_lim[2], the
+                        original distribution
+    exponential_disk    surface density falling off with exp(-R / R_d),
+                        R_d = DISK_SCALE_LENGTH * dis_lim[1], exponential in
+                        z with DISK_SCALE_HEIGHT * dis_lim[2]
+    plummer             Plummer sphere with scale radius
+                        PLUMMER_SCALE * dis_lim[1], the orbits are oriented
+                        randomly
+    collision           two exponential disks of half the size, each around
+                        its own black hole of black_weight. The first one
+                        sits at the centre like the other profiles (the
+                        black hole at index 0 does not move), the second one
+                        starts dis_lim[1] away, inclined by
+                        COLLISION_INCLINATION degrees, and falls into it
+
+The exponential_disk, plummer and collision profiles cut the distance
+from the black hole to dis_lim[0] to dis_lim[1] (half of both for the
+disks of the collision) by drawing again, and |z| of the disks to
+dis_lim[2]. The uniform profile draws within its limits directly.
+"""
+import math
+
+import numpy as np
+
+import simulation_constants as sc
+
+DISK_SCALE_LENGTH = 0.25
+DISK_SCALE_HEIGHT = 0.25
+PLUMMER_SCALE = 0.25
+COLLISION_INCLINATION = 45
+# offset in y of the second galaxy as fraction of its distance in x
+COLLISION_IMPACT = 0.5
+# speed of the second galaxy as fraction of the escape speed
+COLLISION_SPEED = 0.5
+# bodies drawn and given a speed at once, bounds the temporary arrays
+_BATCH_SIZE = 1 << 16
+
+
+def _random_sign(rng, n):
+    return np.where(rng.random(n) >= 0.5, 1.0, -1.0)
+
+
+def _truncated(draw, n, low, high):
+    """
+        n values of draw(count) within [low, high], values outside are
+        drawn again.
+    """
+    values = draw(n)
+    outside = np.flatnonzero((values < low) | (values > high))
+    while outside.size:
+        values[outside] = draw(outside.size)
+        outside = outside[(values[outside] < low) | (values[outside] > high)]
+    return values
+
+
+def _uniform(rng, n, dis_lim, rad_lim):
+    min_distance, max_distance, max_z = dis_lim
+    positions = np.empty((n, 3))
+    positions[:, 0] = rng.uniform(min_distance, max_distance, n) * _random_sign(rng, n)
+    # y within the max_distance circle, as the original initialisation
+    positions[:, 1] = ((rng.random(n) * np.sqrt(max_distance**2 - positions[:, 0]**2)
+                        + rad_lim[0]) * _random_sign(rng, n))
+    positions[:, 2] = rng.random(n) * max_z * _random_sign(rng, n)
+    return positions
+
+
+def _exponential_disk(rng, n, dis_lim, rad_lim):
+    min_distance, max_distance, max_z = dis_lim
+    # R exp(-R / R_d) is the gamma distribution of shape 2
+    distance = _truncated(lambda k: rng.gamma(2.0, DISK_SCALE_LENGTH * max_distance, k),
+                          n, min_distance, max_distance)
+    angle = rng.uniform(0, 2 * np.pi, n)
+    positions = np.empty((n, 3))
+    positions[:, 0] = distance * np.cos(angle)
+    positions[:, 1] = distance * np.sin(angle)
+    positions[:, 2] = _truncated(lambda k: rng.laplace(0, DISK_SCALE_HEIGHT * max_z, k),
+                                 n, -max_z, max_z)
+    return positions
+
+
+def _plummer(rng, n, dis_lim, rad_lim):
+    min_distance, max_distance = dis_lim[0], dis_lim[1]
+    scale = PLUMMER_SCALE * max_distance
+    # inverse of the enclosed mass fraction (r^3 / (r^2 + a^2)^1.5)
+    distance = _truncated(lambda k: scale / np.sqrt(rng.random(k) ** (-2 / 3) - 1),
+                          n, min_distance, max_distance)
+    return distance[:, None] * _random_directions(rng, n)
+
+
+def _random_directions(rng, n):
+    """
+        (n, 3) unit vectors uniform on the sphere.
+    """
+    cos_theta = rng.uniform(-1, 1, n)
+    sin_theta = np.sqrt(1 - cos_theta**2)
+    angle = rng.uniform(0, 2 * np.pi, n)
+    return np.column_stack((sin_theta * np.cos(angle), sin_theta * np.sin(angle), cos_theta))
+
+
+_SAMPLERS = {
+    sc.PROFILE_UNIFORM: _uniform,
+    sc.PROFILE_EXPONENTIAL_DISK: _exponential_disk,
+    sc.PROFILE_PLUMMER: _plummer,
+}
+
+
+def orbital_speed(positions, mass, axes=None, out=None):
+    """
+        Circular speed of every body around the mass focus of all other
+        bodies, in O(N).
+
+        Args:
+            positions (numpy.ndarray): (N, 3) positions
+            mass (numpy.ndarray): (N,) masses
+            axes (numpy.ndarray): (3,) or (N, 3) axes the orbits turn
+                around (in negative sense, as the original
+                initialisation), default z
+            out (numpy.ndarray): (N, 3) array for the speeds
+        Returns:
+            (N, 3) speeds
+    """
+    positions, mass = np.asarray(positions), np.asarray(mass)
+    if out is None:
+        out = np.empty_like(positions)
+    if axes is None:
+        axes = np.array([0.0, 0.0, 1.0])
+    axes = np.asarray(axes, dtype=np.float64)
+    total_mass = mass.sum()
+    moment = mass @ positions
+    for start in range(0, len(mass), _BATCH_SIZE):
+        batch = slice(start, start + _BATCH_SIZE)
+        # MASS FOCUS WITHOUT THE BODY ITSELF
+        others = total_mass - mass[batch]
+        focus = (moment - mass[batch, None] * positions[batch]) / others[:, None]
+        delta = positions[batch] - focus
+        distance = np.sqrt(np.einsum('ij,ij->i', delta, delta))
+        abs_speed = others / total_mass * np.sqrt(sc.G_CONSTANT * total_mass / distance)
+
+        # DIRECTION, ORBITS AROUND THE AXIS
+        direction = np.cross(delta, axes[batch] if axes.ndim == 2 else axes)
+        length = np.sqrt(np.einsum('ij,ij->i', direction, direction))
+        parallel = length == 0
+        if parallel.any():
+            direction[parallel] = np.cross(delta[parallel], [1.0, 0.0, 0.0])
+            length[parallel] = np.sqrt(np.einsum('ij,ij->i', direction[parallel],
+                                                 direction[parallel]))
+        out[batch] = direction * (abs_speed / length)[:, None]
+    return out
+
+
+def _galaxy(rng, sampler, nr_of_bodies, mass_lim, dis_lim, rad_lim, black_weight):
+    """
+        Black hole at index 0 and nr_of_bodies bodies around it.
+    """
+    positions = np.zeros((nr_of_bodies + 1, 3))
+    speed = np.zeros((nr_of_bodies + 1, 3))
+    radius = np.empty(nr_of_bodies + 1)
+    mass = np.empty(nr_of_bodies + 1)
+    mass[0] = black_weight
+    radius[0] = rad_lim[1]
+    axes = None if sampler is not _plummer else np.empty((nr_of_bodies + 1, 3))
+    for start in range(1, nr_of_bodies + 1, _BATCH_SIZE):
+        batch = slice(start, min(start + _BATCH_SIZE, nr_of_bodies + 1))
+        count = batch.stop - start
+        positions[batch] = sampler(rng, count, dis_lim, rad_lim)
+        mass[batch] = rng.uniform(mass_lim[0], mass_lim[1], count)
+        radius[batch] = rng.uniform(rad_lim[0], rad_lim[1], count)
+        if axes is not None:
+            axes[batch] = _random_directions(rng, count)
+    if axes is not None:
+        axes[0] = (0, 0, 1)
+    # the mass focus of the others includes the black hole, which rests
+    if nr_of_bodies:
+        orbital_speed(positions, mass, axes, speed)
+        speed[0] = 0
+    return positions, speed, radius, mass
+
+
+def _rotation_x(degrees):
+    c, s = math.cos(math.radians(degrees)), math.sin(math.radians(degrees))
+    return np.array([[1, 0, 0], [0, c, -s], [0, s, c]])
+
+
+def _collision(rng, nr_of_bodies, mass_lim, dis_lim, rad_lim, black_weight):
+    """
+        Two disks, the black hole of the second one replaces a body so the
+        number of bodies stays nr_of_bodies + 1.
+    """
+    if nr_of_bodies < 2:
+        raise ValueError('the collision profile needs at least 2 bodies')
+    half_lim = tuple(limit / 2 for limit in dis_lim)
+    first = _galaxy(rng, _exponential_disk, nr_of_bodies // 2, mass_lim,
+                    half_lim, rad_lim, black_weight)
+    second = _galaxy(rng, _exponential_disk, nr_of_bodies - nr_of_bodies // 2 - 1,
+                     mass_lim, half_lim, rad_lim, black_weight)
+    rotation = _rotation_x(COLLISION_INCLINATION)
+    second[0][:] = second[0] @ rotation.T
+    second[1][:] = second[1] @ rotation.T
+
+    # SECOND GALAXY ON A BOUND ORBIT TOWARDS THE FIRST
+    offset = np.array([dis_lim[1], COLLISION_IMPACT * dis_lim[1], 0])
+    escape_speed = math.sqrt(2 * sc.G_CONSTANT * (first[3].sum() + second[3].sum())
+                             / np.linalg.norm(offset))
+    second[0][:] += offset
+    second[1][:, 0] -= COLLISION_SPEED * escape_speed
+    return tuple(np.concatenate(arrays) for arrays in zip(first, second))
+
+
+def initialise_bodies(nr_of_bodies, mass_lim, dis_lim, rad_lim, black_weight,
+                      profile=sc.PROFILE_UNIFORM, seed=None):
+    """
+        Generate the bodies of a run.
+
+        Args:
+            nr_of_bodies (int): Bodies besides the black hole at index 0
+            mass_lim (tuple): Smallest and largest mass
+            dis_lim (tuple): Smallest and largest distance from the centre,
+                largest |z|
+            rad_lim (tuple): Smallest and largest radius, the black hole
+                gets the largest
+            black_weight (float): Mass of the black hole
+            profile (str): One of simulation_constants.PROFILES
+            seed: Seed of numpy.random.default_rng, None for fresh entropy
+        Returns:
+            (positions, speed, radius, mass) float64 arrays of
+            nr_of_bodies + 1 bodies
+    """
+    rng = np.random.default_rng(seed)
+    if profile == sc.PROFILE_COLLISION:
+        return _collision(rng, nr_of_bodies, mass_lim, dis_lim, rad_lim, black_weight)
+    if profile not in _SAMPLERS:
+        raise ValueError('unknown profile: {}'.format(profile))
+    return _galaxy(rng, _SAMPLERS[profile], nr_of_bodies, mass_lim, dis_lim, rad_lim,
+                   black_weight)
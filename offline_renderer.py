@@ -0,0 +1,254 @@
+"""
+Render a recorded run to a PNG sequence without OpenGL or a display.
+
+How to use:
+    python offline_renderer.py recording output_dir [options]
+    python offline_renderer.py --help
+
+The frames are sampled from the recording like the replay of
+trajectory_replay does (Hermite interpolation between recorded frames),
+seen through the same camera module as GalaxyRenderer, after the
+translation and rotation MouseInteractor would have applied.
+Every body is splatted as a lit disc the size the point sprite shader
+gives it. All disc fragments of a frame are generated with NumPy and the
+nearest fragment of each pixel wins (z-test), so there is no loop over
+the bodies. Frame ranges are rendered by a process pool, every process
+opens the recording itself (memory-mapped) and writes its PNGs
+(encoded with zlib and struct) directly.
+
+A video can then be made with e.g.
+    ffmpeg -framerate 60 -i output_dir/frame_%06d.png video.mp4
+"""
+import argparse
+import math
+import os
+import struct
+import sys
+import time
+import zlib
+from multiprocessing import cpu_count, Pool
+
+import numpy as np
+
+import camera
+from trajectory_replay import DEFAULT_STEPS_PER_SECOND, TrajectoryReplay
+
+# frames rendered by one task of the pool
+_FRAMES_PER_TASK = 16
+
+
+def _rotation(angle, x, y, z):
+    """
+        4x4 matrix of glRotatef(angle, x, y, z).
+    """
+    axis = np.array([x, y, z], dtype=np.float64)
+    axis /= np.linalg.norm(axis)
+    c, s = math.cos(math.radians(angle)), math.sin(math.radians(angle))
+    cross = np.array([[0, -axis[2], axis[1]],
+                      [axis[2], 0, -axis[0]],
+                      [-axis[1], axis[0], 0]])
+    matrix = np.eye(4)
+    matrix[:3, :3] = c * np.eye(3) + s * cross + (1 - c) * np.outer(axis, axis)
+    return matrix
+
+
+def _translation(x, y, z):
+    matrix = np.eye(4)
+    matrix[:3, 3] = (x, y, z)
+    return matrix
+
+
+def camera_matrices(width, height, translation=(0, 0, 0), rotation=(0, 0),
+                    position=camera.CAMERA_POSITION, field_of_view=camera.FIELD_OF_VIEW):
+    """
+        Modelview and projection matrix of GalaxyRenderer.render.
+
+        Args:
+            width, height (int): Image size in pixels
+            translation (tuple): Translation of MouseInteractor
+            rotation (tuple): Degrees about the y and then the x axis, as
+                MouseInteractor adds them for a left button drag
+            position (tuple): Camera position
+            field_of_view (float): Vertical field of view in degrees
+        Returns:
+            (modelview, projection) 4x4 arrays for column vectors
+    """
+    modelview = (_translation(*(-c for c in position)) @ _translation(*translation)
+                 @ _rotation(rotation[1], 1, 0, 0) @ _rotation(rotation[0], 0, 1, 0))
+    f = 1 / math.tan(math.radians(field_of_view) / 2)
+    projection = np.array([[f * height / width, 0, 0, 0],
+                           [0, f, 0, 0],
+                           [0, 0, (camera.FAR + camera.NEAR) / (camera.NEAR - camera.FAR),
+                            2 * camera.FAR * camera.NEAR / (camera.NEAR - camera.FAR)],
+                           [0, 0, -1, 0]])
+    return modelview, projection
+
+
+def render_frame(frame, modelview, projection, width, height):
+    """
+        Rasterise the bodies of a renderer frame.
+
+        Args:
+            frame (numpy.ndarray): (N, 4) positions and radii in renderer units
+            modelview, projection: Matrices from camera_matrices
+            width, height (int): Image size in pixels
+        Returns:
+            (height, width) uint8 grey image
+    """
+    eye = frame[:, :3] @ modelview[:3, :3].T + modelview[:3, 3]
+    depth = -eye[:, 2]
+    clip = eye @ projection[:3, :3].T + projection[:3, 3]
+    visible = (depth > camera.NEAR) & (depth < camera.FAR)
+    depth, clip, radius = depth[visible], clip[visible], frame[visible, 3]
+    # the clip w of the perspective projection is the depth
+    x = (clip[:, 0] / depth + 1) * width / 2
+    y = (1 - clip[:, 1] / depth) * height / 2
+    # point sprite size of the shader, at least one pixel
+    pixels_per_unit = height * projection[1, 1] / 2
+    pixel_radius = np.maximum(radius * pixels_per_unit / depth, 0.5)
+    on_screen = ((x + pixel_radius >= 0) & (x - pixel_radius < width)
+                 & (y + pixel_radius >= 0) & (y - pixel_radius < height))
+    x, y, depth, pixel_radius = (x[on_screen], y[on_screen], depth[on_screen],
+                                 pixel_radius[on_screen])
+
+    light = camera.light_direction()
+    pixels, depths, shades = [], [], []
+    # same stencil for all bodies of about the same size
+    extents = np.ceil(pixel_radius).astype(np.int64)
+    for extent in np.unique(extents):
+        bodies = extents == extent
+        offsets = np.arange(-extent, extent + 1)
+        dx, dy = [a.ravel() for a in np.meshgrid(offsets, offsets)]
+        centre_x = np.floor(x[bodies]).astype(np.int64)
+        centre_y = np.floor(y[bodies]).astype(np.int64)
+        # disc coordinates of the pixel centres, -1 to 1 over the radius
+        disc_x = (centre_x[:, None] + dx + 0.5 - x[bodies, None]) / pixel_radius[bodies, None]
+        disc_y = (centre_y[:, None] + dy + 0.5 - y[bodies, None]) / pixel_radius[bodies, None]
+        dist_sq = disc_x ** 2 + disc_y ** 2
+        px = centre_x[:, None] + dx
+        py = centre_y[:, None] + dy
+        inside = ((dist_sq <= 1) | (pixel_radius[bodies, None] <= 0.5)) \
+            & (px >= 0) & (px < width) & (py >= 0) & (py < height)
+        # lit like the fragment shader, y of the image points down
+        normal_z = np.sqrt(np.maximum(1 - dist_sq[inside], 0))
+        diffuse = np.maximum(disc_x[inside] * light[0] - disc_y[inside] * light[1]
+                             + normal_z * light[2], 0)
+        pixels.append(py[inside] * width + px[inside])
+        depths.append(np.broadcast_to(depth[bodies, None], inside.shape)[inside])
+        shades.append(camera.AMBIENT + camera.DIFFUSE * diffuse)
+
+    image = np.zeros(width * height, dtype=np.uint8)
+    if pixels:
+        pixels, depths, shades = (np.concatenate(pixels), np.concatenate(depths),
+                                  np.concatenate(shades))
+        # Z-TEST: nearest fragment of every pixel
+        fragments = np.lexsort((depths, pixels))
+        first = np.unique(pixels[fragments], return_index=True)[1]
+        nearest = fragments[first]
+        image[pixels[nearest]] = np.rint(255 * np.minimum(shades[nearest], 1))
+    return image.reshape(height, width)
+
+
+def write_png(path, image):
+    """
+        Write a (height, width) uint8 grey image as PNG.
+    """
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data
+                + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    height, width = image.shape
+    # filter type 0 in front of every row
+    rows = np.zeros((height, width + 1), dtype=np.uint8)
+    rows[:, 1:] = image
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(rows.tobytes(), 6)))
+        f.write(chunk(b'IEND', b''))
+
+
+def _frame_times(replay, fps):
+    """
+        Simulated times of the output frames, rate 1 of the replay.
+    """
+    duration = (replay.end_time - replay.start_time) / replay.base_rate
+    return replay.start_time + np.arange(int(duration * fps) + 1) * replay.base_rate / fps
+
+
+def _render_range(task):
+    (path, output_dir, first, last, width, height, fps, extent,
+     steps_per_second, view) = task
+    replay = TrajectoryReplay(path, extent, steps_per_second)
+    modelview, projection = camera_matrices(width, height, **view)
+    times = _frame_times(replay, fps)
+    frame = np.empty((replay.nr_of_bodies, 4))
+    for index in range(first, last):
+        replay.seek(times[index])
+        image = render_frame(replay.frame(frame), modelview, projection, width, height)
+        write_png(os.path.join(output_dir, 'frame_{:06d}.png'.format(index)), image)
+    return last - first
+
+
+def render(path, output_dir, width=512, height=512, fps=60, extent=None,
+           steps_per_second=DEFAULT_STEPS_PER_SECOND, nr_of_processes=0, **view):
+    """
+        Render a recording to output_dir/frame_000000.png, ...
+
+        Args:
+            path (str): trajectory_recorder or trajectory_archive file
+            output_dir (str): Directory for the PNGs, created if missing
+            width, height (int): Image size
+            fps (float): Frames per second of the video
+            extent (float): Distance shown as 1, see TrajectoryReplay
+            steps_per_second (float): Simulation steps per video second
+            nr_of_processes (int): Processes rendering, 0 = one per core
+            view: Arguments of camera_matrices
+        Returns:
+            Number of frames written.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    nr_of_frames = len(_frame_times(TrajectoryReplay(path, extent, steps_per_second), fps))
+    tasks = [(path, output_dir, first, min(first + _FRAMES_PER_TASK, nr_of_frames),
+              width, height, fps, extent, steps_per_second, view)
+             for first in range(0, nr_of_frames, _FRAMES_PER_TASK)]
+    with Pool(nr_of_processes or cpu_count()) as pool:
+        return sum(pool.imap_unordered(_render_range, tasks))
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        description='Render a recorded run to PNG images without OpenGL.')
+    parser.add_argument('recording')
+    parser.add_argument('output_dir')
+    parser.add_argument('--size', type=int, nargs=2, default=(512, 512),
+                        metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--fps', type=float, default=60)
+    parser.add_argument('--steps-per-second', type=float,
+                        default=DEFAULT_STEPS_PER_SECOND,
+                        help='simulation steps per second of video')
+    parser.add_argument('--extent', type=float,
+                        help='distance shown as 1, dis_lim[1] of the run')
+    parser.add_argument('--camera', type=float, nargs=3, default=camera.CAMERA_POSITION)
+    parser.add_argument('--field-of-view', type=float, default=camera.FIELD_OF_VIEW)
+    parser.add_argument('--translation', type=float, nargs=3, default=(0, 0, 0))
+    parser.add_argument('--rotation', type=float, nargs=2, default=(0, 0),
+                        metavar=('Y_DEGREES', 'X_DEGREES'))
+    parser.add_argument('--processes', type=int, default=0)
+    return parser
+
+
+def _main(argv):
+    args = _parser().parse_args(argv[1:])
+    start = time.perf_counter()
+    frames = render(args.recording, args.output_dir, args.size[0], args.size[1],
+                    args.fps, args.extent, args.steps_per_second, args.processes,
+                    translation=tuple(args.translation), rotation=tuple(args.rotation),
+                    position=tuple(args.camera), field_of_view=args.field_of_view)
+    seconds = time.perf_counter() - start
+    print('{} frames in {:.1f} s ({:.1f} frames/s)'.format(frames, seconds, frames / seconds))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main(sys.argv))
@@ -0,0 +1,65 @@
+"""
+Common setup of the benchmarks and of the checks of the parallel step
+implementations (engine_benchmark, scaling_benchmark, shared_memory_pool
+and distributedMaster local).
+
+All of them start from the same kind of galaxy, step copies of it with
+the single-node simulation_physic._move_bodies and compare their own
+result with that reference run.
+"""
+import time
+
+import numpy as np
+
+import initial_conditions
+import simulation_constants as sc
+import simulation_physic as sp
+
+MASS_LIM = (1e22, 1e24)
+DIS_LIM = (1e11, 1.496e12, 4e10)
+RAD_LIM = (8e9, 8e9)
+BLACK_WEIGHT = 2e31
+TIMESTEP = 50000.0
+
+
+def bodies(nr_of_bodies, seed=None):
+    """
+        Galaxy of nr_of_bodies bodies around the black hole.
+
+        Args:
+            nr_of_bodies (int): Bodies besides the black hole at index 0
+            seed: Seed of the initial conditions, None for fresh entropy
+        Returns:
+            (positions, speed, mass) float64 arrays
+    """
+    positions, speed, radius, mass = initial_conditions.initialise_bodies(
+        nr_of_bodies, MASS_LIM, DIS_LIM, RAD_LIM, BLACK_WEIGHT, seed=seed)
+    return positions, speed, mass
+
+
+def run(positions, speed, mass, steps, engine=sc.ENGINE_DIRECT, timestep=TIMESTEP):
+    """
+        Advance copies of the bodies with simulation_physic._move_bodies,
+        the given arrays are not changed.
+
+        Args:
+            positions, speed, mass: Arrays of all bodies
+            steps (int): Number of steps
+            engine (str): One of simulation_constants.ENGINES
+            timestep (float): Seconds per step
+        Returns:
+            (positions, speed, seconds) after the steps
+    """
+    positions, speed = np.array(positions), np.array(speed)
+    start = time.perf_counter()
+    for _ in range(steps):
+        sp._move_bodies(engine, positions, speed, mass, timestep)
+    return positions, speed, time.perf_counter() - start
+
+
+def identical(positions, speed, reference):
+    """
+        True if positions and speed agree bit for bit with the
+        (positions, speed, ...) of a reference run.
+    """
+    return np.array_equal(positions, reference[0]) and np.array_equal(speed, reference[1])
@@ -0,0 +1,78 @@
+"""
+Compare the frame times of the GalaxyRenderer draw modes.
+
+How to use:
+    python render_benchmark.py [nr_of_bodies] [frames]
+
+Opens a GLUT window, draws the same random galaxy `frames` times with
+every mode that draws bodies and prints the mean and worst frame
+time. glFinish is called after each frame so the time includes the GPU
+work, not just queueing the commands. Needs a display.
+"""
+import sys
+import time
+from multiprocessing import Pipe
+
+import numpy as np
+from OpenGL import GL
+from OpenGL import GLUT
+
+import galaxy_renderer
+
+_RADIUS = 0.005
+
+
+def _galaxy(nr_of_bodies):
+    """
+        Random disc of bodies in renderer coordinates.
+    """
+    radius = np.random.uniform(0.1, 1.0, nr_of_bodies)
+    angle = np.random.uniform(0, 2 * np.pi, nr_of_bodies)
+    bodies = np.empty((nr_of_bodies, 4))
+    bodies[:, 0] = radius * np.cos(angle)
+    bodies[:, 1] = radius * np.sin(angle)
+    bodies[:, 2] = np.random.uniform(-0.03, 0.03, nr_of_bodies)
+    bodies[:, 3] = _RADIUS
+    return bodies
+
+
+def _frame_times(renderer, frames):
+    """
+        Render `frames` frames and return their durations in seconds.
+    """
+    times = []
+    for _ in range(frames):
+        start = time.perf_counter()
+        renderer.render()
+        GL.glFinish()
+        times.append(time.perf_counter() - start)
+        # let GLUT process window events between frames
+        GLUT.glutMainLoopEvent()
+    return np.array(times)
+
+
+def _main(argv):
+    nr_of_bodies = int(argv[1]) if len(argv) > 1 else 5000
+    frames = int(argv[2]) if len(argv) > 2 else 50
+
+    bodies = _galaxy(nr_of_bodies)
+    render_pipe, _ = Pipe()
+    print('bodies: {}, frames: {}'.format(nr_of_bodies, frames))
+    print('mode        mean ms    max ms      fps')
+    renderer = galaxy_renderer.GalaxyRenderer(render_pipe, 60)
+    for mode in (galaxy_renderer.MODE_SPHERES, galaxy_renderer.MODE_SPRITES):
+        renderer.mode = mode
+        if mode == galaxy_renderer.MODE_SPRITES:
+            renderer.init_sprites()
+            if renderer.mode != mode:
+                continue
+        renderer.bodies = bodies
+        # warm up driver and buffers
+        _frame_times(renderer, 2)
+        times = _frame_times(renderer, frames)
+        print('{:9s} {:9.2f} {:9.2f} {:8.1f}'.format(
+            mode, 1000 * times.mean(), 1000 * times.max(), 1 / times.mean()))
+
+
+if __name__ == '__main__':
+    _main(sys.argv)
@@ -0,0 +1,60 @@
+"""
+Measure how the OpenMP force kernels of simulation_physic scale with
+the number of threads.
+
+How to use:
+    python scaling_benchmark.py [nr_of_bodies] [steps] [max_threads]
+
+For every thread count from 1 to max_threads the same initial galaxy is
+advanced by `steps` steps. The table lists steps/s, the speedup relative
+to one thread and the parallel efficiency. Every run is also compared
+against the single-threaded result. The direct, tiled and Barnes-Hut
+kernels do not share any accumulators between threads and must agree bit for
+bit, the symmetric kernel only up to rounding since its per-thread
+buffers are summed in a different order.
+"""
+import sys
+from multiprocessing import cpu_count
+
+import numpy as np
+import reference_run
+import simulation_physic as sp
+import simulation_constants as sc
+
+
+def _run(engine, positions, speed, mass, steps):
+    """
+        Advance copies of the given bodies and return (steps/s, positions).
+    """
+    # warm up caches and the OpenMP thread pool
+    reference_run.run(positions, speed, mass, 1, engine)
+    positions, speed, seconds = reference_run.run(positions, speed, mass, steps, engine)
+    return steps / seconds, positions
+
+
+def _main(argv):
+    nr_of_bodies = int(argv[1]) if len(argv) > 1 else 5000
+    steps = int(argv[2]) if len(argv) > 2 else 5
+    max_threads = int(argv[3]) if len(argv) > 3 else cpu_count()
+
+    positions, speed, mass = reference_run.bodies(nr_of_bodies)
+    for engine in (sc.ENGINE_DIRECT, sc.ENGINE_DIRECT_SYMMETRIC,
+                   sc.ENGINE_DIRECT_TILED, sc.ENGINE_BARNES_HUT):
+        print('\nengine: {}, bodies: {}, steps: {}'.format(engine,
+                                                          nr_of_bodies,
+                                                          steps))
+        print('threads    steps/s   speedup   efficiency   max deviation')
+        reference_rate, reference = None, None
+        for nr_of_threads in range(1, max_threads + 1):
+            sp._set_num_threads(nr_of_threads)
+            rate, result = _run(engine, positions, speed, mass, steps)
+            if reference is None:
+                reference_rate, reference = rate, result
+            speedup = rate / reference_rate
+            print('{:7d} {:10.3f} {:9.2f} {:12.2f} {:15.3e}'.format(
+                nr_of_threads, rate, speedup, speedup / nr_of_threads,
+                np.abs(result - reference).max()))
+
+
+if __name__ == '__main__':
+    _main(sys.argv)
@@ -0,0 +1,166 @@
+"""
+Single-node process pool for the direct sum, for builds without OpenMP.
+Such builds run every prange of simulation_physic in one thread, the
+pool spreads the bodies over processes instead.
+
+The positions (twice, for the current and the next step), speeds,
+masses and a small control block live in multiprocessing.RawArray
+shared memory. Every process computes a fixed range of bodies with
+_mp_move_bodies_circle and writes it into the positions of the next
+step, a barrier before and after each step keeps them in lockstep with
+the simulation process. Arrays are never pickled, only the step number
+and timestep change hands.
+
+How to use:
+    python shared_memory_pool.py [nr_of_bodies] [steps] [nr_of_processes]
+
+Runs the pool against the single-node _move_bodies and prints the
+speedup and whether the results are identical.
+"""
+import sys
+import time
+from multiprocessing import Barrier, cpu_count, Process, RawArray
+
+import numpy as np
+
+# control block: command, step, timestep
+_STEP = 0
+_STOP = 1
+
+
+def _views(shared, nr_of_bodies):
+    """
+    numpy views (positions (2, N, 3), speed, mass, control) of the raw
+    arrays
+    """
+    positions, speed, mass, control = shared
+    return (np.frombuffer(positions, dtype=np.float64).reshape(2, nr_of_bodies, 3),
+            np.frombuffer(speed, dtype=np.float64).reshape(nr_of_bodies, 3),
+            np.frombuffer(mass, dtype=np.float64),
+            np.frombuffer(control, dtype=np.float64))
+
+
+def _pool_worker(shared, nr_of_bodies, start, end, barrier, nr_of_threads):
+    # imported here, simulation_physic imports this module
+    import simulation_physic as sp
+
+    sp._set_num_threads(nr_of_threads)
+    positions, speed, mass, control = _views(shared, nr_of_bodies)
+    # the other processes read the current positions while this one
+    # integrates, so it works on a private copy
+    private = np.empty((nr_of_bodies, 3), dtype=np.float64)
+    indexrange = np.array([start, end], dtype=np.int32)
+    while True:
+        barrier.wait()
+        if control[0] == _STOP:
+            break
+        step = int(control[1])
+        np.copyto(private, positions[step % 2])
+        sp._mp_move_bodies_circle(private, speed, mass, control[2], indexrange)
+        positions[(step + 1) % 2][start:end] = private[start:end]
+        barrier.wait()
+
+
+class SharedMemoryPool:
+    """
+    Splits every step of the direct sum over processes sharing the
+    bodies in memory, same interface as distributedMaster.DistributedMaster
+    """
+    def __init__(self, nr_of_bodies, nr_of_processes=0, nr_of_threads=1):
+        """
+        Start nr_of_processes processes (0 = one per core) for
+        nr_of_bodies bodies including the black hole, with nr_of_threads
+        OpenMP threads each
+        """
+        if nr_of_processes <= 0:
+            nr_of_processes = cpu_count()
+        self.nr_of_bodies = nr_of_bodies
+        self.shared = (RawArray('d', 2 * nr_of_bodies * 3),
+                       RawArray('d', nr_of_bodies * 3),
+                       RawArray('d', nr_of_bodies),
+                       RawArray('d', 3))
+        self.positions, self.speed, self.mass, self.control = _views(self.shared,
+                                                                     nr_of_bodies)
+        self.step = 0
+        # the simulation process is the last party
+        self.barrier = Barrier(nr_of_processes + 1)
+        # fixed ranges, the black hole at index 0 does not move
+        bounds = np.linspace(1, nr_of_bodies, nr_of_processes + 1).astype(np.int64)
+        self.processes = [Process(target=_pool_worker,
+                                  args=(self.shared, nr_of_bodies, int(bounds[i]),
+                                        int(bounds[i + 1]), self.barrier,
+                                        nr_of_threads),
+                                  daemon=True)
+                          for i in range(nr_of_processes)]
+        for p in self.processes:
+            p.start()
+
+    def set_state(self, positions, speed, mass):
+        """
+        Copy positions, speeds and masses into shared memory, needed at the
+        start and again after the bodies were re-sorted
+        """
+        self.positions[self.step % 2] = positions
+        self.positions[(self.step + 1) % 2] = positions
+        self.speed[...] = speed
+        self.mass[...] = mass
+
+    def move_bodies(self, positions, speed, timestep, collect=True):
+        """
+        Advance all bodies but the black hole by one step. positions and
+        speed are updated in place if collect is set, otherwise they stay
+        at the last collected step.
+        """
+        self.control[0] = _STEP
+        self.control[1] = self.step
+        self.control[2] = timestep
+        # start, then wait until every range is done
+        self.barrier.wait()
+        self.barrier.wait()
+        self.step += 1
+        if collect:
+            np.copyto(np.asarray(positions), self.positions[self.step % 2])
+            np.copyto(np.asarray(speed), self.speed)
+
+    def stop(self):
+        """
+        Let all processes exit
+        """
+        self.control[0] = _STOP
+        self.barrier.wait()
+        for p in self.processes:
+            p.join()
+
+
+def _main(argv):
+    import reference_run
+    import simulation_physic as sp
+
+    nr_of_bodies = int(argv[1]) if len(argv) > 1 else 2000
+    steps = int(argv[2]) if len(argv) > 2 else 10
+    nr_of_processes = int(argv[3]) if len(argv) > 3 else cpu_count()
+
+    positions, speed, mass = reference_run.bodies(nr_of_bodies)
+    # one thread, like a build without OpenMP
+    sp._set_num_threads(1)
+    reference = reference_run.run(positions, speed, mass, steps)
+
+    pool = SharedMemoryPool(positions.shape[0], nr_of_processes)
+    pool.set_state(positions, speed, mass)
+    t1 = time.time()
+    for i in range(steps):
+        pool.move_bodies(positions, speed, reference_run.TIMESTEP, collect=i == steps - 1)
+    t2 = time.time()
+    pool.stop()
+
+    identical = reference_run.identical(positions, speed, reference)
+    print(' processes:    ', nr_of_processes)
+    print(' pool:         ', t2-t1, ' s')
+    print(' one thread:   ', reference[2], ' s')
+    print(' speedup:      ', reference[2] / (t2-t1))
+    print(' identical:    ', identical)
+    return 0 if identical else 1
+
+
+if __name__ == '__main__':
+    sys.exit(_main(sys.argv))
@@ -22,3 +22,31 @@
 # message to signal a process to terminate
 END_MESSAGE = 'End_of_the_universe'
 G_CONSTANT = 6.673e-11
+
+# force engines selectable in simulation_physic.startup
+ENGINE_DIRECT = 'direct'
+ENGINE_DIRECT_SYMMETRIC = 'direct_symmetric'
+ENGINE_DIRECT_TILED = 'direct_tiled'
+ENGINE_BARNES_HUT = 'barnes_hut'
+ENGINE_PARTICLE_MESH = 'particle_mesh'
+ENGINES = (ENGINE_DIRECT, ENGINE_DIRECT_SYMMETRIC, ENGINE_DIRECT_TILED,
+           ENGINE_BARNES_HUT, ENGINE_PARTICLE_MESH)
+# default opening angle of the Barnes-Hut tree (0 = exact direct sum)
+DEFAULT_THETA = 0.5
+# default number of particle-mesh cells per axis
+DEFAULT_GRID_SIZE = 64
+# steps between two Morton re-sorts of the bodies (0 = never)
+DEFAULT_REORDER_EVERY = 100
+# accuracy of the adaptive timesteps (fraction of an orbital period / 2 pi)
+DEFAULT_ETA = 0.02
+# integrators selectable in simulation_physic.startup
+INTEGRATOR_EULER = 'euler'
+INTEGRATOR_VERLET = 'verlet'
+INTEGRATOR_HERMITE = 'hermite'
+INTEGRATORS = (INTEGRATOR_EULER, INTEGRATOR_VERLET, INTEGRATOR_HERMITE)
+# initial distributions selectable in simulation_physic.startup
+PROFILE_UNIFORM = 'uniform'
+PROFILE_EXPONENTIAL_DISK = 'exponential_disk'
+PROFILE_PLUMMER = 'plummer'
+PROFILE_COLLISION = 'collision'
+PROFILES = (PROFILE_UNIFORM, PROFILE_EXPONENTIAL_DISK, PROFILE_PLUMMER, PROFILE_COLLISION)
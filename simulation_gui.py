@@ -61,6 +61,8 @@ class SimulationGUI(QtWidgets.QMainWindow):
         black_weight = float(self.ui.blackHoleWeightLineEdit.text())
 
         timestep = float(self.ui.timestepValue.text())
+        engine = self.ui.engineComboBox.currentText()
+        theta = float(self.ui.thetaLineEdit.text())
 
         self.renderer_conn, self.simulation_conn = multiprocessing.Pipe()
         self.simulation_process = \
@@ -68,7 +70,9 @@ class SimulationGUI(QtWidgets.QMainWindow):
                                     args=(self.simulation_conn,
                                           nr_of_planets,
                                           mass_lim, dis_lim,
-                                          rad_lim, black_weight, timestep))
+                                          rad_lim, black_weight, timestep,
+                                          engine, theta),
+                                    kwargs={'max_publish_rate': 60})
         self.render_process = \
             multiprocessing.Process(target=galaxy_renderer.startup,
                                     args=(self.renderer_conn, 60), )
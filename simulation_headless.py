@@ -0,0 +1,122 @@
+"""
+Run the simulation without renderer, GUI or display and report its
+throughput, to size runs on servers.
+
+How to use:
+    python simulation_headless.py [nr_of_bodies] [nr_of_steps] [options]
+    python simulation_headless.py --help
+
+Runs simulation_physic.startup in this process with no pipe consumer
+for nr_of_steps steps as fast as possible and prints steps/s,
+body-body interactions/s and the peak memory. Interactions are counted
+as the N * N pair evaluations of one direct-sum step, so for the tree and
+mesh engines and for the adaptive integrators (several substeps per
+step) the rate is the direct-sum equivalent.
+"""
+import argparse
+import sys
+
+import simulation_constants as sc
+import simulation_physic
+
+
+def _peak_memory():
+    """
+    Peak resident memory in bytes of this process and of its finished
+    children (process pool), None where the resource module is missing
+    """
+    try:
+        import resource
+    except ImportError:
+        return None, None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit)
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        description='Headless galaxy simulation with throughput report.')
+    parser.add_argument('nr_of_bodies', type=int, nargs='?', default=1000)
+    parser.add_argument('nr_of_steps', type=int, nargs='?', default=100)
+    parser.add_argument('--mass-lim', type=float, nargs=2, default=(1e16, 1e22))
+    parser.add_argument('--dis-lim', type=float, nargs=3, default=(1e11, 1.496e12, 4e11))
+    parser.add_argument('--rad-lim', type=float, nargs=2, default=(8e9, 4e10))
+    parser.add_argument('--black-weight', type=float, default=2e31)
+    parser.add_argument('--timestep', type=float, default=50000.0)
+    parser.add_argument('--engine', choices=sc.ENGINES, default=sc.ENGINE_DIRECT)
+    parser.add_argument('--theta', type=float, default=sc.DEFAULT_THETA)
+    parser.add_argument('--grid-size', type=int, default=sc.DEFAULT_GRID_SIZE)
+    parser.add_argument('--mesh-black-hole', action='store_true',
+                        help='particle_mesh: deposit the black hole on the mesh')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='OpenMP threads, 0 keeps the default')
+    parser.add_argument('--single-precision', action='store_true')
+    parser.add_argument('--reorder-every', type=int, default=sc.DEFAULT_REORDER_EVERY)
+    parser.add_argument('--block-levels', type=int, default=0)
+    parser.add_argument('--eta', type=float, default=sc.DEFAULT_ETA)
+    parser.add_argument('--integrator', choices=sc.INTEGRATORS,
+                        default=sc.INTEGRATOR_EULER)
+    parser.add_argument('--processes', type=int, default=0,
+                        help='split the direct sum over local processes')
+    parser.add_argument('--distributed', nargs=3, metavar=('IP', 'SOCKET', 'WORKERS'),
+                        help='listen for distributedWorker processes')
+    parser.add_argument('--ring', action='store_true',
+                        help='distributed workers exchange positions in a ring')
+    parser.add_argument('--record', metavar='PATH',
+                        help='record positions and speeds into a trajectory file')
+    parser.add_argument('--record-every', type=int, default=1)
+    parser.add_argument('--record-radius', action='store_true')
+    parser.add_argument('--record-bits', type=int, default=0,
+                        help='write a compressed archive with that many bits per coordinate')
+    parser.add_argument('--profile', choices=sc.PROFILES, default=sc.PROFILE_UNIFORM,
+                        help='initial distribution of the bodies')
+    parser.add_argument('--seed', type=int, help='seed of the initial bodies')
+    return parser
+
+
+def _main(argv):
+    parser = _parser()
+    args = parser.parse_args(argv[1:])
+    if args.nr_of_steps < 1:
+        parser.error('nr_of_steps has to be at least 1')
+    distributed = None
+    if args.distributed is not None:
+        distributed = (args.distributed[0], int(args.distributed[1]),
+                       int(args.distributed[2]))
+
+    steps, seconds, dropped = simulation_physic.startup(
+        None, args.nr_of_bodies, tuple(args.mass_lim), tuple(args.dis_lim),
+        tuple(args.rad_lim), args.black_weight, args.timestep,
+        engine=args.engine, theta=args.theta, grid_size=args.grid_size,
+        direct_black_hole=not args.mesh_black_hole, nr_of_threads=args.threads,
+        single_precision=args.single_precision,
+        reorder_every=args.reorder_every, block_levels=args.block_levels,
+        eta=args.eta, integrator=args.integrator, distributed=distributed,
+        distributed_ring=args.ring, nr_of_processes=args.processes,
+        nr_of_steps=args.nr_of_steps, record_path=args.record,
+        record_every=args.record_every, record_radius=args.record_radius,
+        record_bits=args.record_bits, profile=args.profile, seed=args.seed)
+
+    peak, peak_children = _peak_memory()
+    print('engine:          ', args.engine, '/', args.integrator)
+    print('bodies:          ', args.nr_of_bodies)
+    print('steps:           ', steps)
+    print('seconds:          {:.3f}'.format(seconds))
+    print('steps/s:          {:.3f}'.format(steps / seconds))
+    print('interactions/s:   {:.4g}'.format(
+        steps * float(args.nr_of_bodies) ** 2 / seconds))
+    if peak is None:
+        print('peak memory:      not available on this platform')
+    else:
+        print('peak memory:      {:.1f} MiB'.format(peak / 2 ** 20))
+        if args.processes > 0:
+            print('peak of children: {:.1f} MiB'.format(peak_children / 2 ** 20))
+    if args.record is not None:
+        print('dropped frames:  ', dropped)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main(sys.argv))
@@ -20,296 +20,1571 @@
 # or open http://www.fsf.org/licensing/licenses/gpl.html
 #
 import sys
-from random import uniform # TODO: C libs
 import numpy as np
 import time
 cimport numpy as np
 cimport cython
-from libc.math cimport sqrt
-from libc.stdlib cimport rand, RAND_MAX, srand
-from cython.parallel import prange
+from libc.math cimport sqrt, fabs
+from libc.stdlib cimport malloc, realloc, free
+from cython.parallel import prange, parallel, threadid
+
+# OpenMP thread count, also builds without -fopenmp (one thread)
+cdef extern from *:
+    """
+    #ifdef _OPENMP
+    #include <omp.h>
+    #define _omp_get_max_threads() omp_get_max_threads()
+    #define _omp_set_num_threads(n) omp_set_num_threads(n)
+    #else
+    #define _omp_get_max_threads() 1
+    #define _omp_set_num_threads(n) ((void)(n))
+    #endif
+    """
+    int _omp_get_max_threads() nogil
+    void _omp_set_num_threads(int nr_of_threads) nogil
 
 import simulation_constants as sc
+from frame_buffer import FrameBuffer
+from distributedMaster import DistributedMaster
+from shared_memory_pool import SharedMemoryPool
+from trajectory_recorder import TrajectoryRecorder
+from trajectory_archive import TrajectoryArchiveWriter
+from initial_conditions import initialise_bodies
 
 cdef int __FPS = 60
 cdef double __DELTA_ALPHA = 0.01
 cdef double G_CONSTANT = 6.673e-11
 
+# Barnes-Hut: below this depth bodies sharing a cell are kept in one leaf
+cdef enum:
+    _BH_MAX_DEPTH = 48
+    _BH_STACK_SIZE = 8 * (_BH_MAX_DEPTH + 1)
+    _BH_INTERNAL = -2
+    _BH_EMPTY = -1
+
+# Tiled direct sum: number of target bodies kept in L1 while all
+# source bodies stream past (6 arrays * 256 * 8 byte = 12 KiB)
+cdef enum:
+    _TILE_SIZE = 256
+
+# storage type of the structure-of-arrays copy used by the tiled kernel
+ctypedef fused _storage_t:
+    float
+    double
+
+
+@cython.cdivision(True)
+cdef inline void _direct_acceleration(double *positions, double *mass,
+                                      np.intp_t nr_of_bodies, np.intp_t body,
+                                      double *accel) nogil:
+    """
+    Berechnet per direkter Summe die Beschleunigung eines Körpers.
+    Positionen werden nur gelesen, alle Zwischenwerte sind lokale
+    Skalare und damit privat je Thread.
+
+    params:
+        positions: Zeiger auf das (N, 3) Positions-Array
+        mass: Zeiger auf das Massen-Array
+        nr_of_bodies: Anzahl N der Körper
+        body: Index des Körpers
+        accel: Ausgabe, 3 Komponenten
+    """
+    cdef np.intp_t j
+    cdef double x = positions[3*body]
+    cdef double y = positions[3*body + 1]
+    cdef double z = positions[3*body + 2]
+    cdef double dx, dy, dz, dist_sq, inv_dist_cube
+    cdef double ax = 0.0
+    cdef double ay = 0.0
+    cdef double az = 0.0
+
+    for j in range(nr_of_bodies):
+        if j == body:
+            continue
+        dx = positions[3*j] - x
+        dy = positions[3*j + 1] - y
+        dz = positions[3*j + 2] - z
+        dist_sq = dx*dx + dy*dy + dz*dz
+        inv_dist_cube = mass[j] / (dist_sq * sqrt(dist_sq))
+        ax = ax + inv_dist_cube * dx
+        ay = ay + inv_dist_cube * dy
+        az = az + inv_dist_cube * dz
+    # G FORCE TO ACCELERATION
+    accel[0] = G_CONSTANT * ax
+    accel[1] = G_CONSTANT * ay
+    accel[2] = G_CONSTANT * az
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _direct_accelerations(double[:, ::1] positions,
+                                double[::1] mass,
+                                double[:, ::1] accel,
+                                np.intp_t start,
+                                np.intp_t end) nogil:
+    """
+    Erste Phase eines Schritts: berechnet per direkter Summe die
+    Beschleunigung der Körper start bis end-1 in den Puffer accel.
+
+    params:
+        positions: NumPy-Array aller Positionen der Körper
+        mass: NumPy-Array aller Massen der Körper
+        accel: Ausgabe, NumPy-Array (N, 3) der Beschleunigungen
+        start, end: zu berechnender Indexbereich
+    """
+    cdef np.intp_t i
+    cdef double *pos_ptr = &positions[0, 0]
+    cdef double *mass_ptr = &mass[0]
+
+    for i in prange(start, end, schedule='static'):
+        _direct_acceleration(pos_ptr, mass_ptr, mass.shape[0], i, &accel[i, 0])
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _direct_accelerations_of(double[:, ::1] positions,
+                                   double[::1] mass,
+                                   double[:, ::1] accel,
+                                   np.intp_t[::1] bodies) nogil:
+    """
+    Wie _direct_accelerations, aber nur für die in bodies aufgeführten
+    Körper (z.B. die gerade aktiven Körper der Block-Zeitschritte).
+
+    params:
+        positions: NumPy-Array aller Positionen der Körper
+        mass: NumPy-Array aller Massen der Körper
+        accel: Ausgabe, NumPy-Array (N, 3) der Beschleunigungen
+        bodies: Indizes der zu berechnenden Körper
+    """
+    cdef np.intp_t k, i
+    cdef double *pos_ptr = &positions[0, 0]
+    cdef double *mass_ptr = &mass[0]
+
+    for k in prange(bodies.shape[0], schedule='static'):
+        i = bodies[k]
+        _direct_acceleration(pos_ptr, mass_ptr, mass.shape[0], i, &accel[i, 0])
+
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-cdef double[:, ::1] _move_bodies_circle(double[:, ::1] positions,
-                              double[:, ::1] speed,
-                              double[::1] mass,
-                              double timestep):
+cdef void _direct_accelerations_jerks(double[:, ::1] positions,
+                                      double[:, ::1] speed,
+                                      double[::1] mass,
+                                      double[:, ::1] accel,
+                                      double[:, ::1] jerk,
+                                      np.intp_t start,
+                                      np.intp_t end) nogil:
     """
-    Iteriert durch alle Körper und berechnet
-    ihre neue Geschwindigkeit und Position.
+    Berechnet per direkter Summe Beschleunigung und Ruck (Ableitung der
+    Beschleunigung nach der Zeit) der Körper start bis end-1, wie sie der
+    Hermite-Integrator braucht.
 
     params:
         positions: NumPy-Array aller Positionen der Körper
         speed: NumPy-Array aller Geschwindigkeiten der Körper
         mass: NumPy-Array aller Massen der Körper
-        timestep: Anzahl der Sekunden pro berechnetem Schritt
+        accel: Ausgabe, NumPy-Array (N, 3) der Beschleunigungen
+        jerk: Ausgabe, NumPy-Array (N, 3) der Rucke
+        start, end: zu berechnender Indexbereich
     """
-    cdef np.intp_t i, j, coord = 0
-    cdef double[::1] delta_pos = np.zeros(3, dtype=np.float64)
-    cdef double[::1] accel = np.zeros(3, dtype=np.float64)
-    cdef double[::1] force = np.zeros(3, dtype=np.float64)
-    cdef double accumulator = 0.0
-    cdef double abs_delta = 0.0
-
-    for i in prange(1, mass.shape[0], nogil=True):
-        '''
-        Idea to optimise mass focus positions calculation
-        and mass focus weight calculation:
-            calculate it once and then add and subtract the right
-            values each time you go through the loop, instead of going
-            through this current loop every time! O(mass.shape[0]**2)
-        '''
-        force[0] = 0.0
-        force[1] = 0.0
-        force[2] = 0.0
+    cdef np.intp_t i, j
+    cdef double dx, dy, dz, dvx, dvy, dvz, dist_sq, inv_dist_cube, rv
+    cdef double ax, ay, az, jx, jy, jz
 
+    for i in prange(start, end, schedule='static'):
+        ax = 0.0
+        ay = 0.0
+        az = 0.0
+        jx = 0.0
+        jy = 0.0
+        jz = 0.0
         for j in range(mass.shape[0]):
             if j == i:
                 continue
-            abs_delta = 0.0
-            for coord in range(3):
-                delta_pos[coord] = positions[j][coord] - positions[i][coord]
-                abs_delta = abs_delta + delta_pos[coord] * delta_pos[coord]
-            abs_delta = sqrt(abs_delta)
-            for coord in range(3):
-                force[coord] = force[coord] + mass[j]/(abs_delta*abs_delta*abs_delta)*delta_pos[coord]
+            dx = positions[j, 0] - positions[i, 0]
+            dy = positions[j, 1] - positions[i, 1]
+            dz = positions[j, 2] - positions[i, 2]
+            dvx = speed[j, 0] - speed[i, 0]
+            dvy = speed[j, 1] - speed[i, 1]
+            dvz = speed[j, 2] - speed[i, 2]
+            dist_sq = dx*dx + dy*dy + dz*dz
+            inv_dist_cube = mass[j] / (dist_sq * sqrt(dist_sq))
+            rv = 3.0 * (dx*dvx + dy*dvy + dz*dvz) / dist_sq
+            ax = ax + inv_dist_cube * dx
+            ay = ay + inv_dist_cube * dy
+            az = az + inv_dist_cube * dz
+            jx = jx + inv_dist_cube * (dvx - rv * dx)
+            jy = jy + inv_dist_cube * (dvy - rv * dy)
+            jz = jz + inv_dist_cube * (dvz - rv * dz)
+        accel[i, 0] = G_CONSTANT * ax
+        accel[i, 1] = G_CONSTANT * ay
+        accel[i, 2] = G_CONSTANT * az
+        jerk[i, 0] = G_CONSTANT * jx
+        jerk[i, 1] = G_CONSTANT * jy
+        jerk[i, 2] = G_CONSTANT * jz
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _integrate(double[:, ::1] positions,
+                     double[:, ::1] speed,
+                     double[:, ::1] accel,
+                     double timestep,
+                     np.intp_t start,
+                     np.intp_t end) nogil:
+    """
+    Zweite Phase eines Schritts: bewegt die Körper start bis end-1 mit
+    den zuvor berechneten Beschleunigungen.
 
+    params:
+        positions: NumPy-Array aller Positionen der Körper
+        speed: NumPy-Array aller Geschwindigkeiten der Körper
+        accel: NumPy-Array (N, 3) der Beschleunigungen
+        timestep: Anzahl der Sekunden pro berechnetem Schritt
+        start, end: zu bewegender Indexbereich
+    """
+    cdef np.intp_t i
+    cdef int j
+
+    for i in prange(start, end, schedule='static'):
         for j in range(3):
-            # G FORCE TO ACCELERATION
-            accel[j] = force[j] * G_CONSTANT
             # NEXT LOCATION
-            positions[i][j] = positions[i][j] + timestep * speed[i][j] + (timestep*timestep/2.0) * accel[j]
+            positions[i, j] = positions[i, j] + timestep * speed[i, j] + (timestep*timestep/2.0) * accel[i, j]
             # SPEED
-            speed[i][j] = speed[i][j] + timestep * accel[j]
+            speed[i, j] = speed[i, j] + timestep * accel[i, j]
+
+
+cdef double[:, ::1] _move_bodies_circle(double[:, ::1] positions,
+                              double[:, ::1] speed,
+                              double[::1] mass,
+                              double timestep):
+    """
+    Iteriert durch alle Körper und berechnet
+    ihre neue Geschwindigkeit und Position.
+
+    Alle Beschleunigungen werden zuerst aus den unveränderten Positionen
+    berechnet und erst danach in einem zweiten parallelen Durchlauf
+    integriert, damit kein Thread Positionen liest, die ein anderer
+    gerade schreibt.
+
+    params:
+        positions: NumPy-Array aller Positionen der Körper
+        speed: NumPy-Array aller Geschwindigkeiten der Körper
+        mass: NumPy-Array aller Massen der Körper
+        timestep: Anzahl der Sekunden pro berechnetem Schritt
+    """
+    cdef double[:, ::1] accel = np.zeros((mass.shape[0], 3), dtype=np.float64)
+
+    with nogil:
+        _direct_accelerations(positions, mass, accel, 1, mass.shape[0])
+        _integrate(positions, speed, accel, timestep, 1, mass.shape[0])
     return positions
 
 
+# per-thread buffers of _symmetric_accelerations, kept between the steps
+cdef object _symmetric_buffers = None
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
+cdef void _symmetric_accelerations(double[:, ::1] positions,
+                                   double[::1] mass,
+                                   double[:, ::1] accel) except *:
+    """
+    Wie _direct_accelerations, wertet aber jedes Körperpaar nur einmal
+    aus und addiert nach dem dritten Newtonschen Gesetz die entgegen-
+    gesetzte Beschleunigung auf den Partner. Jeder Thread sammelt in
+    einem eigenen Puffer, die Puffer werden anschließend parallel
+    aufsummiert. Die Puffer bleiben zwischen den Aufrufen erhalten und
+    werden nur bei anderer Körper- oder Threadanzahl neu angelegt.
+
+    params:
+        positions: NumPy-Array aller Positionen der Körper
+        mass: NumPy-Array aller Massen der Körper
+        accel: Ausgabe, NumPy-Array (N, 3) der Beschleunigungen
+    """
+    global _symmetric_buffers
+    cdef int nr_of_threads = _omp_get_max_threads()
+    if (_symmetric_buffers is None
+            or _symmetric_buffers.shape != (nr_of_threads, mass.shape[0], 3)):
+        _symmetric_buffers = np.empty((nr_of_threads, mass.shape[0], 3), dtype=np.float64)
+    # all slices, the team may get fewer threads than nr_of_threads
+    _symmetric_buffers.fill(0.0)
+    cdef double[:, :, ::1] buffers = _symmetric_buffers
+    cdef np.intp_t i, j
+    cdef int thread, coord
+    cdef double x, y, z, dx, dy, dz, dist_sq, inv_dist_cube
+    cdef double ax, ay, az, sum_x, sum_y, sum_z
+
+    with nogil, parallel(num_threads=nr_of_threads):
+        thread = threadid()
+        # rows get shorter with i, dynamic chunks keep the threads balanced
+        for i in prange(mass.shape[0], schedule='dynamic', chunksize=16):
+            x = positions[i, 0]
+            y = positions[i, 1]
+            z = positions[i, 2]
+            ax = 0.0
+            ay = 0.0
+            az = 0.0
+            for j in range(i + 1, mass.shape[0]):
+                dx = positions[j, 0] - x
+                dy = positions[j, 1] - y
+                dz = positions[j, 2] - z
+                dist_sq = dx*dx + dy*dy + dz*dz
+                inv_dist_cube = 1.0 / (dist_sq * sqrt(dist_sq))
+                ax = ax + mass[j] * inv_dist_cube * dx
+                ay = ay + mass[j] * inv_dist_cube * dy
+                az = az + mass[j] * inv_dist_cube * dz
+                buffers[thread, j, 0] = buffers[thread, j, 0] - mass[i] * inv_dist_cube * dx
+                buffers[thread, j, 1] = buffers[thread, j, 1] - mass[i] * inv_dist_cube * dy
+                buffers[thread, j, 2] = buffers[thread, j, 2] - mass[i] * inv_dist_cube * dz
+            buffers[thread, i, 0] = buffers[thread, i, 0] + ax
+            buffers[thread, i, 1] = buffers[thread, i, 1] + ay
+            buffers[thread, i, 2] = buffers[thread, i, 2] + az
+
+    # REDUCTION OF THE THREAD BUFFERS
+    for i in prange(mass.shape[0], nogil=True, schedule='static'):
+        sum_x = 0.0
+        sum_y = 0.0
+        sum_z = 0.0
+        for thread in range(nr_of_threads):
+            sum_x = sum_x + buffers[thread, i, 0]
+            sum_y = sum_y + buffers[thread, i, 1]
+            sum_z = sum_z + buffers[thread, i, 2]
+        accel[i, 0] = G_CONSTANT * sum_x
+        accel[i, 1] = G_CONSTANT * sum_y
+        accel[i, 2] = G_CONSTANT * sum_z
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _tiled_block(_storage_t *x, _storage_t *y, _storage_t *z, _storage_t *m,
+                       double *accel_x, double *accel_y, double *accel_z,
+                       np.intp_t start, np.intp_t end, np.intp_t nr_of_bodies) nogil:
+    """
+    Berechnet die Beschleunigung der Zielkörper start bis end-1
+    (höchstens _TILE_SIZE) durch alle Körper. Koordinaten und Summen
+    der Zielkörper liegen in lokalen Arrays, also privat je Thread und
+    ohne mögliche Überlappung mit den Eingaben.
+    """
+    cdef double target_x[_TILE_SIZE]
+    cdef double target_y[_TILE_SIZE]
+    cdef double target_z[_TILE_SIZE]
+    cdef double sum_x[_TILE_SIZE]
+    cdef double sum_y[_TILE_SIZE]
+    cdef double sum_z[_TILE_SIZE]
+    cdef np.intp_t count = end - start
+    cdef np.intp_t i, j
+    cdef double source_x, source_y, source_z, source_mass
+    cdef double dx, dy, dz, dist_sq, inv_dist_cube, self_term
+
+    for i in range(count):
+        target_x[i] = x[start + i]
+        target_y[i] = y[start + i]
+        target_z[i] = z[start + i]
+        sum_x[i] = 0.0
+        sum_y[i] = 0.0
+        sum_z[i] = 0.0
+    for j in range(nr_of_bodies):
+        source_x = x[j]
+        source_y = y[j]
+        source_z = z[j]
+        source_mass = m[j]
+        for i in range(count):
+            dx = source_x - target_x[i]
+            dy = source_y - target_y[i]
+            dz = source_z - target_z[i]
+            dist_sq = dx*dx + dy*dy + dz*dz
+            # the body itself (distance 0) contributes nothing, written
+            # without a branch so that the loop stays vectorisable
+            self_term = dist_sq == 0.0
+            dist_sq = dist_sq + self_term
+            inv_dist_cube = (1.0 - self_term) * source_mass / (dist_sq * sqrt(dist_sq))
+            sum_x[i] = sum_x[i] + inv_dist_cube * dx
+            sum_y[i] = sum_y[i] + inv_dist_cube * dy
+            sum_z[i] = sum_z[i] + inv_dist_cube * dz
+    for i in range(count):
+        accel_x[start + i] = G_CONSTANT * sum_x[i]
+        accel_y[start + i] = G_CONSTANT * sum_y[i]
+        accel_z[start + i] = G_CONSTANT * sum_z[i]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _tiled_accelerations(_storage_t[::1] pos_x,
+                               _storage_t[::1] pos_y,
+                               _storage_t[::1] pos_z,
+                               _storage_t[::1] body_mass,
+                               double[::1] accel_x,
+                               double[::1] accel_y,
+                               double[::1] accel_z) nogil:
+    """
+    Direkte Summe auf getrennten x/y/z/Massen-Arrays (Structure of Arrays).
+    Jeder Thread bearbeitet Blöcke von _TILE_SIZE Zielkörpern, die im
+    L1-Cache bleiben, während alle Quellkörper nacheinander durchlaufen.
+    Die innerste Schleife läuft zusammenhängend über die Zielkörper ohne
+    Abhängigkeit zwischen den Iterationen und kann daher vom Compiler
+    vektorisiert werden. Gerechnet und summiert wird immer in double.
+
+    params:
+        pos_x, pos_y, pos_z: Koordinaten aller Körper (float oder double)
+        body_mass: Massen aller Körper (float oder double)
+        accel_x, accel_y, accel_z: Ausgabe, Beschleunigungen aller Körper
+    """
+    cdef np.intp_t nr_of_bodies = body_mass.shape[0]
+    cdef np.intp_t nr_of_blocks = (nr_of_bodies + _TILE_SIZE - 1) // _TILE_SIZE
+    cdef np.intp_t block
+
+    for block in prange(nr_of_blocks, schedule='static'):
+        _tiled_block(&pos_x[0], &pos_y[0], &pos_z[0], &body_mass[0],
+                     &accel_x[0], &accel_y[0], &accel_z[0],
+                     block * _TILE_SIZE,
+                     min((block + 1) * _TILE_SIZE, nr_of_bodies),
+                     nr_of_bodies)
+
+
+cdef void _soa_accelerations(double[:, ::1] positions,
+                             double[::1] mass,
+                             double[:, ::1] accel,
+                             bint single_precision) except *:
+    """
+    Berechnet alle Beschleunigungen mit dem cache-geblockten Kernel
+    _tiled_accelerations. Positionen und Geschwindigkeiten bleiben im
+    (N, 3) double-Array, nur die Kopie für die Kraftberechnung liegt
+    als Structure of Arrays vor.
+
+    params:
+        positions: NumPy-Array aller Positionen der Körper
+        mass: NumPy-Array aller Massen der Körper
+        accel: Ausgabe, NumPy-Array (N, 3) der Beschleunigungen
+        single_precision: Kopie in float32 ablegen (halbe Speicher-
+            bandbreite, summiert wird trotzdem in double)
+    """
+    dtype = np.float32 if single_precision else np.float64
+    soa = np.ascontiguousarray(np.asarray(positions).T, dtype=dtype)
+    soa_mass = np.asarray(mass, dtype=dtype)
+    accel_soa = np.empty((3, mass.shape[0]), dtype=np.float64)
+    cdef double[::1] accel_x = accel_soa[0]
+    cdef double[::1] accel_y = accel_soa[1]
+    cdef double[::1] accel_z = accel_soa[2]
+    cdef float[::1] x32, y32, z32, m32
+    cdef double[::1] x64, y64, z64, m64
+
+    if single_precision:
+        x32, y32, z32, m32 = soa[0], soa[1], soa[2], soa_mass
+        with nogil:
+            _tiled_accelerations(x32, y32, z32, m32, accel_x, accel_y, accel_z)
+    else:
+        x64, y64, z64, m64 = soa[0], soa[1], soa[2], soa_mass
+        with nogil:
+            _tiled_accelerations(x64, y64, z64, m64, accel_x, accel_y, accel_z)
+    np.asarray(accel)[...] = accel_soa.T
+
+
+
 cpdef tuple _mp_move_bodies_circle(double[:, ::1] positions,
                                    double[:, ::1] speed,
                                    double[::1] mass,
                                    double timestep,
                                    int[::1] indexrange):
-    # This method probably also needs to receive a master
+    """
+    Wie _move_bodies_circle, berechnet aber nur die Körper
+    indexrange[0] bis indexrange[-1]-1. Die übrigen Körper gehen
+    unverändert in die Kraftberechnung ein.
 
-    # THIS LOGIC WILL MOVE IN THE WORKER
-    #
-    # In order for this to work we will need something like a calculation range (Planet 1 - 200 or similar)
-    # Also: consider using a dictionary as shared memory!
-    # The code remaining here will probably be something like
+    params:
+        positions: NumPy-Array aller Positionen der Körper
+        speed: NumPy-Array aller Geschwindigkeiten der Körper
+        mass: NumPy-Array aller Massen der Körper
+        timestep: Anzahl der Sekunden pro berechnetem Schritt
+        indexrange: Array, dessen erstes und letztes Element den
+            Indexbereich angeben
+    """
+    cdef np.intp_t start_value = indexrange[0]
+    cdef np.intp_t end_value = indexrange[indexrange.shape[0] - 1]
+    cdef double[:, ::1] accel = np.zeros((mass.shape[0], 3), dtype=np.float64)
+
+    with nogil:
+        _direct_accelerations(positions, mass, accel, start_value, end_value)
+        _integrate(positions, speed, accel, timestep, start_value, end_value)
+    return (positions, speed)
 
-    # result = distributedMaster.calculate(positions, speed, mass, timestep)
 
-    # for planet in range(1, mass.shape[0]):
-    #    positions[planet][0] = result[planet][0]
-    #    positions[planet][1] = result[planet][1]
-    #    positions[planet][2] = result[planet][2]
+cpdef void _set_num_threads(int nr_of_threads):
     """
-    Iteriert durch alle Körper und berechnet
-    ihre neue Geschwindigkeit und Position.
+    Legt die Anzahl der OpenMP-Threads für alle parallelen Schleifen fest.
+    Ohne OpenMP übersetzt bleibt es bei einem Thread.
 
     params:
+        nr_of_threads: Anzahl der Threads, 0 behält den Standardwert
+    """
+    if nr_of_threads > 0:
+        _omp_set_num_threads(nr_of_threads)
+
+cdef struct _Octree:
+    int nr_of_nodes
+    int capacity
+    int *child          # 8 Kinder je Knoten, -1 wenn nicht vorhanden
+    int *first_body     # erster Körper eines Blattes oder _BH_INTERNAL/_BH_EMPTY
+    int *next_body      # verkettete Liste der Körper eines Blattes
+    int *parent
+    double *center      # 3 Koordinaten je Knoten
+    double *half_size
+    double *node_mass
+    double *mass_focus  # 3 Koordinaten je Knoten
+
+
+cdef int _octree_reserve(_Octree *tree, int capacity) except -1:
+    """
+    Vergrößert die Knoten-Arrays des Baums auf mindestens capacity Knoten.
+    """
+    if capacity <= tree.capacity:
+        return 0
+    capacity = max(capacity, 2 * tree.capacity)
+    cdef int *child = <int *> realloc(tree.child, 8 * capacity * sizeof(int))
+    if child == NULL:
+        raise MemoryError()
+    tree.child = child
+    cdef int *first_body = <int *> realloc(tree.first_body, capacity * sizeof(int))
+    if first_body == NULL:
+        raise MemoryError()
+    tree.first_body = first_body
+    cdef int *parent = <int *> realloc(tree.parent, capacity * sizeof(int))
+    if parent == NULL:
+        raise MemoryError()
+    tree.parent = parent
+    cdef double *center = <double *> realloc(tree.center, 3 * capacity * sizeof(double))
+    if center == NULL:
+        raise MemoryError()
+    tree.center = center
+    cdef double *half_size = <double *> realloc(tree.half_size, capacity * sizeof(double))
+    if half_size == NULL:
+        raise MemoryError()
+    tree.half_size = half_size
+    cdef double *node_mass = <double *> realloc(tree.node_mass, capacity * sizeof(double))
+    if node_mass == NULL:
+        raise MemoryError()
+    tree.node_mass = node_mass
+    cdef double *mass_focus = <double *> realloc(tree.mass_focus, 3 * capacity * sizeof(double))
+    if mass_focus == NULL:
+        raise MemoryError()
+    tree.mass_focus = mass_focus
+    tree.capacity = capacity
+    return 0
+
+
+cdef void _octree_free(_Octree *tree):
+    free(tree.child)
+    free(tree.first_body)
+    free(tree.next_body)
+    free(tree.parent)
+    free(tree.center)
+    free(tree.half_size)
+    free(tree.node_mass)
+    free(tree.mass_focus)
+
+
+cdef int _octree_new_node(_Octree *tree, int parent, int octant,
+                          double cx, double cy, double cz,
+                          double half) except -1:
+    """
+    Hängt einen leeren Knoten an den Baum an und gibt dessen Index zurück.
+    """
+    _octree_reserve(tree, tree.nr_of_nodes + 1)
+    cdef int node = tree.nr_of_nodes
+    cdef int k
+    tree.nr_of_nodes += 1
+    for k in range(8):
+        tree.child[8*node + k] = -1
+    tree.first_body[node] = _BH_EMPTY
+    tree.parent[node] = parent
+    tree.center[3*node] = cx
+    tree.center[3*node + 1] = cy
+    tree.center[3*node + 2] = cz
+    tree.half_size[node] = half
+    tree.node_mass[node] = 0.0
+    tree.mass_focus[3*node] = 0.0
+    tree.mass_focus[3*node + 1] = 0.0
+    tree.mass_focus[3*node + 2] = 0.0
+    if parent >= 0:
+        tree.child[8*parent + octant] = node
+    return node
+
+
+cdef inline int _octant(_Octree *tree, int node, double[:, ::1] positions, int body):
+    cdef int octant = 0
+    if positions[body, 0] >= tree.center[3*node]:
+        octant |= 1
+    if positions[body, 1] >= tree.center[3*node + 1]:
+        octant |= 2
+    if positions[body, 2] >= tree.center[3*node + 2]:
+        octant |= 4
+    return octant
+
+
+cdef int _octree_add_child(_Octree *tree, int node, int octant) except -1:
+    cdef double half = tree.half_size[node] / 2.0
+    return _octree_new_node(tree, node, octant,
+                            tree.center[3*node] + (half if octant & 1 else -half),
+                            tree.center[3*node + 1] + (half if octant & 2 else -half),
+                            tree.center[3*node + 2] + (half if octant & 4 else -half),
+                            half)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef int _build_octree(_Octree *tree, double[:, ::1] positions, double[::1] mass) except -1:
+    """
+    Baut den Barnes-Hut-Baum über alle Körper auf und berechnet
+    für jeden Knoten Gesamtmasse und Massenschwerpunkt.
+
+    params:
+        tree: leerer (mit Nullen initialisierter) Baum
         positions: NumPy-Array aller Positionen der Körper
-        speed: NumPy-Array aller Geschwindigkeiten der Körper
         mass: NumPy-Array aller Massen der Körper
-        timestep: Anzahl der Sekunden pro berechnetem Schritt
     """
-    cdef np.intp_t i, j, coord = 0
-    cdef double[::1] delta_pos = np.zeros(3, dtype=np.float64)
-    cdef double[::1] accel = np.zeros(3, dtype=np.float64)
-    cdef double[::1] force = np.zeros(3, dtype=np.float64)
-    cdef double accumulator = 0.0
-    cdef double abs_delta = 0.0
-
-    cdef int start_value = indexrange[0]
-    cdef int end_value = indexrange[indexrange.shape[0] - 1]
-
-    for i in prange(start_value, end_value, nogil=True):
-        '''
-        Idea to optimise mass focus positions calculation
-        and mass focus weight calculation:
-            calculate it once and then add and subtract the right
-            values each time you go through the loop, instead of going
-            through this current loop every time! O(mass.shape[0]**2)
-        '''
-        force[0] = 0.0
-        force[1] = 0.0
-        force[2] = 0.0
+    cdef np.intp_t nr_of_bodies = mass.shape[0]
+    cdef np.intp_t i
+    cdef int node, child, old, octant, depth, body, coord, parent
+    cdef double lower[3]
+    cdef double upper[3]
+    cdef double half = 0.0
 
-        for j in range(mass.shape[0]):
-            if j == i:
-                continue
-            abs_delta = 0.0
-            for coord in range(3):
-                delta_pos[coord] = positions[j][coord] - positions[i][coord]
-                abs_delta = abs_delta + delta_pos[coord] * delta_pos[coord]
-            abs_delta = sqrt(abs_delta)
+    tree.next_body = <int *> malloc(max(nr_of_bodies, 1) * sizeof(int))
+    if tree.next_body == NULL:
+        raise MemoryError()
+    _octree_reserve(tree, 2 * nr_of_bodies + 1)
+
+    # ROOT CELL: BOUNDING CUBE OF ALL BODIES
+    for coord in range(3):
+        lower[coord] = positions[0, coord]
+        upper[coord] = positions[0, coord]
+    for i in range(1, nr_of_bodies):
+        for coord in range(3):
+            if positions[i, coord] < lower[coord]:
+                lower[coord] = positions[i, coord]
+            if positions[i, coord] > upper[coord]:
+                upper[coord] = positions[i, coord]
+    for coord in range(3):
+        half = max(half, (upper[coord] - lower[coord]) / 2.0)
+    half = half * (1.0 + 1e-9) if half > 0.0 else 1.0
+    _octree_new_node(tree, -1, 0,
+                     (lower[0] + upper[0]) / 2.0,
+                     (lower[1] + upper[1]) / 2.0,
+                     (lower[2] + upper[2]) / 2.0,
+                     half)
 
+    # INSERT BODIES
+    for i in range(nr_of_bodies):
+        body = <int> i
+        tree.next_body[body] = -1
+        node = 0
+        depth = 0
+        while True:
+            if tree.first_body[node] == _BH_INTERNAL:
+                octant = _octant(tree, node, positions, body)
+                child = tree.child[8*node + octant]
+                if child == -1:
+                    child = _octree_add_child(tree, node, octant)
+                    tree.first_body[child] = body
+                    break
+                node = child
+                depth += 1
+            elif tree.first_body[node] == _BH_EMPTY:
+                tree.first_body[node] = body
+                break
+            elif depth >= _BH_MAX_DEPTH:
+                # (almost) coincident bodies share one leaf
+                tree.next_body[body] = tree.first_body[node]
+                tree.first_body[node] = body
+                break
+            else:
+                old = tree.first_body[node]
+                tree.first_body[node] = _BH_INTERNAL
+                octant = _octant(tree, node, positions, old)
+                child = _octree_add_child(tree, node, octant)
+                tree.first_body[child] = old
+
+    # MASS AND MASS FOCUS, children always have a larger index than their parent
+    for node in range(tree.nr_of_nodes - 1, -1, -1):
+        body = tree.first_body[node]
+        while body >= 0:
+            tree.node_mass[node] += mass[body]
+            for coord in range(3):
+                tree.mass_focus[3*node + coord] += mass[body] * positions[body, coord]
+            body = tree.next_body[body]
+        if tree.node_mass[node] > 0.0:
             for coord in range(3):
-                force[coord] = force[coord] + mass[j]/(abs_delta*abs_delta*abs_delta)*delta_pos[coord]
+                tree.mass_focus[3*node + coord] /= tree.node_mass[node]
+        parent = tree.parent[node]
+        if parent >= 0:
+            tree.node_mass[parent] += tree.node_mass[node]
+            for coord in range(3):
+                tree.mass_focus[3*parent + coord] += tree.node_mass[node] * tree.mass_focus[3*node + coord]
+    return 0
 
-        for j in range(3):
-            # G FORCE TO ACCELERATION
-            accel[j] = force[j] * G_CONSTANT
-            # NEXT LOCATION
-            positions[i][j] = positions[i][j] + timestep * speed[i][j] + (timestep*timestep/2.0) * accel[j]
-            # SPEED
-            speed[i][j] = speed[i][j] + timestep * accel[j]
 
-    return (positions, speed)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _bh_acceleration(_Octree *tree, double *positions, double *mass,
+                           int body, double theta_sq, double *accel) nogil:
+    """
+    Berechnet die Beschleunigung eines Körpers durch einen Baumdurchlauf.
+    Ein Knoten wird als Punktmasse genähert, wenn der Körper nicht in ihm
+    liegt und Kantenlänge / Abstand < theta gilt.
+
+    params:
+        tree: aufgebauter Barnes-Hut-Baum
+        positions: Zeiger auf das (N, 3) Positions-Array
+        mass: Zeiger auf das Massen-Array
+        body: Index des Körpers
+        theta_sq: Quadrat des Öffnungswinkels
+        accel: Ausgabe, 3 Komponenten
+    """
+    cdef int stack[_BH_STACK_SIZE]
+    cdef int top = 1
+    cdef int node, other, k, child
+    cdef double x = positions[3*body]
+    cdef double y = positions[3*body + 1]
+    cdef double z = positions[3*body + 2]
+    cdef double dx, dy, dz, dist_sq, inv_dist_cube, size, half
+    cdef double ax = 0.0
+    cdef double ay = 0.0
+    cdef double az = 0.0
+
+    stack[0] = 0
+    while top > 0:
+        top -= 1
+        node = stack[top]
+        other = tree.first_body[node]
+        if other >= 0:
+            while other >= 0:
+                if other != body:
+                    dx = positions[3*other] - x
+                    dy = positions[3*other + 1] - y
+                    dz = positions[3*other + 2] - z
+                    dist_sq = dx*dx + dy*dy + dz*dz
+                    if dist_sq > 0.0:
+                        inv_dist_cube = mass[other] / (dist_sq * sqrt(dist_sq))
+                        ax = ax + inv_dist_cube * dx
+                        ay = ay + inv_dist_cube * dy
+                        az = az + inv_dist_cube * dz
+                other = tree.next_body[other]
+        elif other == _BH_INTERNAL:
+            half = tree.half_size[node]
+            dx = tree.mass_focus[3*node] - x
+            dy = tree.mass_focus[3*node + 1] - y
+            dz = tree.mass_focus[3*node + 2] - z
+            dist_sq = dx*dx + dy*dy + dz*dz
+            size = 2.0 * half
+            if (size * size < theta_sq * dist_sq
+                    and (fabs(x - tree.center[3*node]) > half
+                         or fabs(y - tree.center[3*node + 1]) > half
+                         or fabs(z - tree.center[3*node + 2]) > half)):
+                inv_dist_cube = tree.node_mass[node] / (dist_sq * sqrt(dist_sq))
+                ax = ax + inv_dist_cube * dx
+                ay = ay + inv_dist_cube * dy
+                az = az + inv_dist_cube * dz
+            else:
+                for k in range(8):
+                    child = tree.child[8*node + k]
+                    if child != -1:
+                        stack[top] = child
+                        top += 1
+    accel[0] = G_CONSTANT * ax
+    accel[1] = G_CONSTANT * ay
+    accel[2] = G_CONSTANT * az
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-cdef _initialise_bodies(int nr_of_bodies, tuple mass_lim, tuple dis_lim, tuple rad_lim, double black_weight):
+cdef void _barnes_hut_accelerations(double[:, ::1] positions,
+                                    double[::1] mass,
+                                    double[:, ::1] accel,
+                                    double theta,
+                                    np.intp_t[::1] bodies) except *:
     """
-    Initialisiert eine Anzahl von Körpern mit zufälligen Massen
-    und Positionen. Außerdem wird jedem Planeten eine
-    Startgeschwindigkeit zugeteilt, sodass insgesamt ein
-    stabiles System entsteht.
+    Berechnet die Beschleunigungen der Körper bodies in O(log N) je Körper
+    über einen Barnes-Hut-Octree, der bei jedem Aufruf neu aufgebaut wird.
+
+    Genauigkeit über den Öffnungswinkel theta: 0 entspricht der exakten
+    direkten Summe, 0.5 ergibt typischerweise einen relativen Kraftfehler
+    von ~1% je Körper, 1.0 von einigen Prozent. Da das schwarze Loch
+    (Index 0) als eigenes Blatt immer exakt eingeht, ist der Fehler der
+    Gesamtbeschleunigung in Scheiben-Galaxien deutlich kleiner.
 
     params:
-        nr_of_bodies: Anzahl der zu generierenden Planeten
+        positions: NumPy-Array aller Positionen der Körper
+        mass: NumPy-Array aller Massen der Körper
+        accel: Ausgabe, NumPy-Array (N, 3) der Beschleunigungen
+        theta: Öffnungswinkel des Baums
+        bodies: Indizes der zu berechnenden Körper
     """
-    cdef double min_mass = mass_lim[0]
-    cdef double max_mass = mass_lim[1]
-    cdef double min_radius = rad_lim[0]
-    cdef double max_radius = rad_lim[1]
-    cdef double min_distance = dis_lim[0]
-    cdef double max_distance = dis_lim[1]
-    cdef double max_z = dis_lim[2]
+    cdef _Octree tree
+    cdef np.intp_t k, i
+    cdef double theta_sq = theta * theta
+    cdef double *pos_ptr = &positions[0, 0]
+    cdef double *mass_ptr = &mass[0]
 
-    black_hole_weight = black_weight
+    tree.nr_of_nodes = 0
+    tree.capacity = 0
+    tree.child = NULL
+    tree.first_body = NULL
+    tree.next_body = NULL
+    tree.parent = NULL
+    tree.center = NULL
+    tree.half_size = NULL
+    tree.node_mass = NULL
+    tree.mass_focus = NULL
+    try:
+        _build_octree(&tree, positions, mass)
+        # the tree is read-only from here on, so bodies are independent
+        for k in prange(bodies.shape[0], nogil=True, schedule='guided'):
+            i = bodies[k]
+            _bh_acceleration(&tree, pos_ptr, mass_ptr, <int> i, theta_sq, &accel[i, 0])
+    finally:
+        _octree_free(&tree)
 
-    cdef double[:, ::1] positions = np.zeros((nr_of_bodies+1, 3), dtype=np.float64)
-    cdef double[:, ::1] speed = np.zeros((nr_of_bodies+1, 3), dtype=np.float64)
+# FFT of the isolated Green's function per grid size, see _pm_green_function
+_PM_GREEN_CACHE = {}
 
-    cdef double[::1] radius = np.zeros((nr_of_bodies+1), dtype=np.float64)
-    cdef double[::1] mass = np.zeros((nr_of_bodies+1), dtype=np.float64)
-
-    cdef double[::1] tmp_speed = np.zeros((nr_of_bodies+1), dtype=np.float64)
-
-    ### VARIABLES NEEDED FOR THE CALCULATION OF ABSOLUTE SPEED
-    cdef double tot_mass_ignored = 0.0
-    cdef double tot_mass = 0.0
-    cdef double accumulator = 0.0
-    cdef double abs_delta
-    cdef double[::1] tmp_loc = np.zeros(3, dtype=np.float64)
-    cdef double[::1] delta_pos = np.zeros(3, dtype=np.float64)
-    cdef double abs_speed
-
-    ### VARIABLES NEEDED FOR THE CALCULATION OF SPEED DIRECTION
-    cdef int[::1] z_vector = np.array([0, 0, 1], dtype=np.int32)
-    cdef double[::1] cross_product = np.zeros(3, dtype=np.float64)
-
-    # Black Hole
-    positions[0][0] = 0
-    positions[0][1] = 0
-    positions[0][2] = 0
-    speed[0][0] = 0
-    speed[0][1] = 0
-    speed[0][2] = 0
-    mass[0] = black_hole_weight
-    radius[0] = max_radius
 
-    cdef np.intp_t i, j
+def _pm_green_function(int grid_size):
+    """
+    Berechnet die Fouriertransformierte des Greenschen Kerns -1/r für
+    eine Zellgröße von 1 auf dem doppelt so großen Gitter (isolierte
+    Randbedingungen nach Hockney-Eastwood, keine periodischen Bilder).
+    Der Kern ist mit einer halben Zelle geglättet.
 
-    for i in range(1, nr_of_bodies+1):
-    	# Note: y_pos gets randomly generated between the min distance and
-        #       the distance so that the length of the (x, y) vector
-        #       is never longer than max_distance.
-        x_pos = (((rand() / (RAND_MAX + 1.0))*(max_distance-min_distance))+min_distance)*_get_sign()
-        y_pos = (((rand() / (RAND_MAX + 1.0))*(sqrt(max_distance**2 - x_pos**2))+min_radius))*_get_sign()
-        z_pos = ((rand() / (RAND_MAX + 1.0))*(max_z))*_get_sign()
+    params:
+        grid_size: Anzahl der Zellen je Achse
+    return:
+        rfftn des Kerns, wird je grid_size zwischengespeichert
+    """
+    if grid_size not in _PM_GREEN_CACHE:
+        cells = np.arange(2 * grid_size, dtype=np.float64)
+        cells = np.minimum(cells, 2 * grid_size - cells)
+        dist_sq = (cells[:, None, None]**2
+                   + cells[None, :, None]**2
+                   + cells[None, None, :]**2)
+        green = -1.0 / np.sqrt(dist_sq + 0.25)
+        _PM_GREEN_CACHE[grid_size] = np.fft.rfftn(green)
+    return _PM_GREEN_CACHE[grid_size]
 
-        positions[i][0] = x_pos
-        positions[i][1] = y_pos
-        positions[i][2] = z_pos
 
-        mass[i] = (((rand() / (RAND_MAX + 1.0))*(max_mass-min_mass))+min_mass)
-        radius[i] = (((rand() / (RAND_MAX + 1.0))*(max_radius-min_radius))+min_radius)
+def _pm_accelerations(positions, mass, int grid_size, bint direct_black_hole):
+    """
+    Berechnet die Beschleunigungen aller Körper mit der Particle-Mesh-Methode:
+    Massen werden per Cloud-in-Cell auf ein 3D-Gitter verteilt, die
+    Poisson-Gleichung wird per FFT gelöst und die Beschleunigung wieder
+    per Cloud-in-Cell auf die Körper interpoliert.
 
-    print("generated planets")
+    params:
+        positions: NumPy-Array aller Positionen der Körper
+        mass: NumPy-Array aller Massen der Körper
+        grid_size: Anzahl der Zellen je Achse
+        direct_black_hole: das schwarze Loch (Index 0) nicht auf das Gitter
+            legen, sondern seine Anziehung exakt direkt addieren (P3M)
+    return:
+        NumPy-Array (N, 3) der Beschleunigungen
+    """
+    positions = np.asarray(positions)
+    mass = np.asarray(mass)
+    cdef int n = grid_size
+    cdef int corner
 
-    # CALCULATING TOTAL MASS
-    for i in range(nr_of_bodies):
-        tot_mass += mass[i]
-
-    for i in range(1, nr_of_bodies+1):
-        # ABSOLUTE SPEED CALCULATION STARTS HERE
-        tot_mass_ignored = 0.0
-        tmp_loc[0] = 0.0
-        tmp_loc[1] = 0.0
-        tmp_loc[2] = 0.0
-        for j in range(nr_of_bodies+1):
-            if j == i:
-                continue
-            tot_mass_ignored += mass[j]
-            tmp_loc[0] = tmp_loc[0] + mass[j] * positions[j][0]
-            tmp_loc[1] = tmp_loc[1] + mass[j] * positions[j][1]
-            tmp_loc[2] = tmp_loc[2] + mass[j] * positions[j][2]
+    # CUBE AROUND ALL BODIES, TWO CELLS MARGIN AT EVERY BORDER: the cloud
+    # in cell weights of the outermost bodies reach into the second cell,
+    # the first stays empty so every used cell has a centred gradient
+    lower = positions.min(axis=0)
+    upper = positions.max(axis=0)
+    extent = max((upper - lower).max(), 1.0)
+    cell = extent / (n - 4)
+    origin = (lower + upper) / 2.0 - cell * n / 2.0
 
-        accumulator = 0.0
-        for j in range(3):
-            tmp_loc[j] = tmp_loc[j] / tot_mass_ignored
-            delta_pos[j] = positions[i][j] - tmp_loc[j]
-            accumulator += delta_pos[j] * delta_pos[j]
-        abs_delta = sqrt(accumulator)
-        abs_speed = (tot_mass_ignored/tot_mass)*sqrt(G_CONSTANT*tot_mass/abs_delta)
-
-        # SPEED DIRECTION CALCULATION STARTS HERE
-        cross_product = np.cross(delta_pos, z_vector)
-        accumulator = 0.0
-        for j in range(3):
-            accumulator += cross_product[j]*cross_product[j]
-        accumulator = sqrt(accumulator)
+    # CLOUD IN CELL WEIGHTS (cell centred)
+    grid_pos = (positions - origin) / cell - 0.5
+    base = np.floor(grid_pos).astype(np.intp)
+    frac = grid_pos - base
+    weights = []
+    indices = []
+    for corner in range(8):
+        offset = np.array([corner & 1, (corner >> 1) & 1, (corner >> 2) & 1])
+        weights.append(np.prod(np.where(offset, frac, 1.0 - frac), axis=1))
+        indices.append(np.ravel_multi_index((base + offset).T, (n, n, n)))
 
-        speed[i][0] = cross_product[0] / accumulator * abs_speed
-        speed[i][1] = cross_product[1] / accumulator * abs_speed
-        speed[i][2] = cross_product[2] / accumulator * abs_speed
+    mesh_mass = mass.copy()
+    if direct_black_hole:
+        mesh_mass[0] = 0.0
+    density = np.zeros(n**3, dtype=np.float64)
+    for corner in range(8):
+        density += np.bincount(indices[corner],
+                               weights=mesh_mass * weights[corner],
+                               minlength=n**3)
 
-    print("calculated starting speeds")
+    # POISSON: CONVOLUTION WITH -G/r ON THE ZERO PADDED GRID
+    shape = (2 * n, 2 * n, 2 * n)
+    potential = np.fft.irfftn(np.fft.rfftn(density.reshape(n, n, n), s=shape, axes=(0, 1, 2))
+                              * _pm_green_function(n), s=shape, axes=(0, 1, 2))
+    potential = potential[:n, :n, :n] * (G_CONSTANT / cell)
+
+    # ACCELERATION = -GRAD(POTENTIAL), BACK TO THE BODIES
+    accel = np.zeros((mass.shape[0], 3), dtype=np.float64)
+    for coord, gradient in enumerate(np.gradient(potential, cell)):
+        gradient = gradient.ravel()
+        for corner in range(8):
+            accel[:, coord] -= weights[corner] * gradient[indices[corner]]
+
+    if direct_black_hole:
+        delta_pos = positions[0] - positions
+        dist = np.linalg.norm(delta_pos, axis=1)
+        dist[0] = np.inf
+        accel += (G_CONSTANT * mass[0] / dist**3)[:, None] * delta_pos
+    return accel
+
+
+cpdef void _accelerations(str engine,
+                          double[:, ::1] positions,
+                          double[::1] mass,
+                          double[:, ::1] accel,
+                          np.intp_t[::1] bodies=None,
+                          double theta=sc.DEFAULT_THETA,
+                          int grid_size=sc.DEFAULT_GRID_SIZE,
+                          bint direct_black_hole=True,
+                          bint single_precision=False) except *:
+    """
+    Berechnet die Beschleunigungen mit der gewählten Kraftberechnung.
+
+    params:
+        engine: einer der Werte aus simulation_constants.ENGINES
+        positions: NumPy-Array aller Positionen der Körper
+        mass: NumPy-Array aller Massen der Körper
+        accel: Ausgabe, NumPy-Array (N, 3) der Beschleunigungen
+        bodies: Indizes der zu berechnenden Körper, None für alle außer
+            dem schwarzen Loch. Die direkten Summen rechnen dann mit
+            _direct_accelerations_of, Particle-Mesh löst immer das ganze Gitter.
+        theta: Öffnungswinkel, nur für den Barnes-Hut-Baum
+        grid_size: Zellen je Achse, nur für Particle-Mesh
+        direct_black_hole: schwarzes Loch exakt addieren, nur für Particle-Mesh
+        single_precision: float32-Kopie der Positionen, nur für direct_tiled
+    """
+    if engine == sc.ENGINE_BARNES_HUT:
+        if bodies is None:
+            bodies = np.arange(1, mass.shape[0], dtype=np.intp)
+        _barnes_hut_accelerations(positions, mass, accel, theta, bodies)
+    elif engine == sc.ENGINE_PARTICLE_MESH:
+        mesh_accel = _pm_accelerations(positions, mass, grid_size, direct_black_hole)
+        if bodies is None:
+            np.asarray(accel)[1:] = mesh_accel[1:]
+        else:
+            np.asarray(accel)[bodies] = mesh_accel[bodies]
+    elif bodies is not None:
+        with nogil:
+            _direct_accelerations_of(positions, mass, accel, bodies)
+    elif engine == sc.ENGINE_DIRECT_SYMMETRIC:
+        _symmetric_accelerations(positions, mass, accel)
+    elif engine == sc.ENGINE_DIRECT_TILED:
+        _soa_accelerations(positions, mass, accel, single_precision)
+    else:
+        with nogil:
+            _direct_accelerations(positions, mass, accel, 1, mass.shape[0])
+
+
+cpdef void _move_bodies(str engine,
+                        double[:, ::1] positions,
+                        double[:, ::1] speed,
+                        double[::1] mass,
+                        double timestep,
+                        double theta=sc.DEFAULT_THETA,
+                        int grid_size=sc.DEFAULT_GRID_SIZE,
+                        bint direct_black_hole=True,
+                        bint single_precision=False) except *:
+    """
+    Führt einen Simulationsschritt mit der gewählten Kraftberechnung aus:
+    erst alle Beschleunigungen, dann die Integration.
+
+    params:
+        engine: einer der Werte aus simulation_constants.ENGINES
+        theta: Öffnungswinkel, nur für den Barnes-Hut-Baum
+        grid_size: Zellen je Achse, nur für Particle-Mesh
+        direct_black_hole: schwarzes Loch exakt addieren, nur für Particle-Mesh
+        single_precision: float32-Kopie der Positionen, nur für direct_tiled
+    """
+    if engine == sc.ENGINE_DIRECT:
+        _move_bodies_circle(positions, speed, mass, timestep)
+        return
+
+    cdef double[:, ::1] accel = np.zeros((mass.shape[0], 3), dtype=np.float64)
+
+    _accelerations(engine, positions, mass, accel, None, theta,
+                   grid_size, direct_black_hole, single_precision)
+    with nogil:
+        _integrate(positions, speed, accel, timestep, 1, mass.shape[0])
+
+
+def _timestep_levels(positions, black_hole, accel, double timestep,
+                     int max_level, double eta):
+    """
+    Ordnet Körpern eine Zeitschrittstufe k mit der Schrittweite
+    timestep / 2^k zu. Gewünscht ist eta * sqrt(r / |a|) mit dem Abstand r
+    zum schwarzen Loch, also der Anteil eta einer Umlaufzeit / 2 pi.
+
+    params:
+        positions: NumPy-Array der Positionen der Körper
+        black_hole: Position des schwarzen Lochs
+        accel: NumPy-Array der Beschleunigungen der Körper
+        timestep: längste Schrittweite (Stufe 0)
+        max_level: feinste Stufe
+        eta: Genauigkeitsparameter
+    return:
+        NumPy-Array der Stufen
+    """
+    dist = np.linalg.norm(positions - black_hole, axis=1)
+    accel_abs = np.linalg.norm(accel, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        levels = np.ceil(np.log2(timestep / (eta * np.sqrt(dist / accel_abs))))
+    levels = np.nan_to_num(levels, nan=0.0, posinf=max_level, neginf=0.0)
+    return np.clip(levels, 0, max_level).astype(np.intp)
+
+
+cpdef void _move_bodies_block(str engine,
+                              double[:, ::1] positions,
+                              double[:, ::1] speed,
+                              double[::1] mass,
+                              double[:, ::1] accel,
+                              double timestep,
+                              int max_level,
+                              double eta=sc.DEFAULT_ETA,
+                              double theta=sc.DEFAULT_THETA,
+                              int grid_size=sc.DEFAULT_GRID_SIZE,
+                              bint direct_black_hole=True,
+                              bint single_precision=False) except *:
+    """
+    Rückt alle Körper mit hierarchischen Block-Zeitschritten um timestep
+    vor (Kick-Drift-Kick-Leapfrog). Jeder Körper rechnet auf einer Stufe
+    k mit der Schrittweite timestep / 2^k, siehe _timestep_levels. In
+    jedem der 2^max_level Teilschritte werden alle Körper bewegt, aber
+    nur für die Körper neue Kräfte berechnet, deren Schritt gerade endet.
+    Die Stufe eines Körpers wechselt nur an Zeitpunkten, die auch auf
+    dem Raster der neuen Stufe liegen.
+
+    params:
+        engine: einer der Werte aus simulation_constants.ENGINES
+        positions: NumPy-Array aller Positionen der Körper
+        speed: NumPy-Array aller Geschwindigkeiten der Körper
+        mass: NumPy-Array aller Massen der Körper
+        accel: Beschleunigungen zu den aktuellen Positionen, enthält
+            danach die Beschleunigungen zu den neuen Positionen
+        timestep: Anzahl der Sekunden des ganzen Blockschritts
+        max_level: feinste Stufe, also höchstens 2^max_level Teilschritte
+        eta: Genauigkeitsparameter, siehe _timestep_levels
+        theta, grid_size, direct_black_hole, single_precision:
+            siehe _accelerations
+    """
+    pos = np.asarray(positions)
+    vel = np.asarray(speed)
+    acc = np.asarray(accel)
+    cdef long nr_of_substeps = 1 << max_level
+    cdef long sub
+    cdef double substep = timestep / nr_of_substeps
+
+    # the black hole at index 0 does not move
+    bodies = np.arange(1, mass.shape[0], dtype=np.intp)
+    levels = _timestep_levels(pos[1:], pos[0], acc[1:], timestep, max_level, eta)
+
+    # OPENING HALF KICK
+    vel[1:] += acc[1:] * (timestep / 2.0**(levels + 1))[:, None]
+    for sub in range(1, nr_of_substeps + 1):
+        # DRIFT
+        pos[1:] += vel[1:] * substep
+
+        # bodies whose step ends now
+        ending = sub % (1 << (max_level - levels)) == 0
+        if ending.all():
+            active = bodies
+            _accelerations(engine, positions, mass, accel, None, theta,
+                           grid_size, direct_black_hole, single_precision)
+        else:
+            active = bodies[ending]
+            _accelerations(engine, positions, mass, accel, active, theta,
+                           grid_size, direct_black_hole, single_precision)
+
+        # CLOSING HALF KICK
+        vel[active] += acc[active] * (timestep / 2.0**(levels[ending] + 1))[:, None]
+        if sub == nr_of_substeps:
+            break
+
+        # NEW LEVEL, its stride has to divide sub
+        new_levels = _timestep_levels(pos[active], pos[0], acc[active],
+                                      timestep, max_level, eta)
+        new_levels = np.maximum(new_levels, max_level - ((sub & -sub).bit_length() - 1))
+        levels[ending] = new_levels
+
+        # OPENING HALF KICK
+        vel[active] += acc[active] * (timestep / 2.0**(new_levels + 1))[:, None]
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cpdef void _accelerations_jerks(double[:, ::1] positions,
+                                double[:, ::1] speed,
+                                double[::1] mass,
+                                double[:, ::1] accel,
+                                double[:, ::1] jerk) except *:
+    """
+    Beschleunigungen und Rucke aller Körper außer dem schwarzen Loch,
+    siehe _direct_accelerations_jerks.
+    """
+    with nogil:
+        _direct_accelerations_jerks(positions, speed, mass, accel, jerk,
+                                    1, mass.shape[0])
+
+
+def _initial_step(positions, accel, double eta):
+    """
+    Erste Schrittweite von _move_bodies_verlet, solange noch keine
+    Fehlerschätzung vorliegt: eta mal die kleinste dynamische Zeit
+    sqrt(r / |a|) der Körper zum schwarzen Loch.
+
+    params:
+        positions: NumPy-Array aller Positionen der Körper
+        accel: NumPy-Array aller Beschleunigungen der Körper
+        eta: Genauigkeitsparameter
+    return:
+        Schrittweite in Sekunden
+    """
+    positions = np.asarray(positions)
+    dist = np.linalg.norm(positions[1:] - positions[0], axis=1)
+    accel_abs = np.linalg.norm(np.asarray(accel)[1:], axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return float(np.nanmin(eta * np.sqrt(dist / accel_abs)))
+
+
+cpdef double _move_bodies_verlet(str engine,
+                                 double[:, ::1] positions,
+                                 double[:, ::1] speed,
+                                 double[::1] mass,
+                                 double[:, ::1] accel,
+                                 double timestep,
+                                 double step,
+                                 double eta=sc.DEFAULT_ETA,
+                                 double theta=sc.DEFAULT_THETA,
+                                 int grid_size=sc.DEFAULT_GRID_SIZE,
+                                 bint direct_black_hole=True,
+                                 bint single_precision=False) except -1:
+    """
+    Rückt alle Körper mit Velocity-Verlet (Kick-Drift-Kick) um timestep
+    vor, in so vielen Schritten wie die Fehlerschätzung verlangt. Nach
+    jedem Schritt h folgt die nächste Schrittweite aus der Änderung der
+    Beschleunigung: eta * |a| / |da/dt| als Minimum über alle Körper,
+    höchstens doppelt so groß wie die letzte.
+
+    params:
+        engine: einer der Werte aus simulation_constants.ENGINES
+        positions: NumPy-Array aller Positionen der Körper
+        speed: NumPy-Array aller Geschwindigkeiten der Körper
+        mass: NumPy-Array aller Massen der Körper
+        accel: Beschleunigungen zu den aktuellen Positionen, enthält
+            danach die Beschleunigungen zu den neuen Positionen
+        timestep: Anzahl der Sekunden, um die vorgerückt wird
+        step: vorgeschlagene Schrittweite, 0 wenn noch keine bekannt ist
+        eta: Genauigkeitsparameter
+        theta, grid_size, direct_black_hole, single_precision:
+            siehe _accelerations
+    return:
+        vorgeschlagene Schrittweite für den nächsten Aufruf
+    """
+    pos = np.asarray(positions)[1:]
+    vel = np.asarray(speed)[1:]
+    acc = np.asarray(accel)[1:]
+    cdef double elapsed = 0.0
+    cdef double h
+
+    if step <= 0.0:
+        step = _initial_step(positions, accel, eta)
+    while elapsed < timestep:
+        h = min(step, timestep - elapsed)
+        old_acc = acc.copy()
+        # KICK, DRIFT
+        vel += acc * (h / 2.0)
+        pos += vel * h
+        _accelerations(engine, positions, mass, accel, None, theta,
+                       grid_size, direct_black_hole, single_precision)
+        # KICK
+        vel += acc * (h / 2.0)
+        elapsed += h
+
+        # NEXT STEP FROM THE CHANGE OF THE ACCELERATION
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = np.linalg.norm(acc, axis=1) / np.linalg.norm(acc - old_acc, axis=1)
+        step = min(2.0 * step, eta * h * float(np.nanmin(ratio)))
+    return step
+
+
+cpdef double _move_bodies_hermite(double[:, ::1] positions,
+                                  double[:, ::1] speed,
+                                  double[::1] mass,
+                                  double[:, ::1] accel,
+                                  double[:, ::1] jerk,
+                                  double timestep,
+                                  double step,
+                                  double eta=sc.DEFAULT_ETA) except -1:
+    """
+    Rückt alle Körper mit dem Hermite-Integrator 4. Ordnung
+    (Prädiktor-Korrektor nach Makino & Aarseth 1992) um timestep vor,
+    die Kräfte kommen exakt aus der direkten Summe. Die nächste
+    Schrittweite folgt dem Aarseth-Kriterium
+    sqrt(eta * (|a| |a2| + |a1|^2) / (|a1| |a3| + |a2|^2)) mit den
+    Ableitungen a1, a2, a3 der Beschleunigung, als Minimum über alle
+    Körper und höchstens doppelt so groß wie die letzte.
+
+    params:
+        positions: NumPy-Array aller Positionen der Körper
+        speed: NumPy-Array aller Geschwindigkeiten der Körper
+        mass: NumPy-Array aller Massen der Körper
+        accel, jerk: Beschleunigungen und Rucke zum aktuellen Zustand,
+            siehe _accelerations_jerks, enthalten danach die zum neuen
+        timestep: Anzahl der Sekunden, um die vorgerückt wird
+        step: vorgeschlagene Schrittweite, 0 wenn noch keine bekannt ist
+        eta: Genauigkeitsparameter
+    return:
+        vorgeschlagene Schrittweite für den nächsten Aufruf
+    """
+    pos = np.asarray(positions)[1:]
+    vel = np.asarray(speed)[1:]
+    acc = np.asarray(accel)[1:]
+    jrk = np.asarray(jerk)[1:]
+    cdef double elapsed = 0.0
+    cdef double h
+
+    if step <= 0.0:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            step = eta * float(np.nanmin(np.linalg.norm(acc, axis=1)
+                                         / np.linalg.norm(jrk, axis=1)))
+    while elapsed < timestep:
+        h = min(step, timestep - elapsed)
+        old_pos = pos.copy()
+        old_vel = vel.copy()
+        old_acc = acc.copy()
+        old_jrk = jrk.copy()
+        # PREDICT
+        pos += h * (vel + h * (acc / 2.0 + h * jrk / 6.0))
+        vel += h * (acc + h * jrk / 2.0)
+        _accelerations_jerks(positions, speed, mass, accel, jerk)
+
+        # CORRECT WITH THE INTERPOLATED 2ND AND 3RD DERIVATIVE
+        snap = (-6.0 * (old_acc - acc) - h * (4.0 * old_jrk + 2.0 * jrk)) / h**2
+        crackle = (12.0 * (old_acc - acc) + 6.0 * h * (old_jrk + jrk)) / h**3
+        vel[:] = vel + h**3 * (snap / 6.0 + h * crackle / 24.0)
+        pos[:] = pos + h**4 * (snap / 24.0 + h * crackle / 120.0)
+        elapsed += h
+
+        # NEXT STEP, AARSETH CRITERION AT THE END OF THE STEP
+        snap += h * crackle
+        acc_abs = np.linalg.norm(acc, axis=1)
+        jrk_abs = np.linalg.norm(jrk, axis=1)
+        snap_abs = np.linalg.norm(snap, axis=1)
+        crackle_abs = np.linalg.norm(crackle, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = (acc_abs * snap_abs + jrk_abs**2) / (jrk_abs * crackle_abs + snap_abs**2)
+        step = min(2.0 * step, float(np.sqrt(eta * np.nanmin(ratio))))
+    return step
+
+
+cpdef tuple _initialise_bodies(int nr_of_bodies, tuple mass_lim, tuple dis_lim, tuple rad_lim, double black_weight,
+                               str profile=sc.PROFILE_UNIFORM, seed=None):
+    """
+    Initialisiert eine Anzahl von Körpern mit zufälligen Massen
+    und Positionen. Außerdem wird jedem Planeten eine
+    Startgeschwindigkeit zugeteilt, sodass insgesamt ein
+    stabiles System entsteht. Die Körper werden mit NumPy in O(N)
+    erzeugt, siehe initial_conditions.
 
+    params:
+        nr_of_bodies: Anzahl der zu generierenden Planeten
+        profile: Verteilung, eine aus simulation_constants.PROFILES
+        seed: Startwert des Zufallsgenerators (None = zufällig)
+    """
+    positions, speed, radius, mass = initialise_bodies(nr_of_bodies, mass_lim, dis_lim,
+                                                       rad_lim, black_weight, profile, seed)
+    print("generated planets")
+    print("calculated starting speeds")
     return positions, speed, radius, mass
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-cdef int _get_sign():
+cpdef void _density_grid(double[:, ::1] positions,
+                         double[::1] mass,
+                         double extent,
+                         double[:, ::1] grid) except *:
     """
-    Generiert ein zufälliges Vorzeichen -/+
-    um bei der Initialisierung alle 4 Quadranten
-    mit Planeten zu füllen.
+    Verteilt die Massen der Körper (ohne schwarzes Loch) auf ein 2D
+    Gitter in der x-y-Ebene, das den Bereich -extent bis extent abdeckt.
+    Körper außerhalb werden ignoriert. Jeder Thread zählt in ein eigenes
+    Gitter, die Gitter werden anschließend parallel aufsummiert.
 
+    params:
+        positions: NumPy-Array aller Positionen der Körper
+        mass: NumPy-Array aller Massen der Körper
+        extent: halbe Kantenlänge des abgedeckten Bereichs
+        grid: Ausgabe, NumPy-Array (G, G) der Massen je Zelle,
+            Zeile = y, Spalte = x
+    """
+    cdef int nr_of_threads = _omp_get_max_threads()
+    cdef np.intp_t size = grid.shape[0]
+    cdef double[:, :, ::1] buffers = np.zeros((nr_of_threads, size, size), dtype=np.float64)
+    cdef double cells_per_unit = size / (2.0 * extent)
+    cdef double cell_x, cell_y, total
+    cdef np.intp_t i, row, column
+    cdef int thread
+
+    with nogil, parallel(num_threads=nr_of_threads):
+        thread = threadid()
+        for i in prange(1, mass.shape[0], schedule='static'):
+            cell_x = (positions[i, 0] + extent) * cells_per_unit
+            cell_y = (positions[i, 1] + extent) * cells_per_unit
+            if cell_x < 0.0 or cell_y < 0.0 or cell_x >= size or cell_y >= size:
+                continue
+            row = <np.intp_t>cell_y
+            column = <np.intp_t>cell_x
+            buffers[thread, row, column] = buffers[thread, row, column] + mass[i]
+
+    # REDUCTION OF THE THREAD BUFFERS
+    for row in prange(size, nogil=True, schedule='static'):
+        for column in range(size):
+            total = 0.0
+            for thread in range(nr_of_threads):
+                total = total + buffers[thread, row, column]
+            grid[row, column] = total
+
+
+def _spread_bits(cells):
+    """
+    Verteilt die unteren 21 Bit jedes Werts auf jedes dritte Bit
+    eines 64-Bit-Worts (Vorbereitung für den Morton-Schlüssel).
+
+    params:
+        cells: NumPy-Array vom Typ uint64
+    """
+    cells = cells & np.uint64(0x1fffff)
+    cells = (cells | cells << np.uint64(32)) & np.uint64(0x1f00000000ffff)
+    cells = (cells | cells << np.uint64(16)) & np.uint64(0x1f0000ff0000ff)
+    cells = (cells | cells << np.uint64(8)) & np.uint64(0x100f00f00f00f00f)
+    cells = (cells | cells << np.uint64(4)) & np.uint64(0x10c30c30c30c30c3)
+    cells = (cells | cells << np.uint64(2)) & np.uint64(0x1249249249249249)
+    return cells
+
+
+def _morton_keys(positions):
+    """
+    Berechnet für jeden Körper den Morton-Schlüssel (Z-Kurve) seiner
+    Position in einem Würfel um alle Körper mit 2^21 Zellen je Achse.
+    Im Raum benachbarte Körper haben meist benachbarte Schlüssel.
+
+    params:
+        positions: NumPy-Array aller Positionen der Körper
     return:
-        +1 / -1
+        NumPy-Array der Schlüssel (uint64)
+    """
+    positions = np.asarray(positions)
+    lower = positions.min(axis=0)
+    extent = (positions.max(axis=0) - lower).max()
+    if extent <= 0.0:
+        extent = 1.0
+    cells = ((positions - lower) * ((2**21 - 1) / extent)).astype(np.uint64)
+    return (_spread_bits(cells[:, 0])
+            | _spread_bits(cells[:, 1]) << np.uint64(1)
+            | _spread_bits(cells[:, 2]) << np.uint64(2))
+
+
+def _sort_bodies(positions, speed, mass, radius, order, *extra):
+    """
+    Sortiert alle Körper-Arrays an Ort und Stelle entlang der Morton-Kurve,
+    damit im Raum benachbarte Körper auch im Speicher nah beieinander
+    liegen. Das schwarze Loch bleibt an Index 0.
+
+    params:
+        positions, speed, mass, radius: Arrays aller Körper
+        order: Array mit der ursprünglichen Nummer jedes Körpers,
+            wird mitsortiert
+        extra: weitere Arrays je Körper, die mitsortiert werden
+    """
+    positions = np.asarray(positions)
+    permutation = np.argsort(_morton_keys(positions[1:]), kind='stable') + 1
+    for array in (positions, np.asarray(speed), np.asarray(mass),
+                  np.asarray(radius), np.asarray(order)) + tuple(np.asarray(a) for a in extra):
+        array[1:] = array[permutation]
+
+
+def _frame(positions, radius, order, double scale, frame=None):
+    """
+    Erzeugt das (N, 4) Array aus Positionen und Radien für den Renderer,
+    in der ursprünglichen Reihenfolge der Körper.
+
+    params:
+        positions, radius: Arrays aller Körper (evtl. umsortiert)
+        order: ursprüngliche Nummer jedes Körpers
+        scale: Skalierungsfaktor für die Ausgabe
+        frame: optionales (N, 4) Zielarray, z.B. ein FrameBuffer-Slot
     """
-    return 1 if (<double>rand()/<double>RAND_MAX) >= 0.5 else -1
+    if frame is None:
+        frame = np.empty((len(order), 4), dtype=np.float64)
+    frame[order, :3] = positions
+    frame[order, 3] = radius
+    frame *= scale
+    return frame
 
 
-cpdef void startup(sim_pipe, int nr_of_bodies, tuple mass_lim, tuple dis_lim, tuple rad_lim, black_weight, double timestep):
+cpdef tuple startup(sim_pipe, int nr_of_bodies, tuple mass_lim, tuple dis_lim, tuple rad_lim, black_weight, double timestep,
+                   str engine=sc.ENGINE_DIRECT, double theta=sc.DEFAULT_THETA,
+                   int grid_size=sc.DEFAULT_GRID_SIZE, bint direct_black_hole=True,
+                   int nr_of_threads=0, bint single_precision=False,
+                   int reorder_every=sc.DEFAULT_REORDER_EVERY,
+                   int block_levels=0, double eta=sc.DEFAULT_ETA,
+                   str integrator=sc.INTEGRATOR_EULER,
+                   bint shared_frames=True, int publish_every=1,
+                   double max_publish_rate=0.0, int density_grid=0,
+                   tuple distributed=None, bint distributed_ring=False,
+                   int nr_of_processes=0, long nr_of_steps=0,
+                   str record_path=None, int record_every=1, long record_capacity=0,
+                   bint record_radius=False, int record_bits=0,
+                   str profile=sc.PROFILE_UNIFORM, seed=None):
     """
         Initialise and continuously update a position list.
 
         Results are sent through a pipe after each update step
 
         Args:
-            sim_pipe (multiprocessing.Pipe): Pipe to send results
+            sim_pipe (multiprocessing.Pipe): Pipe to send results, None runs
+                headless without publishing frames
             delta_t (float): Simulation step width.
+            engine (str): Force calculation, one of simulation_constants.ENGINES
+                ('direct' is the exact O(N^2) sum, 'direct_symmetric' the same
+                sum with every pair evaluated once, 'direct_tiled' the cache
+                blocked structure-of-arrays sum, 'barnes_hut' the O(N log N)
+                tree and 'particle_mesh' the FFT grid solver)
+            theta (float): Barnes-Hut opening angle, the accuracy knob of the
+                tree: 0 is exact, 0.5 gives ~1% and 1.0 a few % force error
+                from the bodies (the black hole is always exact).
+            grid_size (int): Particle-mesh cells per axis
+            direct_black_hole (bool): Particle-mesh only, add the black hole
+                at index 0 as exact direct-sum term instead of depositing it
+                on the mesh (P3M short-range correction)
+            nr_of_threads (int): OpenMP threads, 0 keeps the default
+            single_precision (bool): 'direct_tiled' only, keep the copy of
+                the positions used for the forces in float32
+            reorder_every (int): Re-sort the bodies along a Morton curve
+                every that many steps for memory locality (0 = never).
+                Frames are always sent in the original body order.
+            block_levels (int): Use hierarchical block timesteps with up to
+                2^block_levels substeps per step; bodies close to the black
+                hole get smaller steps and only bodies whose substep ends get
+                new forces (0 = one timestep for all bodies). Always
+                integrates with leapfrog, not allowed with 'hermite'.
+            eta (float): Accuracy of the adaptive timesteps, roughly the
+                fraction of an orbital period / 2 pi a body may move per step
+            integrator (str): One of simulation_constants.INTEGRATORS:
+                'euler' does one first-order step per timestep, 'verlet'
+                (2nd order) and 'hermite' (4th order, direct engines only)
+                choose their own step size from eta and take as many steps
+                as needed per timestep
+            shared_frames (bool): Write frames into a shared-memory
+                frame_buffer.FrameBuffer whose descriptor is sent through
+                the pipe once, instead of pickling every frame into the pipe
+            publish_every (int): Publish only every that many steps
+            max_publish_rate (float): Publish at most that many frames per
+                second, further steps are computed but not sent (0 = no
+                limit). Keeps the physics loop from waiting on a slower
+                renderer.
+            density_grid (int): Publish a density_grid x density_grid mass
+                histogram of the x-y plane instead of the bodies, for the
+                'density' mode of the renderer. The frame size no longer
+                depends on the number of bodies (0 = publish the bodies).
+            distributed (tuple): (listen_ip, listen_socket, nr_of_workers),
+                listen for that many distributedWorker processes and split
+                the direct sum of every step over them. Needs the 'direct'
+                engine and 'euler' integrator.
+            distributed_ring (bool): Let the distributed workers pass the
+                new positions around a ring among themselves instead of
+                through this process, which then only receives the
+                positions for published frames and before re-sorting.
+            nr_of_processes (int): Split the direct sum of every step over
+                that many local processes sharing the bodies in memory, for
+                builds without OpenMP (0 = compute in this process). Needs
+                the 'direct' engine and 'euler' integrator.
+            nr_of_steps (int): Return after that many steps (0 = run until
+                END_MESSAGE arrives)
+            record_path (str): Record positions and speeds into this
+                memory-mapped trajectory_recorder file (None = no recording)
+            record_every (int): Record only every that many steps
+            record_capacity (int): Frames the recording can hold, later
+                ones are dropped with a warning (0 = enough for nr_of_steps)
+            record_radius (bool): Also record the radius of every body
+            record_bits (int): Write a compressed trajectory_archive with
+                positions quantized to that many bits relative to
+                dis_lim[1] instead of the memory-mapped recording (0 = raw
+                float64 positions and speeds)
+            profile (str): Initial distribution of the bodies, one of
+                simulation_constants.PROFILES ('uniform' is the original
+                distribution, 'exponential_disk' a disk galaxy,
+                'plummer' a Plummer sphere and 'collision' two disks with
+                a black hole each falling into each other)
+            seed (int): Seed of the initial bodies, None draws a new system
+                every run
+        Returns:
+            (steps, seconds spent in the simulation loop, recorded frames
+            that were dropped) once nr_of_steps is reached
     """
+    if engine not in sc.ENGINES:
+        raise ValueError('unknown engine: {}'.format(engine))
+    if profile not in sc.PROFILES:
+        raise ValueError('unknown profile: {}'.format(profile))
+    if grid_size < 8:
+        raise ValueError('grid_size has to be at least 8')
+    if distributed is not None and (engine != sc.ENGINE_DIRECT
+                                    or integrator != sc.INTEGRATOR_EULER
+                                    or block_levels > 0):
+        raise ValueError('distributed runs need the direct engine and the euler integrator')
+    if nr_of_processes > 0 and (engine != sc.ENGINE_DIRECT
+                                or integrator != sc.INTEGRATOR_EULER
+                                or block_levels > 0 or distributed is not None):
+        raise ValueError('nr_of_processes needs the direct engine and the euler integrator '
+                         'and can not be combined with distributed')
+    if nr_of_steps < 0:
+        raise ValueError('nr_of_steps must not be negative')
+    if record_path is not None:
+        if record_every < 1:
+            raise ValueError('record_every has to be at least 1')
+        if record_bits < 0:
+            raise ValueError('record_bits must not be negative')
+        if record_bits == 0 and record_capacity <= 0 and nr_of_steps == 0:
+            raise ValueError('recording without nr_of_steps needs a record_capacity')
+    if nr_of_processes < 0:
+        raise ValueError('nr_of_processes must not be negative')
+    if density_grid < 0:
+        raise ValueError('density_grid must not be negative')
+    if publish_every < 1:
+        raise ValueError('publish_every has to be at least 1')
+    if not 0 <= block_levels <= 30:
+        raise ValueError('block_levels has to be between 0 and 30')
+    if integrator not in sc.INTEGRATORS:
+        raise ValueError('unknown integrator: {}'.format(integrator))
+    if integrator == sc.INTEGRATOR_HERMITE:
+        if engine not in (sc.ENGINE_DIRECT, sc.ENGINE_DIRECT_SYMMETRIC, sc.ENGINE_DIRECT_TILED):
+            raise ValueError('the hermite integrator needs a direct engine')
+        if block_levels > 0:
+            raise ValueError('the hermite integrator does not support block_levels')
+    _set_num_threads(nr_of_threads)
 
     cdef double[:, ::1] positions = np.zeros((nr_of_bodies+1, 3), dtype=np.float64)
     cdef double[:, ::1] speed = np.zeros((nr_of_bodies+1, 3), dtype=np.float64)
@@ -320,19 +1595,138 @@ cpdef void startup(sim_pipe, int nr_of_bodies, tuple mass_lim, tuple dis_lim, tu
                                                         mass_lim,
                                                         dis_lim,
                                                         rad_lim,
-                                                        black_weight)
+                                                        black_weight,
+                                                        profile, seed)
 
-    # TODO: This is probably the best location to initialize the distributedMaster.
+    # original number of the body stored at each index
+    order = np.arange(nr_of_bodies+1)
+    cdef long step = 0
+    # accelerations (and jerks) at the current state, kept between steps
+    kept = ()
+    # step size proposed by the adaptive integrators
+    cdef double adaptive_step = 0.0
+    cdef double min_publish_interval = 1.0 / max_publish_rate if max_publish_rate > 0 else 0.0
+    cdef double last_publish = -min_publish_interval
+    cdef double now
 
+    frame_buffer = None
+    if shared_frames and sim_pipe is not None:
+        if density_grid > 0:
+            frame_buffer = FrameBuffer.create(density_grid, density_grid)
+        else:
+            frame_buffer = FrameBuffer.create(nr_of_bodies+1)
+        sim_pipe.send(frame_buffer.descriptor())
+
+    recorder = None
+    if record_path is not None and record_bits > 0:
+        recorder = TrajectoryArchiveWriter(record_path, nr_of_bodies+1, dis_lim[1],
+                                           record_bits,
+                                           radius=radius if record_radius else None)
+        recorder.record(0, 0.0, positions)
+    elif record_path is not None:
+        if record_capacity <= 0:
+            record_capacity = nr_of_steps // record_every + 1
+        recorder = TrajectoryRecorder(record_path, nr_of_bodies+1, record_capacity,
+                                      record_radius)
+        recorder.record(0, 0.0, positions, speed, radius, order)
+    cdef bint record
+
+    # distributed master or local process pool, both move the bodies
+    master = None
+    if nr_of_processes > 0:
+        master = SharedMemoryPool(nr_of_bodies+1, nr_of_processes)
+        master.set_state(positions, speed, mass)
+    elif distributed is not None:
+        master = DistributedMaster((distributed[0], distributed[1]))
+        master.accept_workers(distributed[2])
+        if distributed_ring:
+            master.start_ring()
+        master.set_state(positions, speed, mass)
+    cdef bint publish
+    cdef double loop_start = time.perf_counter()
 
     while True:
-        if sim_pipe.poll():
+        if nr_of_steps > 0 and step == nr_of_steps:
+            if frame_buffer is not None:
+                frame_buffer.close()
+            if master is not None:
+                master.stop()
+            if recorder is not None:
+                recorder.close()
+            return (step, time.perf_counter() - loop_start,
+                    recorder.dropped if recorder is not None else 0)
+        if sim_pipe is not None and sim_pipe.poll():
             message = sim_pipe.recv()
             if isinstance(message, str) and message == sc.END_MESSAGE:
                 print('simulation exiting ...')
+                if frame_buffer is not None:
+                    frame_buffer.close()
+                if master is not None:
+                    master.stop()
+                if recorder is not None:
+                    recorder.close()
                 sys.exit(0)
 
-        _move_bodies_circle(positions, speed, mass, timestep) # We probably need to pass the distributedMaster
-        pos_with_radius = np.c_[positions, radius]
-        sim_pipe.send(pos_with_radius * (1/dis_lim[1]))
+        if reorder_every > 0 and step % reorder_every == 0:
+            _sort_bodies(positions, speed, mass, radius, order, *kept)
+            if master is not None:
+                master.set_state(positions, speed, mass)
+        step += 1
+
+        publish = sim_pipe is not None and step % publish_every == 0
+        if publish and min_publish_interval > 0:
+            now = time.perf_counter()
+            publish = now - last_publish >= min_publish_interval
+            if publish:
+                last_publish = now
+
+        record = recorder is not None and step % record_every == 0
+
+        if master is not None:
+            # a ring only hands out the bodies when they are needed, the
+            # pool then skips copying them out
+            master.move_bodies(positions, speed, timestep,
+                               publish or record
+                               or (reorder_every > 0 and step % reorder_every == 0))
+        elif integrator == sc.INTEGRATOR_HERMITE:
+            if not kept:
+                kept = (np.zeros((nr_of_bodies+1, 3), dtype=np.float64),
+                        np.zeros((nr_of_bodies+1, 3), dtype=np.float64))
+                _accelerations_jerks(positions, speed, mass, kept[0], kept[1])
+            adaptive_step = _move_bodies_hermite(positions, speed, mass, kept[0], kept[1],
+                                                 timestep, adaptive_step, eta)
+        elif block_levels > 0 or integrator == sc.INTEGRATOR_VERLET:
+            if not kept:
+                kept = (np.zeros((nr_of_bodies+1, 3), dtype=np.float64),)
+                _accelerations(engine, positions, mass, kept[0], None, theta,
+                               grid_size, direct_black_hole, single_precision)
+            if block_levels > 0:
+                _move_bodies_block(engine, positions, speed, mass, kept[0], timestep,
+                                   block_levels, eta, theta, grid_size,
+                                   direct_black_hole, single_precision)
+            else:
+                adaptive_step = _move_bodies_verlet(engine, positions, speed, mass, kept[0],
+                                                    timestep, adaptive_step, eta, theta,
+                                                    grid_size, direct_black_hole,
+                                                    single_precision)
+        else:
+            _move_bodies(engine, positions, speed, mass, timestep, theta,
+                         grid_size, direct_black_hole, single_precision)
+        if record:
+            recorder.record(step, step * timestep, positions, speed, radius, order)
+        if not publish:
+            continue
+        if density_grid > 0:
+            if frame_buffer is not None:
+                _density_grid(positions, mass, dis_lim[1], frame_buffer.begin_write())
+                frame_buffer.end_write()
+            else:
+                grid = np.empty((density_grid, density_grid), dtype=np.float64)
+                _density_grid(positions, mass, dis_lim[1], grid)
+                sim_pipe.send(grid)
+        elif frame_buffer is not None:
+            _frame(positions, radius, order, 1/dis_lim[1], frame_buffer.begin_write())
+            frame_buffer.end_write()
+        else:
+            sim_pipe.send(_frame(positions, radius, order, 1/dis_lim[1]))
         # Positions changed in movedbodies is sent to renderer through the pipe
@@ -20,11 +20,10 @@
 # or open http://www.fsf.org/licensing/licenses/gpl.html
 #
 import sys
-from random import uniform, random
 import numpy as np
 from numba import jit
-import physics_formula as pf
 import simulation_constants as sc
+from initial_conditions import initialise_bodies
 
 __FPS = 60
 __DELTA_ALPHA = 0.01
@@ -68,69 +67,22 @@ def _move_bodies_circle(positions, speed, mass, timestep):
         speed[i] = speed[i] + timestep * accel
 
 
-@jit
-def _initialise_bodies(nr_of_bodies, mass_lim, dis_lim, rad_lim, black_weight):
+def _initialise_bodies(nr_of_bodies, mass_lim, dis_lim, rad_lim, black_weight,
+                       profile=sc.PROFILE_UNIFORM, seed=None):
     """
     Initialisiert eine Anzahl von Körpern mit zufälligen Massen
     und Positionen. Außerdem wird jedem Planeten eine
     Startgeschwindigkeit zugeteilt, sodass insgesamt ein
-    stabiles System entsteht.
+    stabiles System entsteht. Die Körper werden mit NumPy in O(N)
+    erzeugt, siehe initial_conditions.
 
     params:
         nr_of_bodies: Anzahl der zu generierenden Planeten
+        profile: Verteilung, eine aus simulation_constants.PROFILES
+        seed: Startwert des Zufallsgenerators (None = zufällig)
     """
-    min_mass = mass_lim[0]
-    max_mass = mass_lim[1]
-    min_radius = rad_lim[0]
-    max_radius = rad_lim[1]
-    min_distance = dis_lim[0]
-    max_distance = dis_lim[1]
-    max_z = dis_lim[2]
-
-    black_hole_weight = black_weight
-
-    positions = np.zeros((nr_of_bodies+1, 3), dtype=np.float64)
-    speed = np.zeros((nr_of_bodies+1, 3), dtype=np.float64)
-    radius = np.zeros((nr_of_bodies+1), dtype=np.float64)
-    mass = np.zeros((nr_of_bodies+1), dtype=np.float64)
-
-    # Black Hole
-    positions[0] = np.array([0, 0, 0])
-    speed[0] = [0, 0, 0]
-    mass[0] = black_hole_weight
-    radius[0] = 5000000000
-
-    for i in range(1, nr_of_bodies+1):
-        x_pos = uniform(min_distance, max_distance) * _get_sign()
-        y_pos = uniform(min_distance,
-                        np.sqrt(max_distance**2 - x_pos**2))*_get_sign()
-        z_pos = uniform(0, max_z) * _get_sign()
-        # Note: y_pos gets randomly generated between the min distance and
-        #       the distance so that the length of the (x, y) vector
-        #       is never longer than max_distance.
-        positions[i] = np.array([x_pos,
-                                 y_pos,
-                                 z_pos])
-
-        mass[i] = uniform(min_mass, max_mass)
-        radius[i] = uniform(min_radius, max_radius)
-
-    for i in range(1, nr_of_bodies+1):
-        speed[i] = pf.calc_speed_direction(i, mass, positions)
-
-    return positions, speed, radius, mass
-
-
-def _get_sign():
-    """
-    Generiert ein zufälliges Vorzeichen -/+
-    um bei der Initialisierung alle 4 Quadranten
-    mit Planeten zu füllen.
-
-    return:
-        +1 / -1
-    """
-    return 1 if random() >= 0.5 else -1
+    return initialise_bodies(nr_of_bodies, mass_lim, dis_lim, rad_lim, black_weight,
+                             profile, seed)
 
 
 def startup(sim_pipe, nr_of_bodies, mass_lim, dis_lim, rad_lim, black_weight, timestep):
@@ -0,0 +1,347 @@
+"""
+Compact archive of the positions of a run, for long recordings.
+
+Positions are quantized to integers in units of
+    scale = extent / 2 ** (bits - 1)
+with extent usually dis_lim[1], so a coordinate of +-extent needs `bits`
+bits and every stored coordinate is off by at most scale / 2. The
+quantized frames are grouped into chunks of keyframe_every frames. A
+chunk holds its first frame (the keyframe) and the integer differences
+of the following frames to their predecessors, in the smallest integer
+type that fits, compressed with zlib. Deltas are taken between quantized
+values, so the error does not grow along a chunk, and every chunk can be
+decoded on its own, in parallel with the others.
+
+Like trajectory_recorder, the writer only copies a frame into one of a
+few spare buffers; quantizing and compressing run in a background
+thread (zlib releases the GIL). Every frame is kept, so append() waits
+for a free buffer when the thread falls behind (and raises a
+RuntimeError if the thread failed). Of the chunk being
+filled only the keyframe and the deltas in their final integer type are
+held in memory.
+
+File layout:
+    header      magic, version, bits, N, keyframe_every, scale, has_radius
+    radius      N float64, if has_radius
+    chunks      zlib streams, one per chunk
+    footer      zlib stream of the chunk table and the step number and
+                simulated time of every frame
+    trailer     offset and size of the footer, number of chunks, end magic
+"""
+import mmap
+import queue
+import struct
+import sys
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+_MAGIC = b'GTRJ'
+_END_MAGIC = b'GTRJEND\0'
+_VERSION = 1
+# magic, version, bits, nr_of_bodies, keyframe_every, scale, has_radius
+_HEADER = struct.Struct('<4sHHqqd?')
+# footer offset, footer size, number of chunks, end magic
+_TRAILER = struct.Struct('<qqq8s')
+_CHUNK_DTYPE = np.dtype([('offset', np.int64), ('size', np.int64),
+                         ('first_frame', np.int64), ('nr_of_frames', np.int64),
+                         ('delta_itemsize', np.int64)])
+_DELTA_TYPES = (np.int8, np.int16, np.int32, np.int64)
+
+DEFAULT_BITS = 16
+DEFAULT_KEYFRAME_EVERY = 64
+# frames that may wait for the writer thread
+DEFAULT_NR_OF_BUFFERS = 4
+# seconds between the checks of the writer thread while waiting for a buffer
+_WAIT_INTERVAL = 1.0
+
+
+def _delta_type(deltas):
+    """
+        Smallest signed integer type holding all deltas.
+    """
+    if deltas.size == 0:
+        return np.int8
+    largest = max(-int(deltas.min()), int(deltas.max()))
+    for dtype in _DELTA_TYPES:
+        if largest <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+class TrajectoryArchiveWriter:
+    """
+        Writes positions frame by frame into a compressed archive.
+    """
+    def __init__(self, path, nr_of_bodies, extent, bits=DEFAULT_BITS,
+                 keyframe_every=DEFAULT_KEYFRAME_EVERY, radius=None,
+                 compression_level=6, nr_of_buffers=DEFAULT_NR_OF_BUFFERS):
+        """
+            Create a new archive.
+
+            Args:
+                path (str): Archive file
+                nr_of_bodies (int): Bodies per frame, including the black hole
+                extent (float): Coordinate mapped to the largest value of
+                    `bits` bits, usually dis_lim[1]
+                bits (int): Bits per coordinate, 8 to 48
+                keyframe_every (int): Frames per independently decodable chunk
+                radius (numpy.ndarray): Radius of every body, stored once
+                compression_level (int): zlib level
+                nr_of_buffers (int): Frames that may wait for the writer
+        """
+        if not 8 <= bits <= 48:
+            raise ValueError('bits has to be between 8 and 48')
+        if keyframe_every < 1:
+            raise ValueError('keyframe_every has to be at least 1')
+        if extent <= 0:
+            raise ValueError('extent has to be positive')
+        self.file = open(path, 'wb')
+        self.nr_of_bodies = nr_of_bodies
+        self.scale = extent / 2 ** (bits - 1)
+        self.keyframe_every = keyframe_every
+        self.compression_level = compression_level
+        self.file.write(_HEADER.pack(_MAGIC, _VERSION, bits, nr_of_bodies,
+                                     keyframe_every, self.scale, radius is not None))
+        if radius is not None:
+            self.file.write(np.ascontiguousarray(radius, dtype='<f8').tobytes())
+        self.chunks = []
+        self.steps = []
+        self.times = []
+        # same attribute as TrajectoryRecorder, the archive keeps every frame
+        self.dropped = 0
+
+        # chunk being filled by the writer thread: quantized keyframe, the
+        # quantized previous frame and the deltas since the keyframe
+        self.keyframe = None
+        self.previous = None
+        self.deltas = None
+        self.nr_of_deltas = 0
+        self.nr_of_frames = 0
+        # exception that stopped the writer thread
+        self.error = None
+
+        # filled frames wait in pending, empty buffers in free
+        self.free = queue.Queue()
+        for _ in range(nr_of_buffers):
+            self.free.put(np.empty((nr_of_bodies, 3), dtype=np.float64))
+        self.pending = queue.Queue()
+        self.writer = threading.Thread(target=self._write_frames, daemon=True)
+        self.writer.start()
+
+    def append(self, step, time, positions, order=None):
+        """
+            Hand a frame to the writer thread, waits only if all buffers
+            are taken.
+
+            Args:
+                step (int): Step number of the frame
+                time (float): Simulated seconds since the start
+                positions (numpy.ndarray): (N, 3) positions
+                order (numpy.ndarray): Original number of the body at each
+                    index, if the bodies were re-sorted
+            Raises:
+                RuntimeError: The writer thread failed.
+        """
+        buffer = self._wait_for_buffer()
+        buffer[slice(None) if order is None else order] = positions
+        self.steps.append(step)
+        self.times.append(time)
+        self.pending.put(buffer)
+
+    def record(self, step, time, positions, speed=None, radius=None, order=None):
+        """
+            Same interface as TrajectoryRecorder.record, the speeds are
+            not archived. Returns True.
+        """
+        self.append(step, time, positions, order)
+        return True
+
+    def _wait_for_buffer(self):
+        while True:
+            self._check_writer()
+            try:
+                return self.free.get(timeout=_WAIT_INTERVAL)
+            except queue.Empty:
+                pass
+
+    def _check_writer(self):
+        if not self.writer.is_alive():
+            raise RuntimeError('the writer thread of the archive failed') from self.error
+
+    def _write_frames(self):
+        try:
+            self._write_pending()
+        except BaseException as error:
+            self.error = error
+            raise
+
+    def _write_pending(self):
+        while True:
+            buffer = self.pending.get()
+            if buffer is None:
+                break
+            self._add(buffer)
+            self.free.put(buffer)
+        if self.keyframe is not None:
+            self._write_chunk()
+
+    def _add(self, positions):
+        quantized = np.rint(positions / self.scale).astype(np.int64)
+        if self.keyframe is None:
+            self.keyframe = quantized
+            self.deltas = np.empty((self.keyframe_every - 1,) + quantized.shape, dtype=np.int8)
+            self.nr_of_deltas = 0
+        else:
+            delta = quantized - self.previous
+            delta_type = np.dtype(_delta_type(delta))
+            if delta_type.itemsize > self.deltas.dtype.itemsize:
+                # a larger step than before in this chunk
+                self.deltas = self.deltas.astype(delta_type)
+            self.deltas[self.nr_of_deltas] = delta
+            self.nr_of_deltas += 1
+        self.previous = quantized
+        if self.nr_of_deltas + 1 == self.keyframe_every:
+            self._write_chunk()
+
+    def _write_chunk(self):
+        deltas = self.deltas[:self.nr_of_deltas]
+        data = zlib.compress(self.keyframe.astype('<i8').tobytes()
+                             + deltas.astype(deltas.dtype.newbyteorder('<')).tobytes(),
+                             self.compression_level)
+        nr_of_frames = self.nr_of_deltas + 1
+        self.chunks.append((self.file.tell(), len(data), self.nr_of_frames,
+                            nr_of_frames, deltas.dtype.itemsize))
+        self.file.write(data)
+        self.nr_of_frames += nr_of_frames
+        self.keyframe = None
+        self.deltas = None
+
+    def close(self):
+        """
+            Write the waiting frames, the last chunk and the footer.
+
+            Raises:
+                RuntimeError: The writer thread failed, the file is closed
+                    without footer and readers reject it as incomplete.
+        """
+        self.pending.put(None)
+        self.writer.join()
+        if self.error is not None:
+            self.file.close()
+            self._check_writer()
+        footer = zlib.compress(np.array(self.chunks, dtype=_CHUNK_DTYPE).tobytes()
+                               + np.array(self.steps, dtype='<i8').tobytes()
+                               + np.array(self.times, dtype='<f8').tobytes())
+        offset = self.file.tell()
+        self.file.write(footer)
+        self.file.write(_TRAILER.pack(offset, len(footer), len(self.chunks), _END_MAGIC))
+        self.file.close()
+
+
+class TrajectoryArchiveReader:
+    """
+        Random access to the frames of an archive. The file is
+        memory-mapped and only the chunks that are read are decompressed.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.bits, self.nr_of_bodies, self.keyframe_every, \
+            self.scale, has_radius = _HEADER.unpack_from(self.data)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError('{} is not a version {} trajectory archive'.format(path, _VERSION))
+        self.radius = None
+        if has_radius:
+            self.radius = np.frombuffer(self.data, dtype='<f8', count=self.nr_of_bodies,
+                                        offset=_HEADER.size).copy()
+        offset, size, nr_of_chunks, end_magic = _TRAILER.unpack_from(
+            self.data, len(self.data) - _TRAILER.size)
+        if end_magic != _END_MAGIC:
+            raise ValueError('{} is incomplete, the writer was not closed'.format(path))
+        footer = zlib.decompress(self.data[offset:offset + size])
+        self.chunks = np.frombuffer(footer, dtype=_CHUNK_DTYPE, count=nr_of_chunks)
+        nr_of_frames = int(self.chunks['nr_of_frames'].sum())
+        table_size = self.chunks.nbytes
+        self.steps = np.frombuffer(footer, dtype='<i8', count=nr_of_frames,
+                                   offset=table_size)
+        self.times = np.frombuffer(footer, dtype='<f8', count=nr_of_frames,
+                                   offset=table_size + 8 * nr_of_frames)
+
+    def __len__(self):
+        return len(self.steps)
+
+    def decode_chunk(self, chunk):
+        """
+            Decode one chunk, returns its (frames, N, 3) positions.
+        """
+        offset, size, _, nr_of_frames, delta_itemsize = self.chunks[chunk]
+        data = zlib.decompress(self.data[offset:offset + size])
+        values = self.nr_of_bodies * 3
+        delta_type = np.dtype(_DELTA_TYPES[int(delta_itemsize).bit_length() - 1]).newbyteorder('<')
+        quantized = np.empty((nr_of_frames, self.nr_of_bodies, 3), dtype=np.int64)
+        quantized[0] = np.frombuffer(data, dtype='<i8', count=values).reshape(-1, 3)
+        deltas = np.frombuffer(data, dtype=delta_type, count=(nr_of_frames - 1) * values,
+                               offset=8 * values).reshape(-1, self.nr_of_bodies, 3)
+        np.cumsum(deltas, axis=0, dtype=np.int64, out=quantized[1:])
+        quantized[1:] += quantized[0]
+        return quantized * self.scale
+
+    def read(self, start=0, stop=None, nr_of_threads=1):
+        """
+            Positions of the frames start to stop-1.
+
+            Args:
+                start, stop (int): Frame range, stop None reads to the end
+                nr_of_threads (int): Decode the chunks of the range in that
+                    many threads, zlib and numpy release the GIL
+            Returns:
+                (stop - start, N, 3) float64 array
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        first = int(np.searchsorted(self.chunks['first_frame'], start, side='right')) - 1
+        last = int(np.searchsorted(self.chunks['first_frame'], stop, side='left'))
+        chunks = range(max(first, 0), last)
+        if nr_of_threads > 1 and len(chunks) > 1:
+            with ThreadPoolExecutor(nr_of_threads) as executor:
+                decoded = list(executor.map(self.decode_chunk, chunks))
+        else:
+            decoded = [self.decode_chunk(chunk) for chunk in chunks]
+        if not decoded:
+            return np.empty((0, self.nr_of_bodies, 3))
+        frames = np.concatenate(decoded)
+        skip = start - int(self.chunks['first_frame'][chunks[0]])
+        return frames[skip:skip + stop - start]
+
+
+def convert(recording_path, archive_path, extent, bits=DEFAULT_BITS,
+            keyframe_every=DEFAULT_KEYFRAME_EVERY):
+    """
+        Archive the positions of a trajectory_recorder recording.
+    """
+    from trajectory_recorder import TrajectoryReader
+    recording = TrajectoryReader(recording_path)
+    writer = TrajectoryArchiveWriter(archive_path, recording.nr_of_bodies, extent, bits,
+                                     keyframe_every, recording.radius(0) if
+                                     recording.with_radius and len(recording) else None)
+    for frame, (step, time) in enumerate(zip(recording.steps, recording.times)):
+        writer.append(int(step), float(time), recording.positions(frame))
+    writer.close()
+    return len(recording)
+
+
+def _main(argv):
+    if len(argv) < 4:
+        print('usage:', argv[0], 'recording.npy archive extent [bits] [keyframe_every]')
+        return 0
+    bits = int(argv[4]) if len(argv) > 4 else DEFAULT_BITS
+    keyframe_every = int(argv[5]) if len(argv) > 5 else DEFAULT_KEYFRAME_EVERY
+    frames = convert(argv[1], argv[2], float(argv[3]), bits, keyframe_every)
+    print(frames, 'frames archived')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main(sys.argv))
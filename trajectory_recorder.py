@@ -0,0 +1,225 @@
+"""
+Record the frames of a run into memory-mapped .npy files.
+
+A recording is two .npy files that np.load can open:
+    <path>              (capacity, N, columns) float64 frames, columns
+                        0-2 positions, 3-5 speed and 6 the radius if it
+                        was recorded, bodies in their original order
+    <path>.index.npy    (capacity,) records of the step number and the
+                        simulated time of every frame, step -1 marks
+                        frames not written yet
+
+Both files are allocated at full size when the recording starts. The
+simulation only copies a frame into one of a few spare buffers and
+returns; a background thread writes it into the map. If the writer falls
+behind and all buffers are taken, record() waits for the next free
+buffer, so no frame is lost (with drop_when_behind the frame is dropped
+instead and the simulation never waits). If the writer thread fails,
+record() and close() raise a RuntimeError instead of waiting for it.
+Frames beyond the capacity are dropped. Dropped frames are counted in `dropped`, the first one issues a
+RuntimeWarning. A frame's index entry is written after its data, so a
+TrajectoryReader in another process sees every frame with a valid step
+number complete, also while the run is still in progress.
+"""
+import queue
+import threading
+import warnings
+
+import numpy as np
+
+INDEX_DTYPE = np.dtype([('step', np.int64), ('time', np.float64)])
+# position and speed, plus radius
+COLUMNS = 6
+COLUMNS_WITH_RADIUS = 7
+# frames that may wait for the writer thread
+DEFAULT_NR_OF_BUFFERS = 4
+# seconds between the checks of the writer thread while waiting for a buffer
+_WAIT_INTERVAL = 1.0
+
+
+def index_path(path):
+    """
+        Path of the index file belonging to a recording.
+    """
+    return str(path) + '.index.npy'
+
+
+class TrajectoryRecorder:
+    """
+        Appends frames to a preallocated memory-mapped recording from a
+        background thread.
+    """
+    def __init__(self, path, nr_of_bodies, capacity, with_radius=False,
+                 nr_of_buffers=DEFAULT_NR_OF_BUFFERS, drop_when_behind=False):
+        """
+            Create the files of a new recording.
+
+            Args:
+                path (str): File of the frames, the index goes next to it
+                nr_of_bodies (int): Bodies per frame, including the black hole
+                capacity (int): Number of frames the files can hold, later
+                    frames are dropped
+                with_radius (bool): Also record the radius of every body
+                nr_of_buffers (int): Frames that may wait for the writer
+                drop_when_behind (bool): Drop frames while all buffers wait
+                    for the writer instead of waiting for a free one
+        """
+        columns = COLUMNS_WITH_RADIUS if with_radius else COLUMNS
+        self.frames = np.lib.format.open_memmap(
+            path, mode='w+', dtype=np.float64, shape=(capacity, nr_of_bodies, columns))
+        self.index = np.lib.format.open_memmap(
+            index_path(path), mode='w+', dtype=INDEX_DTYPE, shape=(capacity,))
+        self.index['step'] = -1
+        self.index.flush()
+        self.capacity = capacity
+        self.with_radius = with_radius
+        self.drop_when_behind = drop_when_behind
+        # frames handed over by record() and written by the thread
+        self.accepted = 0
+        self.nr_of_frames = 0
+        self.dropped = 0
+        # exception that stopped the writer thread
+        self.error = None
+
+        # filled frames wait in pending, empty buffers in free
+        self.free = queue.Queue()
+        for _ in range(nr_of_buffers):
+            self.free.put(np.empty((nr_of_bodies, columns), dtype=np.float64))
+        self.pending = queue.Queue()
+        self.writer = threading.Thread(target=self._write_frames, daemon=True)
+        self.writer.start()
+
+    def record(self, step, time, positions, speed, radius=None, order=None):
+        """
+            Hand a frame to the writer thread. Waits for a free buffer if
+            the writer is behind, unless drop_when_behind is set.
+
+            Args:
+                step (int): Step number of the frame
+                time (float): Simulated seconds since the start
+                positions, speed, radius: Arrays of all bodies
+                order (numpy.ndarray): Original number of the body at each
+                    index, if the bodies were re-sorted
+            Returns:
+                False if the frame was dropped (recording full, or writer
+                behind with drop_when_behind).
+            Raises:
+                RuntimeError: The writer thread failed.
+        """
+        if self.accepted >= self.capacity:
+            self._drop('the recording is full ({} frames)'.format(self.capacity))
+            return False
+        try:
+            buffer = self.free.get_nowait()
+        except queue.Empty:
+            if self.drop_when_behind:
+                self._drop('the writer thread is behind')
+                return False
+            # wait for the writer rather than losing the frame
+            buffer = self._wait_for_buffer()
+        if order is None:
+            order = slice(None)
+        buffer[order, 0:3] = positions
+        buffer[order, 3:6] = speed
+        if self.with_radius:
+            buffer[order, 6] = radius
+        self.pending.put((step, time, buffer))
+        self.accepted += 1
+        return True
+
+    def _drop(self, reason):
+        if not self.dropped:
+            warnings.warn('dropping recorded frames, {}'.format(reason),
+                          RuntimeWarning, stacklevel=3)
+        self.dropped += 1
+
+    def _wait_for_buffer(self):
+        while True:
+            self._check_writer()
+            try:
+                return self.free.get(timeout=_WAIT_INTERVAL)
+            except queue.Empty:
+                pass
+
+    def _check_writer(self):
+        if not self.writer.is_alive():
+            raise RuntimeError('the writer thread of the recording failed') from self.error
+
+    def _write_frames(self):
+        try:
+            self._write_pending()
+        except BaseException as error:
+            self.error = error
+            raise
+
+    def _write_pending(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            step, time, buffer = item
+            frame = self.nr_of_frames
+            self.frames[frame] = buffer
+            self.free.put(buffer)
+            # data before index, readers trust frames with a step number
+            self.index['time'][frame] = time
+            self.index['step'][frame] = step
+            self.nr_of_frames = frame + 1
+
+    def close(self):
+        """
+            Write the waiting frames and flush both files.
+
+            Raises:
+                RuntimeError: The writer thread failed, the frames it
+                    wrote before are flushed.
+        """
+        self.pending.put(None)
+        self.writer.join()
+        self.frames.flush()
+        self.index.flush()
+        del self.frames
+        del self.index
+        if self.error is not None:
+            self._check_writer()
+
+
+class TrajectoryReader:
+    """
+        Read-only view of a recording, may be opened while it is written.
+    """
+    def __init__(self, path):
+        self.frames = np.load(path, mmap_mode='r')
+        self.index = np.load(index_path(path), mmap_mode='r')
+        self.with_radius = self.frames.shape[2] == COLUMNS_WITH_RADIUS
+
+    def __len__(self):
+        """
+            Number of complete frames.
+        """
+        written = self.index['step'] < 0
+        return int(np.argmax(written)) if written.any() else len(written)
+
+    @property
+    def nr_of_bodies(self):
+        return self.frames.shape[1]
+
+    @property
+    def steps(self):
+        return self.index['step'][:len(self)]
+
+    @property
+    def times(self):
+        return self.index['time'][:len(self)]
+
+    def positions(self, frame):
+        return self.frames[frame, :, 0:3]
+
+    def speed(self, frame):
+        return self.frames[frame, :, 3:6]
+
+    def radius(self, frame):
+        """
+            Radius of every body, None if it was not recorded.
+        """
+        return self.frames[frame, :, 6] if self.with_radius else None
@@ -0,0 +1,237 @@
+"""
+Play a recorded run back in the GalaxyRenderer.
+
+How to use:
+    python trajectory_replay.py recording [fps] [mode] [extent]
+
+recording is a trajectory_recorder .npy file or a trajectory_archive.
+The replay keeps a playback position in simulated time. Every rendered
+frame advances it by the elapsed wall time times the playback rate, and
+the bodies are interpolated between the two recorded frames around it
+with cubic Hermite polynomials. The tangents are the recorded speeds, or
+finite differences of the positions for archives, which store no speeds.
+So a run recorded every k steps still plays back smoothly at any fps.
+
+Keys in the renderer window:
+    space       pause / play
+    r           reverse the direction
+    + / -       double / halve the playback rate
+    , / .       pause and step one recorded frame back / forward
+    0 - 9       seek to 0 % - 90 % of the run
+    left/right  seek 5 % back / forward
+"""
+import sys
+
+import numpy as np
+
+from trajectory_archive import TrajectoryArchiveReader
+from trajectory_recorder import TrajectoryReader
+
+# recorded simulation steps played per wall second at rate 1
+DEFAULT_STEPS_PER_SECOND = 60
+# radius in renderer units for recordings without radius
+DEFAULT_RADIUS = 0.005
+# fraction of the run the arrow keys seek
+SEEK_STEP = 0.05
+# decoded archive chunks kept
+_CACHED_CHUNKS = 3
+
+
+def _is_archive(path):
+    with open(path, 'rb') as f:
+        return f.read(4) == b'GTRJ'
+
+
+class TrajectoryReplay:
+    """
+        Playback position and interpolated frames of a recording.
+    """
+    def __init__(self, path, extent=None,
+                 steps_per_second=DEFAULT_STEPS_PER_SECOND):
+        """
+            Open a recording for playback.
+
+            Args:
+                path (str): trajectory_recorder or trajectory_archive file
+                extent (float): Distance mapped to 1 in the renderer
+                    (dis_lim[1] of the run). Archives know it, for
+                    recordings the default is the largest x or y of the
+                    first frame.
+                steps_per_second (float): Simulation steps played per wall
+                    second at rate 1
+        """
+        if _is_archive(path):
+            self.archive = TrajectoryArchiveReader(path)
+            self.recording = None
+            self.times = np.array(self.archive.times)
+            steps = self.archive.steps
+            radius = self.archive.radius
+            if extent is None:
+                extent = self.archive.scale * 2 ** (self.archive.bits - 1)
+            self.nr_of_bodies = self.archive.nr_of_bodies
+        else:
+            self.archive = None
+            self.recording = TrajectoryReader(path)
+            self.times = np.array(self.recording.times)
+            steps = self.recording.steps
+            radius = self.recording.radius(0) if self.recording.with_radius else None
+            if extent is None:
+                extent = float(np.abs(self.recording.positions(0)[:, :2]).max())
+            self.nr_of_bodies = self.recording.nr_of_bodies
+        if len(self.times) < 2:
+            raise ValueError('{} has less than two frames'.format(path))
+        self.chunks = {}
+        self.scale = 1 / extent
+        self.radius = (radius * self.scale if radius is not None
+                       else np.full(self.nr_of_bodies, DEFAULT_RADIUS))
+        # simulated seconds of one step
+        step_time = (self.times[-1] - self.times[0]) / max(int(steps[-1] - steps[0]), 1)
+        self.base_rate = steps_per_second * step_time
+        self.rate = 1.0
+        self.direction = 1
+        self.paused = False
+        self.time = float(self.times[0])
+
+    @property
+    def start_time(self):
+        return float(self.times[0])
+
+    @property
+    def end_time(self):
+        return float(self.times[-1])
+
+    def advance(self, seconds):
+        """
+            Move the playback position by `seconds` of wall time, stops
+            at the ends of the recording.
+        """
+        if self.paused:
+            return
+        self.seek(self.time + self.direction * self.rate * self.base_rate * seconds)
+        if self.time == self._last_time():
+            self.paused = True
+
+    def _last_time(self):
+        """
+            End of the recording in playback direction.
+        """
+        return self.end_time if self.direction > 0 else self.start_time
+
+    def seek(self, time):
+        """
+            Jump to a simulated time, clamped to the recording.
+        """
+        self.time = min(max(time, self.start_time), self.end_time)
+
+    def seek_fraction(self, fraction):
+        self.seek(self.start_time + fraction * (self.end_time - self.start_time))
+
+    def seek_relative(self, fraction):
+        """
+            Move by a fraction of the whole run, negative moves back.
+        """
+        self.seek(self.time + fraction * (self.end_time - self.start_time))
+
+    def step_frame(self, frames):
+        """
+            Pause and move by whole recorded frames.
+        """
+        self.paused = True
+        frame = int(np.searchsorted(self.times, self.time, side='right')) - 1
+        if frames < 0 and self.time > self.times[frame]:
+            frames += 1
+        frame = min(max(frame + frames, 0), len(self.times) - 1)
+        self.time = float(self.times[frame])
+
+    def keyboard(self, key):
+        """
+            Apply a key of the renderer window, returns whether it was used.
+        """
+        if key == b' ':
+            if self.paused and self.time == self._last_time():
+                # play again from the beginning
+                self.seek(self.start_time if self.direction > 0 else self.end_time)
+            self.paused = not self.paused
+        elif key == b'r':
+            self.direction = -self.direction
+        elif key == b'+':
+            self.rate *= 2
+        elif key == b'-':
+            self.rate /= 2
+        elif key == b',':
+            self.step_frame(-1)
+        elif key == b'.':
+            self.step_frame(1)
+        elif key.isdigit():
+            self.seek_fraction(int(key) / 10)
+        else:
+            return False
+        return True
+
+    def _positions(self, frame):
+        if self.recording is not None:
+            return self.recording.positions(frame)
+        first_frames = self.archive.chunks['first_frame']
+        chunk = int(np.searchsorted(first_frames, frame, side='right')) - 1
+        if chunk not in self.chunks:
+            if len(self.chunks) >= _CACHED_CHUNKS:
+                del self.chunks[next(iter(self.chunks))]
+            self.chunks[chunk] = self.archive.decode_chunk(chunk)
+        return self.chunks[chunk][frame - int(first_frames[chunk])]
+
+    def _tangent(self, frame):
+        """
+            Time derivative of the positions at a recorded frame.
+        """
+        if self.recording is not None:
+            return self.recording.speed(frame)
+        before = max(frame - 1, 0)
+        after = min(frame + 1, len(self.times) - 1)
+        return ((self._positions(after) - self._positions(before))
+                / (self.times[after] - self.times[before]))
+
+    def positions(self, time=None):
+        """
+            Positions of all bodies at a simulated time (default: the
+            playback position), interpolated between the recorded frames.
+        """
+        time = self.time if time is None else time
+        frame = int(np.searchsorted(self.times, time, side='right')) - 1
+        frame = min(max(frame, 0), len(self.times) - 2)
+        span = self.times[frame + 1] - self.times[frame]
+        u = (time - self.times[frame]) / span
+        # cubic Hermite basis
+        h00 = 2 * u**3 - 3 * u**2 + 1
+        h10 = u**3 - 2 * u**2 + u
+        h01 = -2 * u**3 + 3 * u**2
+        h11 = u**3 - u**2
+        return (h00 * self._positions(frame) + h10 * span * self._tangent(frame)
+                + h01 * self._positions(frame + 1) + h11 * span * self._tangent(frame + 1))
+
+    def frame(self, out=None):
+        """
+            (N, 4) renderer frame of positions and radii at the playback
+            position, in renderer units.
+        """
+        if out is None:
+            out = np.empty((self.nr_of_bodies, 4), dtype=np.float64)
+        out[:, :3] = self.positions()
+        out[:, :3] *= self.scale
+        out[:, 3] = self.radius
+        return out
+
+
+def _main(argv):
+    if len(argv) < 2:
+        print('usage:', argv[0], 'recording [fps] [mode] [extent]')
+        return 0
+    import galaxy_renderer
+    fps = float(argv[2]) if len(argv) > 2 else 60
+    mode = argv[3] if len(argv) > 3 else galaxy_renderer.MODE_SPHERES
+    extent = float(argv[4]) if len(argv) > 4 else None
+    galaxy_renderer.startup(None, fps, mode, replay=argv[1], replay_extent=extent)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main(sys.argv))